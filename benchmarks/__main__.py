@@ -3,18 +3,46 @@ from csv import DictWriter
 from csv import excel_tab
 from glob import glob
 from itertools import product
+from operator import truediv
 from os import getenv
 from os import makedirs
+from os.path import getsize
 from os.path import isfile
 from os.path import join
+from random import Random
+from shutil import rmtree
 from sys import stderr
 from sys import stdout
 
+from benchmarks.compression import NoCompression
 from benchmarks.compression import get_all as compressors
+from benchmarks.corpus import CompactCorpus
+from benchmarks.delta import get_all as delta_compressors
+from benchmarks.delta import serialize_batch
+from benchmarks.delta import split_batches
+from benchmarks.encryption import NoEncryption
 from benchmarks.encryption import get_all as encryptors
+from benchmarks.estimation import SizeEstimator
+from benchmarks.estimation import prune
+from benchmarks.granularity import get_all as granularities
+from benchmarks.jobs import read_digests
+from benchmarks.jobs import verify_emails
+from benchmarks.jobs import write_read
+from benchmarks.pipeline import reader_chain
+from benchmarks.pipeline import writer_chain
+from benchmarks.preprocessing import AttachmentDedupPreprocessing
+from benchmarks.preprocessing import NoPreprocessing
+from benchmarks.preprocessing import get_all as preprocessors
+from benchmarks.routing import AttachmentRouter
+from benchmarks.sandbox import first_cpu
+from benchmarks.sandbox import run_isolated
+from benchmarks.serialization import AvroSerialization
 from benchmarks.serialization import get_all as serializers
+from benchmarks.sharding import MANIFEST_NAME
+from benchmarks.sharding import get_all as shardings
 from benchmarks.utils import Timer
 from benchmarks.utils import download_sample_emails
+from benchmarks.utils import email_digest
 from benchmarks.utils import filesize_kb
 from benchmarks.utils import load_sample_email
 from benchmarks.utils import pretty_extension
@@ -24,23 +52,171 @@ Benchmark = namedtuple('Benchmark', (
     'Compressor',
     'Serializer',
     'Encryptor',
+    'Preprocessor',
     'FilesizeKb',
     'WriteTimeSeconds',
     'ReadTimeSeconds',
+    'FirstEmailSeconds',
+    'LatencyP50Ms',
+    'LatencyP99Ms',
+))
+
+
+PartialReadBenchmark = namedtuple('PartialReadBenchmark', (
+    'Compressor',
+    'Serializer',
+    'FilesizeKb',
+    'WriteTimeSeconds',
+    'ReadTimeSeconds',
+    'TailReadTimeSeconds',
+))
+
+
+DedupBenchmark = namedtuple('DedupBenchmark', (
+    'Serializer',
+    'FilesizeKb',
+    'DedupFilesizeKb',
+    'SavedKb',
+    'WriteTimeSeconds',
+    'DedupWriteTimeSeconds',
+    'ReadTimeSeconds',
+    'DedupReadTimeSeconds',
+    'SavedSeconds',
+))
+
+
+RoutingBenchmark = namedtuple('RoutingBenchmark', (
+    'Compressor',
+    'Serializer',
+    'FilesizeKb',
+    'RoutedFilesizeKb',
+    'SizeDifferenceKb',
+    'CpuSeconds',
+    'RoutedCpuSeconds',
+    'SavedCpuSeconds',
+))
+
+
+PipelineBenchmark = namedtuple('PipelineBenchmark', (
+    'Compressor',
+    'Serializer',
+    'Encryptor',
+    'WriteTimeSeconds',
+    'PipelinedWriteTimeSeconds',
+    'WriteSpeedup',
+    'WriteEmailsPerSecond',
+    'ReadTimeSeconds',
+    'PipelinedReadTimeSeconds',
+    'ReadSpeedup',
+    'ReadEmailsPerSecond',
+))
+
+
+CoalescingBenchmark = namedtuple('CoalescingBenchmark', (
+    'Compressor',
+    'Serializer',
+    'BufferSize',
+    'WriteTimeSeconds',
+    'WriteEmailsPerSecond',
+    'Speedup',
+))
+
+
+GranularityBenchmark = namedtuple('GranularityBenchmark', (
+    'Compressor',
+    'Serializer',
+    'Granularity',
+    'FilesizeKb',
+    'OverheadBytesPerEmail',
+    'WriteTimeSeconds',
+    'ReadTimeSeconds',
+    'RandomReadMilliseconds',
+))
+
+
+DeltaBenchmark = namedtuple('DeltaBenchmark', (
+    'Compressor',
+    'Serializer',
+    'NumBatches',
+    'IndependentKb',
+    'IncrementalKb',
+    'SavedPercent',
+    'CompressTimeSeconds',
+    'DecompressTimeSeconds',
+))
+
+
+ConstrainedBenchmark = namedtuple('ConstrainedBenchmark', (
+    'Compressor',
+    'Serializer',
+    'Encryptor',
+    'ReadTimeSeconds',
+    'ConstrainedReadTimeSeconds',
+    'Slowdown',
+    'PeakMemoryMb',
+    'ConstrainedPeakMemoryMb',
+))
+
+
+ProjectionBenchmark = namedtuple('ProjectionBenchmark', (
+    'Serializer',
+    'FilesizeKb',
+    'ReadTimeSeconds',
+    'HeaderReadTimeSeconds',
+    'Speedup',
+))
+
+HEADER_FIELDS = ('from', 'subject', 'sent_at')
+
+ShardingBenchmark = namedtuple('ShardingBenchmark', (
+    'Compressor',
+    'Serializer',
+    'Encryptor',
+    'Sharding',
+    'NumShards',
+    'FilesizeKb',
+    'OverheadPercent',
+    'WriteSpeedup',
+    'ReadSpeedup',
+    'ShardKb',
+    'ShardFetchMilliseconds',
+))
+
+
+EstimateBenchmark = namedtuple('EstimateBenchmark', (
+    'Compressor',
+    'Serializer',
+    'Encryptor',
+    'Preprocessor',
+    'EstimatedFilesizeKb',
+    'FilesizeKbInterval',
+    'FilesizeKb',
+    'FilesizeErrorPercent',
+    'EstimatedWriteTimeSeconds',
+    'WriteTimeSeconds',
+    'Status',
 ))
 
 
 class BenchmarkError:
     def __init__(self, ex):
-        self.ex = ex
+        # drop the traceback so that kept results don't pin the failed job's buffers in memory
+        self.ex = ex.with_traceback(None) if isinstance(ex, BaseException) else ex
 
     def __str__(self):
         return 'ERROR'
 
 
-def load_samples(zip_url, inputs_dir, exclude_attachments):
+def format_result(template, *values, combine=None):
+    for value in values:
+        if isinstance(value, BenchmarkError):
+            return value
+    return template.format(combine(*values) if combine else values[0])
+
+
+def load_samples(zip_url, inputs_dir, exclude_attachments, compact=False):
     download_sample_emails(zip_url, inputs_dir)
-    sample_emails = []
+    sample_emails = CompactCorpus() if compact else []
     for path in glob(join(inputs_dir, '*')):
         sample_email = load_sample_email(path)
         if exclude_attachments:
@@ -49,92 +225,694 @@ def load_samples(zip_url, inputs_dir, exclude_attachments):
     return sample_emails
 
 
-def print_progress(compressor, serializer, encryptor, i, total):
-    print('Running {}+{}+{} ({}/{})'.format(
-        pretty_extension(compressor.extension),
-        pretty_extension(serializer.extension),
-        pretty_extension(encryptor.extension),
+def format_stages(compressor, serializer, encryptor, preprocessor=None):
+    stages = [compressor, serializer, encryptor]
+    if preprocessor is not None:
+        stages.append(preprocessor)
+    return '+'.join(pretty_extension(stage.extension) for stage in stages)
+
+
+def print_progress(compressor, serializer, encryptor, i, total, preprocessor=None):
+    print('Running {} ({}/{})'.format(
+        format_stages(compressor, serializer, encryptor, preprocessor),
         i + 1,
         total,
     ), file=stderr)
 
 
-def print_error(stage, compressor, serializer, encryptor, ex):
-    print('Error during {}-phase in {}+{}+{}: {}'.format(
+def print_error(stage, compressor, serializer, encryptor, ex, preprocessor=None):
+    print('Error during {}-phase in {}: {}'.format(
         stage,
-        pretty_extension(compressor.extension),
-        pretty_extension(serializer.extension),
-        pretty_extension(encryptor.extension),
+        format_stages(compressor, serializer, encryptor, preprocessor),
         ex,
     ), file=stderr)
 
 
-def run_benchmarks(emails, results_dir, incremental):
+def grid_jobs(serializer_variants=False, preprocessing=False, compressor_variants=False, encryptor_variants=False):
+    return list(product(compressors(compressor_variants), serializers(serializer_variants),
+                        encryptors(encryptor_variants),
+                        preprocessors() if preprocessing else (NoPreprocessing(),)))
+
+
+def run_benchmarks(emails, results_dir, incremental, pipelined=False, isolated=False,
+                   timeout=None, memory_limit_mb=None, jobs=None):
     makedirs(results_dir, exist_ok=True)
 
-    jobs = list(product(compressors(), serializers(), encryptors()))
+    jobs = list(jobs) if jobs is not None else grid_jobs()
     num_jobs = len(jobs)
 
-    for i, (compressor, serializer, encryptor) in enumerate(jobs):
-        outpath = join(results_dir, 'emails{}{}{}'.format(
-            serializer.extension, compressor.extension, encryptor.extension))
+    for i, (compressor, serializer, encryptor, preprocessor) in enumerate(jobs):
+        outpath = join(results_dir, 'emails{}{}{}{}'.format(
+            preprocessor.extension, serializer.extension, compressor.extension, encryptor.extension))
 
         if incremental and isfile(outpath):
             continue
 
+        print_progress(compressor, serializer, encryptor, i, num_jobs, preprocessor)
+
+        job = (emails, outpath, compressor, serializer, encryptor, preprocessor, pipelined)
+        if isolated:
+            try:
+                write_time, read_time, latency = run_isolated(
+                    write_read, *job, timeout=timeout, memory_limit_mb=memory_limit_mb)
+            except Exception as ex:
+                print_error('isolated', compressor, serializer, encryptor, ex, preprocessor)
+                write_time = read_time = latency = BenchmarkError(ex)
+        else:
+            write_time, read_time, latency = write_read(*job)
+
+        if isinstance(write_time, Exception):
+            print_error('write', compressor, serializer, encryptor, write_time, preprocessor)
+            write_time = read_time = latency = BenchmarkError(write_time)
+        elif isinstance(read_time, Exception):
+            print_error('read', compressor, serializer, encryptor, read_time, preprocessor)
+            read_time = latency = BenchmarkError(read_time)
+
+        filesize = write_time if isinstance(write_time, BenchmarkError) else filesize_kb(outpath)
+
+        yield Benchmark(
+            Compressor=pretty_extension(compressor.extension),
+            Serializer=pretty_extension(serializer.extension),
+            Encryptor=pretty_extension(encryptor.extension),
+            Preprocessor=pretty_extension(preprocessor.extension),
+            FilesizeKb=format_result('{:.2f}', filesize),
+            WriteTimeSeconds=format_result('{:.4f}', write_time),
+            ReadTimeSeconds=format_result('{:.4f}', read_time),
+            FirstEmailSeconds=format_result('{:.4f}', latency, combine=lambda value: value.first_seconds),
+            LatencyP50Ms=format_result('{:.3f}', latency, combine=lambda value: 1000 * value.p50_seconds),
+            LatencyP99Ms=format_result('{:.3f}', latency, combine=lambda value: 1000 * value.p99_seconds),
+        )
+
+        if not incremental:
+            remove_if_exists(outpath)
+
+
+def run_partial_read_benchmarks(emails, results_dir):
+    makedirs(results_dir, exist_ok=True)
+
+    avro_serializers = [serializer for serializer in serializers(variants=True)
+                        if isinstance(serializer, AvroSerialization)]
+    jobs = list(product(compressors(), avro_serializers))
+    num_jobs = len(jobs)
+    encryptor = NoEncryption()
+
+    for i, (compressor, serializer) in enumerate(jobs):
+        outpath = join(results_dir, 'emails{}{}'.format(
+            serializer.extension, compressor.extension))
+
         print_progress(compressor, serializer, encryptor, i, num_jobs)
 
         try:
             with Timer.timeit() as write_timer:
                 with open(outpath, 'wb') as raw:
-                    with encryptor.encrypt(raw) as enc:
-                        with compressor.compress(enc) as comp:
+                    with compressor.compress(raw) as comp:
+                        serializer.serialize(iter(emails), comp)
+        except Exception as ex:
+            print_error('write', compressor, serializer, encryptor, ex)
+            filesize = write_time = read_time = tail_read_time = BenchmarkError(ex)
+        else:
+            filesize = filesize_kb(outpath)
+            write_time = write_timer.elapsed()
+            try:
+                with Timer.timeit() as read_timer:
+                    with open(outpath, 'rb') as raw:
+                        with compressor.decompress(raw) as decomp:
+                            num_read = sum(1 for _ in serializer.deserialize(decomp))
+
+                with Timer.timeit() as tail_read_timer:
+                    with open(outpath, 'rb') as raw:
+                        with compressor.decompress(raw) as decomp:
+                            tail = list(serializer.deserialize(decomp, skip=len(emails) - 1))
+
+                assert num_read == len(emails), 'read {} of {} emails'.format(num_read, len(emails))
+                assert len(tail) == min(1, len(emails)), 'tail read returned {} emails'.format(len(tail))
+            except Exception as ex:
+                print_error('read', compressor, serializer, encryptor, ex)
+                read_time = tail_read_time = BenchmarkError(ex)
+            else:
+                read_time = read_timer.elapsed()
+                tail_read_time = tail_read_timer.elapsed()
+
+        yield PartialReadBenchmark(
+            Compressor=pretty_extension(compressor.extension),
+            Serializer=pretty_extension(serializer.extension),
+            FilesizeKb=format_result('{:.2f}', filesize),
+            WriteTimeSeconds=format_result('{:.4f}', write_time),
+            ReadTimeSeconds=format_result('{:.4f}', read_time),
+            TailReadTimeSeconds=format_result('{:.4f}', tail_read_time),
+        )
+
+        remove_if_exists(outpath)
+
+
+def run_dedup_benchmarks(emails, results_dir):
+    makedirs(results_dir, exist_ok=True)
+
+    jobs = list(serializers())
+    num_jobs = len(jobs)
+    compressor = NoCompression()
+    encryptor = NoEncryption()
+    preprocessors = (NoPreprocessing(), AttachmentDedupPreprocessing())
+
+    for i, serializer in enumerate(jobs):
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        filesizes = []
+        write_times = []
+        read_times = []
+        for preprocessor in preprocessors:
+            outpath = join(results_dir, 'emails{}{}'.format(
+                preprocessor.extension, serializer.extension))
+
+            try:
+                with Timer.timeit() as write_timer:
+                    with open(outpath, 'wb') as raw:
+                        serializer.serialize(preprocessor.preprocess(iter(emails)), raw)
+
+                with Timer.timeit() as read_timer:
+                    with open(outpath, 'rb') as raw:
+                        actuals = preprocessor.postprocess(serializer.deserialize(raw))
+                        verify_emails(actuals, emails)
+            except Exception as ex:
+                print_error('roundtrip', compressor, serializer, encryptor, ex, preprocessor)
+                filesizes.append(BenchmarkError(ex))
+                write_times.append(BenchmarkError(ex))
+                read_times.append(BenchmarkError(ex))
+            else:
+                filesizes.append(filesize_kb(outpath))
+                write_times.append(write_timer.elapsed())
+                read_times.append(read_timer.elapsed())
+
+            remove_if_exists(outpath)
+
+        yield DedupBenchmark(
+            Serializer=pretty_extension(serializer.extension),
+            FilesizeKb=format_result('{:.2f}', filesizes[0]),
+            DedupFilesizeKb=format_result('{:.2f}', filesizes[1]),
+            SavedKb=format_result('{:.2f}', *filesizes, combine=lambda plain, dedup: plain - dedup),
+            WriteTimeSeconds=format_result('{:.4f}', write_times[0]),
+            DedupWriteTimeSeconds=format_result('{:.4f}', write_times[1]),
+            ReadTimeSeconds=format_result('{:.4f}', read_times[0]),
+            DedupReadTimeSeconds=format_result('{:.4f}', read_times[1]),
+            SavedSeconds=format_result('{:.4f}', *write_times, *read_times,
+                                       combine=lambda write, dedup_write, read, dedup_read:
+                                       write + read - dedup_write - dedup_read),
+        )
+
+
+def run_routing_benchmarks(emails, results_dir):
+    makedirs(results_dir, exist_ok=True)
+
+    jobs = list(product(compressors(), serializers()))
+    num_jobs = len(jobs)
+    encryptor = NoEncryption()
+    router = AttachmentRouter()
+
+    for i, (compressor, serializer) in enumerate(jobs):
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        filesizes = []
+        cpu_times = []
+        for routed in (False, True):
+            outpath = join(results_dir, 'emails{}{}{}'.format(
+                serializer.extension, compressor.extension, router.extension if routed else ''))
+
+            try:
+                with Timer.timeit() as timer:
+                    with open(outpath, 'wb') as raw:
+                        if routed:
+                            router.write(iter(emails), serializer, compressor, raw)
+                        else:
+                            with compressor.compress(raw) as comp:
+                                serializer.serialize(iter(emails), comp)
+
+                    with open(outpath, 'rb') as raw:
+                        if routed:
+                            verify_emails(router.read(serializer, compressor, raw), emails)
+                        else:
+                            with compressor.decompress(raw) as decomp:
+                                verify_emails(serializer.deserialize(decomp), emails)
+            except Exception as ex:
+                print_error('routed' if routed else 'whole-stream', compressor, serializer, encryptor, ex)
+                filesizes.append(BenchmarkError(ex))
+                cpu_times.append(BenchmarkError(ex))
+            else:
+                filesizes.append(filesize_kb(outpath))
+                cpu_times.append(timer.cpu_elapsed())
+
+            remove_if_exists(outpath)
+
+        yield RoutingBenchmark(
+            Compressor=pretty_extension(compressor.extension),
+            Serializer=pretty_extension(serializer.extension),
+            FilesizeKb=format_result('{:.2f}', filesizes[0]),
+            RoutedFilesizeKb=format_result('{:.2f}', filesizes[1]),
+            SizeDifferenceKb=format_result('{:.2f}', *filesizes, combine=lambda whole, routed: routed - whole),
+            CpuSeconds=format_result('{:.4f}', cpu_times[0]),
+            RoutedCpuSeconds=format_result('{:.4f}', cpu_times[1]),
+            SavedCpuSeconds=format_result('{:.4f}', *cpu_times, combine=lambda whole, routed: whole - routed),
+        )
+
+
+def run_pipeline_benchmarks(emails, results_dir):
+    makedirs(results_dir, exist_ok=True)
+
+    jobs = list(product(compressors(), serializers(), encryptors()))
+    num_jobs = len(jobs)
+
+    for i, (compressor, serializer, encryptor) in enumerate(jobs):
+        outpath = join(results_dir, 'emails{}{}{}'.format(
+            serializer.extension, compressor.extension, encryptor.extension))
+
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        write_times = []
+        read_times = []
+        for pipelined in (False, True):
+            try:
+                with Timer.timeit() as write_timer:
+                    with open(outpath, 'wb') as raw:
+                        with writer_chain(raw, compressor, encryptor, pipelined) as comp:
+                            serializer.serialize(iter(emails), comp)
+
+                with Timer.timeit() as read_timer:
+                    with open(outpath, 'rb') as raw:
+                        with reader_chain(raw, compressor, encryptor, pipelined) as decomp:
+                            verify_emails(serializer.deserialize(decomp), emails)
+            except Exception as ex:
+                print_error('pipelined' if pipelined else 'synchronous', compressor, serializer, encryptor, ex)
+                write_times.append(BenchmarkError(ex))
+                read_times.append(BenchmarkError(ex))
+            else:
+                write_times.append(write_timer.elapsed())
+                read_times.append(read_timer.elapsed())
+
+            remove_if_exists(outpath)
+
+        yield PipelineBenchmark(
+            Compressor=pretty_extension(compressor.extension),
+            Serializer=pretty_extension(serializer.extension),
+            Encryptor=pretty_extension(encryptor.extension),
+            WriteTimeSeconds=format_result('{:.4f}', write_times[0]),
+            PipelinedWriteTimeSeconds=format_result('{:.4f}', write_times[1]),
+            WriteSpeedup=format_result('{:.2f}', *write_times, combine=lambda sync, pipelined: sync / pipelined),
+            WriteEmailsPerSecond=format_result('{:.1f}', write_times[1], combine=lambda t: len(emails) / t),
+            ReadTimeSeconds=format_result('{:.4f}', read_times[0]),
+            PipelinedReadTimeSeconds=format_result('{:.4f}', read_times[1]),
+            ReadSpeedup=format_result('{:.2f}', *read_times, combine=lambda sync, pipelined: sync / pipelined),
+            ReadEmailsPerSecond=format_result('{:.1f}', read_times[1], combine=lambda t: len(emails) / t),
+        )
+
+
+def run_coalescing_benchmarks(emails, results_dir, buffer_sizes=(0, 4096, 65536, 1048576)):
+    makedirs(results_dir, exist_ok=True)
+
+    jobs = list(product(compressors(), serializers()))
+    num_jobs = len(jobs)
+    encryptor = NoEncryption()
+
+    for i, (compressor, serializer) in enumerate(jobs):
+        outpath = join(results_dir, 'emails{}{}'.format(serializer.extension, compressor.extension))
+
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        write_times = []
+        for buffer_size in buffer_sizes:
+            try:
+                with Timer.timeit() as write_timer:
+                    with open(outpath, 'wb') as raw:
+                        with writer_chain(raw, compressor, encryptor, buffer_size=buffer_size) as comp:
                             serializer.serialize(iter(emails), comp)
+            except Exception as ex:
+                print_error('buffer size {}'.format(buffer_size), compressor, serializer, encryptor, ex)
+                write_times.append(BenchmarkError(ex))
+            else:
+                write_times.append(write_timer.elapsed())
+
+            remove_if_exists(outpath)
+
+        for buffer_size, write_time in zip(buffer_sizes, write_times):
+            yield CoalescingBenchmark(
+                Compressor=pretty_extension(compressor.extension),
+                Serializer=pretty_extension(serializer.extension),
+                BufferSize=str(buffer_size),
+                WriteTimeSeconds=format_result('{:.4f}', write_time),
+                WriteEmailsPerSecond=format_result('{:.1f}', write_time, combine=lambda t: len(emails) / t),
+                Speedup=format_result('{:.2f}', write_times[0], write_time,
+                                      combine=lambda unbuffered, buffered: unbuffered / buffered),
+            )
+
+
+def run_granularity_benchmarks(emails, results_dir, group_sizes=(1, 10, 100), num_random_reads=20):
+    makedirs(results_dir, exist_ok=True)
+
+    jobs = list(product(compressors(), serializers()))
+    num_jobs = len(jobs)
+    encryptor = NoEncryption()
+    containers = granularities(group_sizes)
+    random_indices = Random(0).sample(range(len(emails)), min(num_random_reads, len(emails)))
+
+    for i, (compressor, serializer) in enumerate(jobs):
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        results = []
+        for container in containers:
+            outpath = join(results_dir, 'emails{}{}{}'.format(
+                serializer.extension, compressor.extension, container.extension))
+
+            try:
+                with Timer.timeit() as write_timer:
+                    with open(outpath, 'wb') as raw:
+                        container.write(iter(emails), serializer, compressor, raw)
+
+                with Timer.timeit() as read_timer:
+                    with open(outpath, 'rb') as raw:
+                        verify_emails(container.read(serializer, compressor, raw), emails)
+
+                with Timer.timeit() as random_read_timer:
+                    for index in random_indices:
+                        with open(outpath, 'rb') as raw:
+                            actual = container.read_one(index, serializer, compressor, raw)
+                        verify_emails([actual], [emails[index]])
+            except Exception as ex:
+                print_error(container.extension.lstrip('.'), compressor, serializer, encryptor, ex)
+                results.append((container, BenchmarkError(ex), BenchmarkError(ex),
+                                BenchmarkError(ex), BenchmarkError(ex)))
+            else:
+                results.append((container, getsize(outpath), write_timer.elapsed(), read_timer.elapsed(),
+                                random_read_timer.elapsed() / max(len(random_indices), 1)))
+
+            remove_if_exists(outpath)
+
+        batch_size = results[-1][1]
+        for container, filesize, write_time, read_time, random_read_time in results:
+            yield GranularityBenchmark(
+                Compressor=pretty_extension(compressor.extension),
+                Serializer=pretty_extension(serializer.extension),
+                Granularity=pretty_extension(container.extension),
+                FilesizeKb=format_result('{:.2f}', filesize, combine=lambda size: size / 1024),
+                OverheadBytesPerEmail=format_result('{:.1f}', filesize, batch_size,
+                                                    combine=lambda size, batch: (size - batch) / len(emails)),
+                WriteTimeSeconds=format_result('{:.4f}', write_time),
+                ReadTimeSeconds=format_result('{:.4f}', read_time),
+                RandomReadMilliseconds=format_result('{:.2f}', random_read_time, combine=lambda t: t * 1000),
+            )
+
+
+def run_delta_benchmarks(emails, results_dir):
+    makedirs(results_dir, exist_ok=True)
+
+    batches = split_batches(emails)
+    jobs = list(product(delta_compressors(), serializers()))
+    num_jobs = len(jobs)
+    encryptor = NoEncryption()
+
+    for i, (compressor, serializer) in enumerate(jobs):
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        independent_size = 0
+        incremental_size = 0
+        compress_time = 0.0
+        decompress_time = 0.0
+        try:
+            reference = b''
+            for j, batch in enumerate(batches):
+                data = serialize_batch(batch, serializer)
+
+                if j > 0:
+                    independent_size += len(compressor.compress(data))
+
+                with Timer.timeit() as compress_timer:
+                    delta = compressor.compress(data, reference)
+
+                with Timer.timeit() as decompress_timer:
+                    restored = compressor.decompress(delta, reference)
+
+                if restored != data:
+                    raise ValueError('batch {} did not roundtrip'.format(j))
+
+                if j > 0:
+                    incremental_size += len(delta)
+                    compress_time += compress_timer.elapsed()
+                    decompress_time += decompress_timer.elapsed()
+
+                reference = data
+        except Exception as ex:
+            print_error('delta', compressor, serializer, encryptor, ex)
+            independent_size = incremental_size = BenchmarkError(ex)
+            compress_time = decompress_time = BenchmarkError(ex)
+
+        yield DeltaBenchmark(
+            Compressor=pretty_extension(compressor.extension),
+            Serializer=pretty_extension(serializer.extension),
+            NumBatches=len(batches),
+            IndependentKb=format_result('{:.2f}', independent_size, combine=lambda size: size / 1024),
+            IncrementalKb=format_result('{:.2f}', incremental_size, combine=lambda size: size / 1024),
+            SavedPercent=format_result('{:.1f}', independent_size, incremental_size,
+                                       combine=lambda independent, incremental:
+                                       100 * (independent - incremental) / max(independent, 1)),
+            CompressTimeSeconds=format_result('{:.4f}', compress_time),
+            DecompressTimeSeconds=format_result('{:.4f}', decompress_time),
+        )
+
+
+def run_constrained_benchmarks(emails, results_dir, memory_limit_mb=512, bytes_per_second=None):
+    makedirs(results_dir, exist_ok=True)
+
+    jobs = list(product(compressors(), serializers(), encryptors()))
+    num_jobs = len(jobs)
+    expected_digests = [email_digest(email) for email in emails]
+    constraints = (
+        {},
+        {'cpu_affinity': first_cpu(), 'memory_limit_mb': memory_limit_mb},
+    )
+
+    for i, (compressor, serializer, encryptor) in enumerate(jobs):
+        outpath = join(results_dir, 'emails{}{}{}'.format(
+            serializer.extension, compressor.extension, encryptor.extension))
+
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        read_times = []
+        peak_memories = []
+        try:
+            with open(outpath, 'wb') as raw:
+                with writer_chain(raw, compressor, encryptor) as comp:
+                    serializer.serialize(iter(emails), comp)
+        except Exception as ex:
+            print_error('write', compressor, serializer, encryptor, ex)
+            read_times = [BenchmarkError(ex)] * len(constraints)
+            peak_memories = [BenchmarkError(ex)] * len(constraints)
+        else:
+            for constrained, limits in enumerate(constraints):
+                try:
+                    read_time, peak_memory = run_isolated(
+                        read_digests, outpath, compressor, serializer, encryptor, expected_digests,
+                        bytes_per_second if constrained else None, **limits)
+                except Exception as ex:
+                    print_error('constrained read' if constrained else 'read', compressor, serializer, encryptor, ex)
+                    read_times.append(BenchmarkError(ex))
+                    peak_memories.append(BenchmarkError(ex))
+                else:
+                    read_times.append(read_time)
+                    peak_memories.append(peak_memory)
+
+        yield ConstrainedBenchmark(
+            Compressor=pretty_extension(compressor.extension),
+            Serializer=pretty_extension(serializer.extension),
+            Encryptor=pretty_extension(encryptor.extension),
+            ReadTimeSeconds=format_result('{:.4f}', read_times[0]),
+            ConstrainedReadTimeSeconds=format_result('{:.4f}', read_times[1]),
+            Slowdown=format_result('{:.2f}', *read_times, combine=lambda free, constrained: constrained / free),
+            PeakMemoryMb=format_result('{:.1f}', peak_memories[0]),
+            ConstrainedPeakMemoryMb=format_result('{:.1f}', peak_memories[1]),
+        )
+
+        remove_if_exists(outpath)
+
+
+def run_projection_benchmarks(emails, results_dir, fields=HEADER_FIELDS):
+    makedirs(results_dir, exist_ok=True)
+
+    jobs = list(serializers())
+    num_jobs = len(jobs)
+    compressor = NoCompression()
+    encryptor = NoEncryption()
+    expected_headers = [{key: value for (key, value) in email.items() if key in fields} for email in emails]
+
+    for i, serializer in enumerate(jobs):
+        outpath = join(results_dir, 'emails{}'.format(serializer.extension))
+
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        read_times = []
+        try:
+            with open(outpath, 'wb') as raw:
+                serializer.serialize(iter(emails), raw)
         except Exception as ex:
             print_error('write', compressor, serializer, encryptor, ex)
-            write_time = BenchmarkError(ex)
             filesize = BenchmarkError(ex)
+            read_times = [filesize, filesize]
         else:
-            write_time = write_timer.seconds()
-            filesize = '{:.2f}'.format(filesize_kb(outpath))
+            filesize = filesize_kb(outpath)
+            for projected in (None, fields):
+                try:
+                    with Timer.timeit() as read_timer:
+                        with open(outpath, 'rb') as raw:
+                            actuals = list(serializer.deserialize(raw, fields=projected))
+                    verify_emails(actuals, emails if projected is None else expected_headers)
+                except Exception as ex:
+                    print_error('projected read' if projected else 'read', compressor, serializer, encryptor, ex)
+                    read_times.append(BenchmarkError(ex))
+                else:
+                    read_times.append(read_timer.elapsed())
 
+        yield ProjectionBenchmark(
+            Serializer=pretty_extension(serializer.extension),
+            FilesizeKb=format_result('{:.2f}', filesize),
+            ReadTimeSeconds=format_result('{:.4f}', read_times[0]),
+            HeaderReadTimeSeconds=format_result('{:.4f}', read_times[1]),
+            Speedup=format_result('{:.2f}', *read_times, combine=lambda full, headers: full / headers),
+        )
+
+        remove_if_exists(outpath)
+
+
+def run_estimate_benchmarks(emails, results_dir, estimator=None, validate_all=False, jobs=None):
+    estimator = estimator or SizeEstimator()
+    jobs = list(jobs) if jobs is not None else grid_jobs()
+    num_jobs = len(jobs)
+
+    estimates = {}
+    for i, job in enumerate(jobs):
+        compressor, serializer, encryptor, preprocessor = job
+        print_progress(compressor, serializer, encryptor, i, num_jobs, preprocessor)
         try:
-            with Timer.timeit() as read_timer:
-                with open(outpath, 'rb') as raw:
-                    with encryptor.deserialize(raw) as denc:
-                        with compressor.decompress(denc) as decomp:
-                            actuals = serializer.deserialize(decomp)
-                            for i, (actual, expected) in enumerate(zip(actuals, emails)):
-                                for key in actual.keys() | expected.keys():
-                                    actual_value = actual.get(key)
-                                    expected_value = expected.get(key)
-                                    assert \
-                                        (actual_value == expected_value) or \
-                                        (not actual_value and not expected_value), \
-                                        'i={},key={},actual={},expected={}'.format(
-                                            i, key, actual_value, expected_value)
+            estimates[job] = estimator.estimate(emails, compressor, serializer, encryptor, preprocessor)
         except Exception as ex:
-            print_error('read', compressor, serializer, encryptor, ex)
-            read_time = BenchmarkError(ex)
+            print_error('estimate', compressor, serializer, encryptor, ex, preprocessor)
+            estimates[job] = BenchmarkError(ex)
+
+    promising = prune({job: estimate for (job, estimate) in estimates.items()
+                       if not isinstance(estimate, BenchmarkError)})
+    validated = [job for job in jobs if validate_all or job in promising]
+    actuals = dict(zip(validated, run_benchmarks(emails, results_dir, incremental=False, jobs=validated)))
+
+    for job in jobs:
+        compressor, serializer, encryptor, preprocessor = job
+        estimate = estimates[job]
+        actual = actuals.get(job)
+
+        if isinstance(estimate, BenchmarkError):
+            size = size_interval = write_time = estimate
         else:
-            read_time = read_timer.seconds()
+            size = estimate.size / 1024
+            size_interval = '{:.2f}-{:.2f}'.format(estimate.size_low / 1024, estimate.size_high / 1024)
+            write_time = estimate.seconds
 
-        yield Benchmark(
+        if actual is None:
+            actual_size = actual_write_time = ''
+            error = ''
+        else:
+            actual_size = parse_result(actual.FilesizeKb)
+            actual_write_time = parse_result(actual.WriteTimeSeconds)
+            if actual_size == 0 and not isinstance(size, BenchmarkError):
+                error = 'n/a'
+            else:
+                error = format_result('{:.1f}', size, actual_size,
+                                      combine=lambda estimated, real: 100 * (estimated - real) / real)
+
+        yield EstimateBenchmark(
             Compressor=pretty_extension(compressor.extension),
             Serializer=pretty_extension(serializer.extension),
             Encryptor=pretty_extension(encryptor.extension),
-            FilesizeKb=filesize,
-            WriteTimeSeconds=write_time,
-            ReadTimeSeconds=read_time,
+            Preprocessor=pretty_extension(preprocessor.extension),
+            EstimatedFilesizeKb=format_result('{:.2f}', size),
+            FilesizeKbInterval=size_interval,
+            FilesizeKb=format_result('{:.2f}', actual_size) if actual_size != '' else '',
+            FilesizeErrorPercent=error,
+            EstimatedWriteTimeSeconds=format_result('{:.4f}', write_time),
+            WriteTimeSeconds=format_result('{:.4f}', actual_write_time) if actual_write_time != '' else '',
+            Status='promising' if job in promising else 'pruned',
         )
 
-        if not incremental:
-            remove_if_exists(outpath)
 
+def run_sharding_benchmarks(emails, results_dir, shard_counts=(2, 4, 16), max_shard_kbs=(), workers=None):
+    makedirs(results_dir, exist_ok=True)
 
-def display_benchmarks(results, display_format, buffer=stdout):
+    jobs = list(product(compressors(), serializers(), encryptors()))
+    num_jobs = len(jobs)
+    preprocessor = NoPreprocessing()
+    containers = shardings(shard_counts, max_shard_kbs, workers)
+
+    for i, (compressor, serializer, encryptor) in enumerate(jobs):
+        print_progress(compressor, serializer, encryptor, i, num_jobs)
+
+        outpath = join(results_dir, 'emails{}{}{}'.format(
+            serializer.extension, compressor.extension, encryptor.extension))
+        write_time, read_time, _ = write_read(emails, outpath, compressor, serializer, encryptor, preprocessor)
+        if isinstance(write_time, Exception) or isinstance(read_time, Exception):
+            print_error('monolithic', compressor, serializer, encryptor, read_time)
+            write_time = read_time = batch_size = BenchmarkError(read_time)
+        else:
+            batch_size = getsize(outpath)
+        remove_if_exists(outpath)
+
+        for container in containers:
+            outdir = outpath + container.extension
+            try:
+                with Timer.timeit() as sharded_write_timer:
+                    manifest = container.write(emails, outdir, compressor, serializer, encryptor, preprocessor)
+
+                with Timer.timeit() as sharded_read_timer:
+                    verify_emails(container.read(outdir, compressor, serializer, encryptor, preprocessor), emails)
+
+                shards = manifest['shards']
+                with Timer.timeit() as fetch_timer:
+                    offset = 0
+                    for index, shard in enumerate(shards):
+                        actuals = container.read_one(index, outdir, compressor, serializer, encryptor, preprocessor)
+                        verify_emails(actuals, emails[offset:offset + shard['emails']])
+                        offset += shard['emails']
+            except Exception as ex:
+                print_error(container.extension.lstrip('.'), compressor, serializer, encryptor, ex)
+                num_shards = filesize = sharded_write_time = sharded_read_time = shard_size = fetch_time = \
+                    BenchmarkError(ex)
+            else:
+                num_shards = len(shards)
+                filesize = sum(shard['bytes'] for shard in shards) + getsize(join(outdir, MANIFEST_NAME))
+                sharded_write_time = sharded_write_timer.elapsed()
+                sharded_read_time = sharded_read_timer.elapsed()
+                shard_size = filesize / num_shards
+                fetch_time = fetch_timer.elapsed() / num_shards
+
+            rmtree(outdir, ignore_errors=True)
+
+            yield ShardingBenchmark(
+                Compressor=pretty_extension(compressor.extension),
+                Serializer=pretty_extension(serializer.extension),
+                Encryptor=pretty_extension(encryptor.extension),
+                Sharding=pretty_extension(container.extension),
+                NumShards=format_result('{}', num_shards),
+                FilesizeKb=format_result('{:.2f}', filesize, combine=lambda size: size / 1024),
+                OverheadPercent=format_result('{:.1f}', filesize, batch_size,
+                                              combine=lambda size, batch: 100 * (size - batch) / batch),
+                WriteSpeedup=format_result('{:.2f}', write_time, sharded_write_time, combine=truediv),
+                ReadSpeedup=format_result('{:.2f}', read_time, sharded_read_time, combine=truediv),
+                ShardKb=format_result('{:.2f}', shard_size, combine=lambda size: size / 1024),
+                ShardFetchMilliseconds=format_result('{:.2f}', fetch_time, combine=lambda t: t * 1000),
+            )
+
+
+def parse_result(value):
+    if isinstance(value, BenchmarkError):
+        return value
+    return float(value)
+
+
+def display_benchmarks(results, display_format, buffer=stdout, fields=Benchmark._fields):
     if display_format == 'csv':
-        writer = DictWriter(buffer, Benchmark._fields, dialect=excel_tab)
+        writer = DictWriter(buffer, fields, dialect=excel_tab)
         writer.writeheader()
         for result in results:
             writer.writerow(result._asdict())
@@ -159,7 +937,7 @@ def display_benchmarks(results, display_format, buffer=stdout):
         buffer.write('  <table id="benchmarks" class="pure-table pure-table-horizontal pure-table-striped">\n')  # noqa: E501
         buffer.write('   <thead>\n')
         buffer.write('    <tr>\n')
-        for field in Benchmark._fields:
+        for field in fields:
             buffer.write('     <th>{}</th>\n'.format(field))
         buffer.write('    </tr>\n')
         buffer.write('   </thead>\n')
@@ -196,16 +974,79 @@ def cli():
     parser.add_argument('--results_dir', default='results')
     parser.add_argument('--inputs_dir', default='sample-emails')
     parser.add_argument('--exclude_attachments', action='store_true')
+    parser.add_argument('--compact_corpus', action='store_true')
     parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--serializer_variants', action='store_true')
+    parser.add_argument('--compressor_variants', action='store_true')
+    parser.add_argument('--encryptor_variants', action='store_true')
+    parser.add_argument('--preprocessing', action='store_true')
     parser.add_argument('--display_format', default='csv')
+    parser.add_argument('--benchmark', default='grid', choices=(
+        'grid', 'partial-read', 'dedup', 'routing', 'pipeline', 'granularity', 'delta', 'constrained',
+        'projection', 'estimate', 'coalescing', 'sharding'))
+    parser.add_argument('--pipelined', action='store_true')
+    parser.add_argument('--group_sizes', default='1,10,100')
+    parser.add_argument('--buffer_sizes', default='0,4096,65536,1048576')
+    parser.add_argument('--shard_counts', default='2,4,16')
+    parser.add_argument('--max_shard_kbs', default='')
+    parser.add_argument('--shard_workers', type=int)
+    parser.add_argument('--isolated', action='store_true')
+    parser.add_argument('--timeout', type=float)
+    parser.add_argument('--memory_limit_mb', type=int)
+    parser.add_argument('--read_bytes_per_second', type=int, default=0)
+    parser.add_argument('--validate_all', action='store_true')
     args = parser.parse_args()
 
     emails = load_samples(args.emails_zip_url, args.inputs_dir,
-                          args.exclude_attachments)
+                          args.exclude_attachments, args.compact_corpus)
+    jobs = grid_jobs(args.serializer_variants, args.preprocessing, args.compressor_variants, args.encryptor_variants)
 
-    results = run_benchmarks(emails, args.results_dir, args.incremental)
+    if args.benchmark == 'partial-read':
+        results = run_partial_read_benchmarks(emails, args.results_dir)
+        fields = PartialReadBenchmark._fields
+    elif args.benchmark == 'dedup':
+        results = run_dedup_benchmarks(emails, args.results_dir)
+        fields = DedupBenchmark._fields
+    elif args.benchmark == 'routing':
+        results = run_routing_benchmarks(emails, args.results_dir)
+        fields = RoutingBenchmark._fields
+    elif args.benchmark == 'pipeline':
+        results = run_pipeline_benchmarks(emails, args.results_dir)
+        fields = PipelineBenchmark._fields
+    elif args.benchmark == 'coalescing':
+        buffer_sizes = [int(buffer_size) for buffer_size in args.buffer_sizes.split(',')]
+        results = run_coalescing_benchmarks(emails, args.results_dir, buffer_sizes)
+        fields = CoalescingBenchmark._fields
+    elif args.benchmark == 'constrained':
+        results = run_constrained_benchmarks(emails, args.results_dir, args.memory_limit_mb or 512,
+                                             args.read_bytes_per_second)
+        fields = ConstrainedBenchmark._fields
+    elif args.benchmark == 'estimate':
+        results = run_estimate_benchmarks(emails, args.results_dir, validate_all=args.validate_all,
+                                          jobs=jobs)
+        fields = EstimateBenchmark._fields
+    elif args.benchmark == 'projection':
+        results = run_projection_benchmarks(emails, args.results_dir)
+        fields = ProjectionBenchmark._fields
+    elif args.benchmark == 'delta':
+        results = run_delta_benchmarks(emails, args.results_dir)
+        fields = DeltaBenchmark._fields
+    elif args.benchmark == 'sharding':
+        shard_counts = [int(shard_count) for shard_count in args.shard_counts.split(',') if shard_count]
+        max_shard_kbs = [int(max_shard_kb) for max_shard_kb in args.max_shard_kbs.split(',') if max_shard_kb]
+        results = run_sharding_benchmarks(emails, args.results_dir, shard_counts, max_shard_kbs, args.shard_workers)
+        fields = ShardingBenchmark._fields
+    elif args.benchmark == 'granularity':
+        group_sizes = [int(group_size) for group_size in args.group_sizes.split(',')]
+        results = run_granularity_benchmarks(emails, args.results_dir, group_sizes)
+        fields = GranularityBenchmark._fields
+    else:
+        results = run_benchmarks(emails, args.results_dir, args.incremental, args.pipelined,
+                                 args.isolated, args.timeout, args.memory_limit_mb,
+                                 jobs)
+        fields = Benchmark._fields
 
-    display_benchmarks(results, args.display_format)
+    display_benchmarks(results, args.display_format, fields=fields)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,225 @@
+from collections import namedtuple
+from itertools import product
+from json import dumps
+from math import ceil
+from random import Random
+from sys import stderr
+from time import monotonic
+from typing import Iterable
+from typing import List
+
+from benchmarks.__main__ import BenchmarkError
+from benchmarks.__main__ import display_benchmarks
+from benchmarks.__main__ import format_result
+from benchmarks.__main__ import format_stages
+from benchmarks.__main__ import load_samples
+from benchmarks.__main__ import parse_result
+from benchmarks.__main__ import run_benchmarks
+from benchmarks.compression import GzipCompression
+from benchmarks.compression import ZstandardCompression
+from benchmarks.compression import get_all as compressors
+from benchmarks.encryption import NoEncryption
+from benchmarks.encryption import get_all as encryptors
+from benchmarks.preprocessing import get_all as preprocessors
+from benchmarks.serialization import get_all as serializers
+from benchmarks.utils import pretty_extension
+
+Trial = namedtuple('Trial', (
+    'Round',
+    'NumEmails',
+    'Compressor',
+    'Serializer',
+    'Encryptor',
+    'Preprocessor',
+    'FilesizeKb',
+    'WriteTimeSeconds',
+    'ReadTimeSeconds',
+    'TransferTimeSeconds',
+    'CostSeconds',
+    'Status',
+))
+
+
+def search_space(require_encryption=False):
+    tuned_compressors = compressors(variants=True) + (
+        GzipCompression(level=1),
+        GzipCompression(level=6),
+        ZstandardCompression(level=1),
+        ZstandardCompression(level=9),
+        ZstandardCompression(level=19),
+    )
+    tuned_encryptors = [encryptor for encryptor in encryptors(variants=True)
+                        if not (require_encryption and isinstance(encryptor, NoEncryption))]
+    return list(product(tuned_compressors, serializers(variants=True), tuned_encryptors, preprocessors()))
+
+
+def halving_schedule(num_candidates: int, num_emails: int, eta: int = 3, min_emails: int = 10) -> List[tuple]:
+    candidates = [num_candidates]
+    while candidates[-1] > eta:
+        candidates.append(ceil(candidates[-1] / eta))
+
+    num_rounds = len(candidates)
+    return [(min(max(ceil(num_emails / eta ** (num_rounds - 1 - i)), min_emails), num_emails), count)
+            for (i, count) in enumerate(candidates)]
+
+
+def transfer_seconds(filesize_kb: float, bandwidth_kbps: float) -> float:
+    return filesize_kb * 1024 * 8 / (bandwidth_kbps * 1000)
+
+
+def successive_halving(emails: List[dict], jobs: Iterable[tuple], results_dir: str, bandwidth_kbps: float,
+                       budget_seconds: float = 600, eta: int = 3, min_emails: int = 10,
+                       seed: int = 0) -> Iterable[Trial]:
+    rng = Random(seed)
+    emails = list(emails)
+    rng.shuffle(emails)
+    candidates = list(jobs)
+    rng.shuffle(candidates)
+
+    started = monotonic()
+    round_number = num_emails = 0
+
+    while candidates:
+        round_number += 1
+        schedule = halving_schedule(len(candidates), len(emails), eta, min_emails)
+        num_emails = max(schedule[0][0], num_emails)
+        subset = emails[:num_emails]
+
+        now = monotonic()
+        work = [size * count for (size, count) in schedule]
+        deadline = now + (started + budget_seconds - now) * work[0] / sum(work)
+        print('Round {}: {} candidates on {} emails'.format(round_number, len(candidates), num_emails), file=stderr)
+
+        evaluated = []
+        skipped = []
+        for index, job in enumerate(candidates):
+            if evaluated and monotonic() > deadline:
+                skipped = candidates[index:]
+                print('Round budget exhausted after {}/{} candidates, skipping: {}'.format(
+                    len(evaluated), len(candidates), ', '.join(format_stages(*candidate) for candidate in skipped)),
+                    file=stderr)
+                break
+            for result in run_benchmarks(subset, results_dir, incremental=False, jobs=[job]):
+                evaluated.append((job, result, _cost(result, bandwidth_kbps)))
+
+        evaluated.sort(key=_sort_key)
+        is_last_round = len(schedule) == 1
+        num_promoted = ceil(len(evaluated) / eta)
+
+        for rank, (job, result, cost) in enumerate(evaluated):
+            if isinstance(cost, BenchmarkError):
+                status = 'error'
+            elif is_last_round:
+                status = 'winner' if rank == 0 else 'eliminated'
+            else:
+                status = 'promoted' if rank < num_promoted else 'eliminated'
+
+            yield Trial(
+                Round=str(round_number),
+                NumEmails=str(num_emails),
+                Compressor=result.Compressor,
+                Serializer=result.Serializer,
+                Encryptor=result.Encryptor,
+                Preprocessor=result.Preprocessor,
+                FilesizeKb=result.FilesizeKb,
+                WriteTimeSeconds=result.WriteTimeSeconds,
+                ReadTimeSeconds=result.ReadTimeSeconds,
+                TransferTimeSeconds=format_result(
+                    '{:.4f}', parse_result(result.FilesizeKb),
+                    combine=lambda filesize: transfer_seconds(filesize, bandwidth_kbps)),
+                CostSeconds=format_result('{:.4f}', cost),
+                Status=status,
+            )
+
+        for compressor, serializer, encryptor, preprocessor in skipped:
+            yield Trial(
+                Round=str(round_number),
+                NumEmails=str(num_emails),
+                Compressor=pretty_extension(compressor.extension),
+                Serializer=pretty_extension(serializer.extension),
+                Encryptor=pretty_extension(encryptor.extension),
+                Preprocessor=pretty_extension(preprocessor.extension),
+                FilesizeKb='',
+                WriteTimeSeconds='',
+                ReadTimeSeconds='',
+                TransferTimeSeconds='',
+                CostSeconds='',
+                Status='skipped',
+            )
+
+        candidates = [job for (job, _, cost) in evaluated[:num_promoted]
+                      if not isinstance(cost, BenchmarkError)]
+        if is_last_round:
+            break
+
+
+def describe_winner(trials: Iterable[Trial], bandwidth_kbps: float) -> dict:
+    for trial in trials:
+        if trial.Status == 'winner':
+            return {
+                'compressor': trial.Compressor,
+                'serializer': trial.Serializer,
+                'encryptor': trial.Encryptor,
+                'preprocessor': trial.Preprocessor,
+                'bandwidth_kbps': bandwidth_kbps,
+                'num_emails': int(trial.NumEmails),
+                'filesize_kb': float(trial.FilesizeKb),
+                'write_time_seconds': float(trial.WriteTimeSeconds),
+                'read_time_seconds': float(trial.ReadTimeSeconds),
+                'transfer_time_seconds': float(trial.TransferTimeSeconds),
+                'cost_seconds': float(trial.CostSeconds),
+            }
+    return {}
+
+
+def _cost(result, bandwidth_kbps):
+    values = [parse_result(value) for value in (result.FilesizeKb, result.WriteTimeSeconds, result.ReadTimeSeconds)]
+    for value in values:
+        if isinstance(value, BenchmarkError):
+            return value
+
+    filesize, write_time, read_time = values
+    return write_time + read_time + transfer_seconds(filesize, bandwidth_kbps)
+
+
+def _sort_key(evaluation):
+    cost = evaluation[2]
+    return float('inf') if isinstance(cost, BenchmarkError) else cost
+
+
+def cli():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Search for the fastest end-to-end pipeline for a corpus and link.')
+    parser.add_argument('emails_zip_url')
+    parser.add_argument('--results_dir', default='results')
+    parser.add_argument('--inputs_dir', default='sample-emails')
+    parser.add_argument('--exclude_attachments', action='store_true')
+    parser.add_argument('--bandwidth_kbps', type=float, default=64)
+    parser.add_argument('--budget_seconds', type=float, default=600)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--min_emails', type=int, default=10)
+    parser.add_argument('--require_encryption', action='store_true')
+    parser.add_argument('--log', default='autotune.tsv')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    emails = load_samples(args.emails_zip_url, args.inputs_dir,
+                          args.exclude_attachments)
+
+    jobs = search_space(args.require_encryption)
+    trials = list(successive_halving(emails, jobs, args.results_dir, args.bandwidth_kbps,
+                                     args.budget_seconds, args.eta, args.min_emails, args.seed))
+
+    with open(args.log, 'w') as fobj:
+        display_benchmarks(trials, 'csv', buffer=fobj, fields=Trial._fields)
+
+    winner = describe_winner(trials, args.bandwidth_kbps)
+    if winner:
+        print('Best pipeline: {}'.format('+'.join(
+            winner[stage] for stage in ('compressor', 'serializer', 'encryptor', 'preprocessor'))), file=stderr)
+    print(dumps(winner, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    cli()
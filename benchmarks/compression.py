@@ -1,16 +1,39 @@
 from abc import ABC
+from bz2 import BZ2File
+from bz2 import compress as bz2_compress
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from gzip import FEXTRA
 from gzip import GzipFile
+from io import BufferedReader
+from io import RawIOBase
+from lzma import FORMAT_XZ
+from lzma import LZMAFile
+from lzma import compress as lzma_compress
+from os import cpu_count
 from os import remove
+from struct import calcsize
+from struct import pack
+from struct import unpack
 from tarfile import open as tarfile_open
 from tempfile import NamedTemporaryFile
 from typing import IO
+from typing import Callable
 from typing import Iterable
+from zlib import DEFLATED
+from zlib import MAX_WBITS
+from zlib import compressobj as zlib_compressobj
+from zlib import crc32
+from zlib import decompress as zlib_decompress
 
 from zstandard import MAX_COMPRESSION_LEVEL
 from zstandard import ZstdCompressor
 from zstandard import ZstdDecompressor
 
+from benchmarks.utils import ChunkReader
+
 
 class _Compression(ABC):
     @property
@@ -37,11 +60,18 @@ class NoCompression(_Compression):
 
 
 class GzipCompression(_Compression):
-    extension = '.gz'
+    def __init__(self, level: int = 9):
+        self.level = level
+
+    @property
+    def extension(self) -> str:
+        if self.level == 9:
+            return '.gz'
+        return '.{}.gz'.format(self.level)
 
     @contextmanager
     def compress(self, fobj: IO[bytes]) -> IO[bytes]:
-        with GzipFile(fileobj=fobj, mode='w') as compressed:
+        with GzipFile(fileobj=fobj, mode='w', compresslevel=self.level) as compressed:
             yield compressed
 
     @contextmanager
@@ -51,16 +81,19 @@ class GzipCompression(_Compression):
 
 
 class ZstandardCompression(_Compression):
-    def __init__(self, level: int = 3):
+    def __init__(self, level: int = 3, threads: int = 0):
         self.level = level
+        self.threads = threads
 
     @property
     def extension(self) -> str:
+        if self.threads:
+            return '.{}.mt.zs'.format(self.level)
         return '.{}.zs'.format(self.level)
 
     @contextmanager
     def compress(self, fobj: IO[bytes]) -> IO[bytes]:
-        compressor = ZstdCompressor(level=self.level)
+        compressor = ZstdCompressor(level=self.level, threads=self.threads)
         with compressor.stream_writer(fobj) as writer:
             yield writer
 
@@ -132,8 +165,142 @@ class XzTarballCompression(_TarballCompression):
         return 'xz'
 
 
-def get_all() -> Iterable[_Compression]:
-    return (
+class _BlockParallelWriter(RawIOBase):
+    def __init__(self, fobj: IO[bytes], compress_block: Callable[[bytes], bytes],
+                 block_size: int, workers: int):
+        self._fobj = fobj
+        self._compress_block = compress_block
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = deque()
+        self._max_pending = 2 * workers
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        if len(self._pending) >= self._max_pending:
+            self._fobj.write(self._pending.popleft().result())
+        self._pending.append(self._executor.submit(self._compress_block, block))
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                    self._buffer = bytearray()
+                while self._pending:
+                    self._fobj.write(self._pending.popleft().result())
+            finally:
+                self._executor.shutdown()
+        super().close()
+
+
+class _BlockParallelCompression(_Compression):
+    def __init__(self, workers: int = None, block_size: int = 1024 * 1024):
+        self.workers = workers or cpu_count() or 1
+        self.block_size = block_size
+
+    def compress_block(self, block: bytes) -> bytes:
+        raise NotImplementedError
+
+    @contextmanager
+    def compress(self, fobj: IO[bytes]) -> IO[bytes]:
+        writer = _BlockParallelWriter(fobj, self.compress_block, self.block_size, self.workers)
+        try:
+            yield writer
+        finally:
+            writer.close()
+
+
+class ParallelGzipCompression(_BlockParallelCompression):
+    extension = '.parallel.gz'
+    subfield_id = b'LK'
+    header_format = '<BBBBIBBHBBHI'
+    trailer_format = '<II'
+
+    def __init__(self, workers: int = None, block_size: int = 1024 * 1024, level: int = 9):
+        super().__init__(workers, block_size)
+        self.level = level
+
+    def compress_block(self, block: bytes) -> bytes:
+        compressor = zlib_compressobj(self.level, DEFLATED, -MAX_WBITS)
+        deflated = compressor.compress(block) + compressor.flush()
+        member_size = calcsize(self.header_format) + len(deflated) + calcsize(self.trailer_format)
+        header = pack(self.header_format,
+                      0x1f, 0x8b, DEFLATED, FEXTRA, 0, 0, 255,
+                      8, self.subfield_id[0], self.subfield_id[1], 4, member_size)
+        trailer = pack(self.trailer_format, crc32(block), len(block) & 0xffffffff)
+        return header + deflated + trailer
+
+    @contextmanager
+    def decompress(self, fobj: IO[bytes]) -> IO[bytes]:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            members = self._read_members(fobj)
+            blocks = _ordered_map(executor, self._decompress_member, members, 2 * self.workers)
+            yield BufferedReader(ChunkReader(blocks))
+
+    @classmethod
+    def _decompress_member(cls, member: bytes) -> bytes:
+        return zlib_decompress(member, 16 + MAX_WBITS)
+
+    def _read_members(self, fobj: IO[bytes]) -> Iterable[bytes]:
+        header_size = calcsize(self.header_format)
+        while True:
+            header = fobj.read(header_size)
+            if not header:
+                break
+            fields = unpack(self.header_format, header)
+            if fields[:2] != (0x1f, 0x8b) or bytes(fields[8:10]) != self.subfield_id:
+                raise ValueError('Not a block-indexed gzip member')
+            member_size = fields[-1]
+            yield header + fobj.read(member_size - header_size)
+
+
+class ParallelXzCompression(_BlockParallelCompression):
+    extension = '.parallel.xz'
+
+    def compress_block(self, block: bytes) -> bytes:
+        return lzma_compress(block, format=FORMAT_XZ)
+
+    @contextmanager
+    def decompress(self, fobj: IO[bytes]) -> IO[bytes]:
+        with LZMAFile(fobj, mode='r') as decompressed:
+            yield decompressed
+
+
+class ParallelBz2Compression(_BlockParallelCompression):
+    extension = '.parallel.bz2'
+
+    def compress_block(self, block: bytes) -> bytes:
+        return bz2_compress(block)
+
+    @contextmanager
+    def decompress(self, fobj: IO[bytes]) -> IO[bytes]:
+        with BZ2File(fobj, mode='r') as decompressed:
+            yield decompressed
+
+
+def _ordered_map(executor: Executor, func: Callable, items: Iterable, max_pending: int) -> Iterable:
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def get_all(variants: bool = False) -> Iterable[_Compression]:
+    compressors = (
         NoCompression(),
         GzipCompression(),
         ZstandardCompression(),
@@ -141,3 +308,12 @@ def get_all() -> Iterable[_Compression]:
         Bz2TarballCompression(),
         XzTarballCompression(),
     )
+    if not variants:
+        return compressors
+
+    return compressors + (
+        ZstandardCompression(level=MAX_COMPRESSION_LEVEL, threads=cpu_count() or 1),
+        ParallelGzipCompression(),
+        ParallelBz2Compression(),
+        ParallelXzCompression(),
+    )
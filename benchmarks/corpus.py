@@ -0,0 +1,134 @@
+from base64 import b64decode
+from base64 import b64encode
+from binascii import Error as Base64Error
+from collections.abc import Sequence
+from sys import intern
+from typing import Iterable
+from typing import List
+
+EMAIL_FIELDS = ('to', 'cc', 'bcc', 'from', 'subject', 'body', 'sent_at', '_uid', 'read', 'attachments')
+ADDRESS_FIELDS = frozenset(('to', 'cc', 'bcc', 'from'))
+ATTACHMENT_FIELDS = ('filename', 'content', 'cid', 'mimetype')
+
+
+class _Missing:
+    # records are pickled for spawned workers, so the sentinel must unpickle to the same object
+    def __reduce__(self):
+        return '_MISSING'
+
+
+_MISSING = _Missing()
+
+
+class AttachmentRecord:
+    __slots__ = ('filename', 'cid', 'mimetype', 'offset', 'size', 'content', 'extra')
+
+    def __init__(self, attachment: dict, arena: bytearray):
+        attachment = dict(attachment)
+        self.filename = _intern(attachment.pop('filename', _MISSING))
+        self.cid = _intern(attachment.pop('cid', _MISSING))
+        self.mimetype = _intern(attachment.pop('mimetype', _MISSING))
+        self.offset = self.size = 0
+        self.content = attachment.pop('content', _MISSING)
+        self.extra = attachment or None
+
+        content = _decode_content(self.content)
+        if content is not None:
+            self.offset = len(arena)
+            self.size = len(content)
+            self.content = None
+            arena += content
+
+    def as_dict(self, arena: bytearray) -> dict:
+        attachment = {}
+        for field in ATTACHMENT_FIELDS:
+            if field == 'content':
+                value = self.content
+                if value is None:
+                    value = b64encode(memoryview(arena)[self.offset:self.offset + self.size]).decode('ascii')
+            else:
+                value = getattr(self, field)
+            if value is not _MISSING:
+                attachment[field] = value
+        if self.extra:
+            attachment.update(self.extra)
+        return attachment
+
+
+class EmailRecord:
+    __slots__ = ('to', 'cc', 'bcc', 'sender', 'subject', 'body', 'sent_at', 'uid', 'read', 'attachments', 'extra')
+
+    _slots = dict(zip(EMAIL_FIELDS, ('to', 'cc', 'bcc', 'sender', 'subject', 'body', 'sent_at', 'uid', 'read',
+                                     'attachments')))
+
+    def __init__(self, email: dict, arena: bytearray):
+        email = dict(email)
+        for field, slot in self._slots.items():
+            value = email.pop(field, _MISSING)
+            if field in ADDRESS_FIELDS:
+                value = _intern_addresses(value)
+            elif field == 'attachments' and isinstance(value, list):
+                value = tuple(AttachmentRecord(attachment, arena) for attachment in value)
+            setattr(self, slot, value)
+        self.extra = email or None
+
+    def as_dict(self, arena: bytearray) -> dict:
+        email = {}
+        for field, slot in self._slots.items():
+            value = getattr(self, slot)
+            if value is _MISSING:
+                continue
+            if isinstance(value, tuple):
+                if field == 'attachments':
+                    value = [attachment.as_dict(arena) for attachment in value]
+                else:
+                    value = list(value)
+            email[field] = value
+        if self.extra:
+            email.update(self.extra)
+        return email
+
+
+class CompactCorpus(Sequence):
+    def __init__(self, emails: Iterable[dict] = (), arena: bytearray = None, records: List[EmailRecord] = None):
+        self.arena = arena if arena is not None else bytearray()
+        self.records = records if records is not None else []
+        for email in emails:
+            self.append(email)
+
+    def append(self, email: dict):
+        self.records.append(EmailRecord(email, self.arena))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CompactCorpus(arena=self.arena, records=self.records[index])
+        return self.records[index].as_dict(self.arena)
+
+    def __iter__(self) -> Iterable[dict]:
+        for record in self.records:
+            yield record.as_dict(self.arena)
+
+
+def _intern(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+def _intern_addresses(value):
+    if isinstance(value, list):
+        return tuple(_intern(address) for address in value)
+    return _intern(value)
+
+
+def _decode_content(content) -> bytes:
+    if not isinstance(content, str):
+        return None
+    try:
+        decoded = b64decode(content, validate=True)
+    except (Base64Error, ValueError):
+        return None
+    if b64encode(decoded) != content.encode('ascii'):
+        return None
+    return decoded
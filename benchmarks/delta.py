@@ -0,0 +1,98 @@
+from abc import ABC
+from io import BytesIO
+from itertools import groupby
+from typing import Iterable
+from typing import List
+from zlib import compressobj as zlib_compressobj
+from zlib import decompressobj as zlib_decompressobj
+
+from zstandard import DICT_TYPE_RAWCONTENT
+from zstandard import MAX_COMPRESSION_LEVEL
+from zstandard import ZstdCompressionDict
+from zstandard import ZstdCompressor
+from zstandard import ZstdDecompressor
+
+from benchmarks.serialization import _Serialization
+
+ZLIB_WINDOW_SIZE = 32 * 1024
+
+
+class _DeltaCompression(ABC):
+    @property
+    def extension(self) -> str:
+        raise NotImplementedError
+
+    def compress(self, data: bytes, reference: bytes = b'') -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes, reference: bytes = b'') -> bytes:
+        raise NotImplementedError
+
+
+class ZstandardDeltaCompression(_DeltaCompression):
+    def __init__(self, level: int = 3):
+        self.level = level
+
+    @property
+    def extension(self) -> str:
+        return '.{}.zs'.format(self.level)
+
+    def compress(self, data: bytes, reference: bytes = b'') -> bytes:
+        if not reference:
+            return ZstdCompressor(level=self.level).compress(data)
+
+        dict_data = ZstdCompressionDict(reference, dict_type=DICT_TYPE_RAWCONTENT)
+        return ZstdCompressor(level=self.level, dict_data=dict_data).compress(data)
+
+    def decompress(self, data: bytes, reference: bytes = b'') -> bytes:
+        if not reference:
+            return ZstdDecompressor().decompress(data)
+
+        dict_data = ZstdCompressionDict(reference, dict_type=DICT_TYPE_RAWCONTENT)
+        return ZstdDecompressor(dict_data=dict_data).decompress(data)
+
+
+class ZlibDeltaCompression(_DeltaCompression):
+    def __init__(self, level: int = 9):
+        self.level = level
+
+    @property
+    def extension(self) -> str:
+        return '.{}.zlib'.format(self.level)
+
+    def compress(self, data: bytes, reference: bytes = b'') -> bytes:
+        compressor = zlib_compressobj(self.level, **self._zdict(reference))
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes, reference: bytes = b'') -> bytes:
+        decompressor = zlib_decompressobj(**self._zdict(reference))
+        return decompressor.decompress(data) + decompressor.flush()
+
+    @classmethod
+    def _zdict(cls, reference: bytes) -> dict:
+        if not reference:
+            return {}
+        return {'zdict': reference[-ZLIB_WINDOW_SIZE:]}
+
+
+def split_batches(objs: Iterable[dict]) -> List[List[dict]]:
+    objs = sorted(objs, key=_sent_at)
+    return [list(batch) for _, batch in groupby(objs, key=lambda obj: _sent_at(obj)[:10])]
+
+
+def serialize_batch(objs: Iterable[dict], serializer: _Serialization) -> bytes:
+    buffer = BytesIO()
+    serializer.serialize(iter(objs), buffer)
+    return buffer.getvalue()
+
+
+def _sent_at(obj: dict) -> str:
+    return str(obj.get('sent_at') or '')
+
+
+def get_all() -> Iterable[_DeltaCompression]:
+    return (
+        ZlibDeltaCompression(),
+        ZstandardDeltaCompression(),
+        ZstandardDeltaCompression(level=MAX_COMPRESSION_LEVEL),
+    )
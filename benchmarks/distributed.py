@@ -0,0 +1,377 @@
+from collections import deque
+from glob import glob
+from hashlib import sha256
+from hmac import compare_digest
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from io import BytesIO
+from json import dumps
+from json import loads
+from os import getenv
+from os import getpid
+from os.path import basename
+from os.path import join
+from secrets import token_hex
+from socket import gethostname
+from socketserver import ThreadingMixIn
+from sys import stderr
+from threading import Condition
+from threading import Thread
+from time import monotonic
+from time import sleep
+from typing import Iterable
+from typing import List
+from zipfile import ZIP_STORED
+from zipfile import ZipFile
+
+import requests
+
+from benchmarks.__main__ import Benchmark
+from benchmarks.__main__ import BenchmarkError
+from benchmarks.__main__ import display_benchmarks
+from benchmarks.__main__ import format_stages
+from benchmarks.__main__ import grid_jobs
+from benchmarks.__main__ import load_samples
+from benchmarks.__main__ import run_benchmarks
+from benchmarks.utils import download_sample_emails
+from benchmarks.utils import pretty_extension
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+TOKEN_ENVVAR = 'BENCHMARKS_DISTRIBUTED_TOKEN'
+
+
+def pack_corpus(inputs_dir: str) -> bytes:
+    buffer = BytesIO()
+    with ZipFile(buffer, 'w', ZIP_STORED) as archive:
+        for path in sorted(glob(join(inputs_dir, '*'))):
+            archive.write(path, basename(path))
+    return buffer.getvalue()
+
+
+def encode_result(result: Benchmark) -> dict:
+    return {field: {'error': str(value.ex)} if isinstance(value, BenchmarkError) else value
+            for (field, value) in result._asdict().items()}
+
+
+def decode_result(encoded: dict) -> Benchmark:
+    return Benchmark(**{field: BenchmarkError(value['error']) if isinstance(value, dict) else value
+                        for (field, value) in encoded.items()})
+
+
+class Coordinator:
+    def __init__(self, jobs: Iterable[tuple], corpus: bytes, options: dict = None,
+                 lease_size: int = 1, lease_timeout: float = 900):
+        self.jobs = {format_stages(*job): job for job in jobs}
+        self.corpus = corpus
+        self.options = dict(options or {})
+        self.options['corpus_digest'] = sha256(corpus).hexdigest()
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+
+        self._pending = deque(self.jobs)
+        self._leases = {}
+        self._completed = {}
+        self._arrived = deque()
+        self._workers = set()
+        self._finished_workers = set()
+        self._condition = Condition()
+
+    @property
+    def done(self) -> bool:
+        return len(self._completed) == len(self.jobs)
+
+    def register(self, worker: str) -> dict:
+        with self._condition:
+            self._workers.add(worker)
+            return self.options
+
+    def lease(self, worker: str) -> dict:
+        with self._condition:
+            self._workers.add(worker)
+            self._reclaim_expired()
+            if self.done:
+                return {'jobs': [], 'done': True}
+
+            deadline = monotonic() + self.lease_timeout
+            leased = []
+            while self._pending and len(leased) < self.lease_size:
+                key = self._pending.popleft()
+                self._leases[key] = (worker, deadline)
+                leased.append(key)
+            return {'jobs': leased, 'done': False}
+
+    def release(self, worker: str):
+        with self._condition:
+            self._finished_workers.add(worker)
+            self._condition.notify_all()
+
+    def complete(self, worker: str, key: str, result: Benchmark):
+        with self._condition:
+            if key not in self.jobs or key in self._completed:
+                return
+            self._leases.pop(key, None)
+            if key in self._pending:
+                self._pending.remove(key)
+            self._completed[key] = result
+            self._arrived.append(result)
+            self._condition.notify_all()
+
+    def fail(self, worker: str, key: str, message: str):
+        compressor, serializer, encryptor, preprocessor = self.jobs[key]
+        error = BenchmarkError(message)
+        self.complete(worker, key, Benchmark(
+            Compressor=pretty_extension(compressor.extension),
+            Serializer=pretty_extension(serializer.extension),
+            Encryptor=pretty_extension(encryptor.extension),
+            Preprocessor=pretty_extension(preprocessor.extension),
+            FilesizeKb=error,
+            WriteTimeSeconds=error,
+            ReadTimeSeconds=error,
+            FirstEmailSeconds=error,
+            LatencyP50Ms=error,
+            LatencyP99Ms=error,
+        ))
+
+    def results(self, poll_interval: float = 1.0) -> Iterable[Benchmark]:
+        num_yielded = 0
+        while num_yielded < len(self.jobs):
+            with self._condition:
+                while not self._arrived:
+                    self._condition.wait(poll_interval)
+                    self._reclaim_expired()
+                result = self._arrived.popleft()
+            num_yielded += 1
+            yield result
+
+    def wait_for_workers(self, timeout: float) -> bool:
+        deadline = monotonic() + timeout
+        with self._condition:
+            while not self._workers <= self._finished_workers:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _reclaim_expired(self):
+        now = monotonic()
+        for key, (worker, deadline) in list(self._leases.items()):
+            if deadline < now:
+                print('Lease of {} by {} expired'.format(key, worker), file=stderr)
+                del self._leases[key]
+                self._pending.append(key)
+
+
+class _CoordinatorHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if not self._authorize():
+            return
+        coordinator = self.server.coordinator
+        if self.path == '/corpus':
+            self._send(coordinator.corpus, 'application/zip')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if not self._authorize():
+            return
+        coordinator = self.server.coordinator
+        body = loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        if self.path == '/register':
+            self._send_json(coordinator.register(body['worker']))
+        elif self.path == '/lease':
+            lease = coordinator.lease(body['worker'])
+            self._send_json(lease)
+            if lease['done']:
+                # only let the coordinator exit once the worker has been told to stop
+                coordinator.release(body['worker'])
+        elif self.path == '/results' and body['job'] in coordinator.jobs:
+            if 'error' in body:
+                coordinator.fail(body['worker'], body['job'], body['error'])
+            else:
+                coordinator.complete(body['worker'], body['job'], decode_result(body['result']))
+            self._send_json({})
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _authorize(self) -> bool:
+        expected = 'Bearer {}'.format(self.server.token)
+        if compare_digest(self.headers.get('Authorization', ''), expected):
+            return True
+        self.send_error(401)
+        return False
+
+    def _send_json(self, obj):
+        self._send(dumps(obj).encode('utf-8'), 'application/json')
+
+    def _send(self, payload: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class CoordinatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, coordinator: Coordinator, token: str, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        if not token:
+            raise ValueError('The coordinator requires a shared token')
+        super().__init__((host, port), _CoordinatorHandler)
+        self.coordinator = coordinator
+        self.token = token
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def run(self, poll_interval: float = 1.0, linger_seconds: float = 10) -> Iterable[Benchmark]:
+        thread = Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        try:
+            for result in self.coordinator.results(poll_interval):
+                yield result
+            self.coordinator.wait_for_workers(linger_seconds)
+        finally:
+            self.shutdown()
+            self.server_close()
+            thread.join()
+
+
+def run_worker(coordinator_url: str, token: str, results_dir: str, cache_dir: str, name: str = None,
+               poll_interval: float = 1.0) -> int:
+    if not token:
+        raise ValueError('The worker requires the coordinator\'s shared token')
+
+    coordinator_url = coordinator_url.rstrip('/')
+    name = name or '{}-{}'.format(gethostname(), getpid())
+    results_dir = join(results_dir, name)
+    session = requests.Session()
+    session.headers['Authorization'] = 'Bearer {}'.format(token)
+
+    options = _post(session, coordinator_url + '/register', {'worker': name})
+    corpus_url = coordinator_url + '/corpus'
+    inputs_dir = join(cache_dir, options['corpus_digest'])
+    download_sample_emails(corpus_url, inputs_dir, headers=session.headers)
+    emails = load_samples(corpus_url, inputs_dir, options.get('exclude_attachments', False))
+
+    jobs = {format_stages(*job): job for job in _all_jobs()}
+    num_completed = 0
+
+    while True:
+        lease = _post(session, coordinator_url + '/lease', {'worker': name})
+        if lease['done']:
+            return num_completed
+        if not lease['jobs']:
+            sleep(poll_interval)
+            continue
+
+        for key in lease['jobs']:
+            job = jobs.get(key)
+            if job is None:
+                _post(session, coordinator_url + '/results', {
+                    'worker': name, 'job': key, 'error': 'unknown to worker {}'.format(name)})
+                continue
+
+            for result in run_benchmarks(emails, results_dir, incremental=False,
+                                         pipelined=options.get('pipelined', False),
+                                         isolated=options.get('isolated', False),
+                                         timeout=options.get('timeout'),
+                                         memory_limit_mb=options.get('memory_limit_mb'),
+                                         jobs=[job]):
+                _post(session, coordinator_url + '/results', {
+                    'worker': name, 'job': key, 'result': encode_result(result)})
+                num_completed += 1
+
+
+def _post(session: requests.Session, url: str, payload: dict) -> dict:
+    response = session.post(url, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+def _all_jobs() -> List[tuple]:
+    return grid_jobs(serializer_variants=True, preprocessing=True, compressor_variants=True, encryptor_variants=True)
+
+
+def _parse_jobs(stages: str, serializer_variants: bool, preprocessing: bool, compressor_variants: bool,
+                encryptor_variants: bool) -> List[tuple]:
+    if not stages:
+        return grid_jobs(serializer_variants, preprocessing, compressor_variants, encryptor_variants)
+    selected = set(stages.split(','))
+    return [job for job in _all_jobs() if format_stages(*job) in selected]
+
+
+def cli():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Distribute the benchmark grid over several worker processes or machines.')
+    commands = parser.add_subparsers(dest='command')
+
+    coordinator_parser = commands.add_parser('coordinator')
+    coordinator_parser.add_argument('emails_zip_url')
+    coordinator_parser.add_argument('--inputs_dir', default='sample-emails')
+    coordinator_parser.add_argument('--exclude_attachments', action='store_true')
+    coordinator_parser.add_argument('--display_format', default='csv')
+    coordinator_parser.add_argument('--host', default=DEFAULT_HOST)
+    coordinator_parser.add_argument('--token', default=getenv(TOKEN_ENVVAR))
+    coordinator_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    coordinator_parser.add_argument('--jobs', default='')
+    coordinator_parser.add_argument('--serializer_variants', action='store_true')
+    coordinator_parser.add_argument('--compressor_variants', action='store_true')
+    coordinator_parser.add_argument('--encryptor_variants', action='store_true')
+    coordinator_parser.add_argument('--preprocessing', action='store_true')
+    coordinator_parser.add_argument('--lease_size', type=int, default=1)
+    coordinator_parser.add_argument('--lease_timeout', type=float, default=900)
+    coordinator_parser.add_argument('--pipelined', action='store_true')
+    coordinator_parser.add_argument('--isolated', action='store_true')
+    coordinator_parser.add_argument('--timeout', type=float)
+    coordinator_parser.add_argument('--memory_limit_mb', type=int)
+
+    worker_parser = commands.add_parser('worker')
+    worker_parser.add_argument('coordinator_url')
+    worker_parser.add_argument('--results_dir', default='results')
+    worker_parser.add_argument('--cache_dir', default='worker-emails')
+    worker_parser.add_argument('--token', default=getenv(TOKEN_ENVVAR))
+    worker_parser.add_argument('--name')
+    worker_parser.add_argument('--poll_interval', type=float, default=1.0)
+
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        if not args.token:
+            parser.error('pass the coordinator\'s token as --token or {}'.format(TOKEN_ENVVAR))
+        num_completed = run_worker(args.coordinator_url, args.token, args.results_dir, args.cache_dir, args.name,
+                                   args.poll_interval)
+        print('Completed {} jobs'.format(num_completed), file=stderr)
+
+    elif args.command == 'coordinator':
+        download_sample_emails(args.emails_zip_url, args.inputs_dir)
+        jobs = _parse_jobs(args.jobs, args.serializer_variants, args.preprocessing, args.compressor_variants,
+                           args.encryptor_variants)
+        coordinator = Coordinator(jobs, pack_corpus(args.inputs_dir), {
+            'exclude_attachments': args.exclude_attachments,
+            'pipelined': args.pipelined,
+            'isolated': args.isolated,
+            'timeout': args.timeout,
+            'memory_limit_mb': args.memory_limit_mb,
+        }, args.lease_size, args.lease_timeout)
+
+        token = args.token or token_hex(16)
+        server = CoordinatorServer(coordinator, token, args.host, args.port)
+        print('Serving {} jobs on {}:{}'.format(len(coordinator.jobs), args.host, server.port), file=stderr)
+        if not args.token:
+            print('Workers need --token {}'.format(token), file=stderr)
+        display_benchmarks(server.run(), args.display_format)
+
+    else:
+        parser.error('expected the coordinator or worker command')
+
+
+if __name__ == '__main__':
+    cli()
@@ -2,13 +2,21 @@ from abc import ABC
 from contextlib import contextmanager
 from io import SEEK_END
 from io import SEEK_SET
+from io import BufferedReader
+from io import RawIOBase
 from os import urandom
+from struct import calcsize
+from struct import pack
+from struct import unpack
 from tempfile import NamedTemporaryFile
 from typing import IO
 from typing import Iterable
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from cryptography.hazmat.primitives.ciphers.algorithms import AES
 from cryptography.hazmat.primitives.ciphers.modes import CTR
 from cryptography.hazmat.primitives.hashes import SHA256
@@ -16,6 +24,8 @@ from cryptography.hazmat.primitives.hmac import HMAC
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 PASSWORD_DERIVE_ITER = 100000
+AEAD_SEGMENT_SIZE = 64 * 1024
+AEAD_TAG_SIZE = 16
 
 
 class KeyDerive(object):
@@ -309,6 +319,148 @@ class AesEncryption(_Encryption):
             yield temp
 
 
+class SegmentAuthenticationError(Exception):
+
+    def __init__(self, segment):
+        super().__init__('Segment {} failed authentication'.format(segment))
+        self.segment = segment
+
+
+class _SegmentEncryptor(RawIOBase):
+
+    def __init__(self, fobj, aead, header, nonce_prefix, segment_size):
+        self._fobj = fobj
+        self._aead = aead
+        self._header = header
+        self._nonce_prefix = nonce_prefix
+        self._segment_size = segment_size
+        self._buffer = bytearray()
+        self._segment = 0
+        self._finalized = False
+
+        fobj.write(header)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) > self._segment_size:
+            self._write_segment(bytes(self._buffer[:self._segment_size]), last=False)
+            del self._buffer[:self._segment_size]
+        return len(data)
+
+    def finalize(self):
+        if not self._finalized:
+            self._finalized = True
+            self._write_segment(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+
+    def close(self):
+        self.finalize()
+        super().close()
+
+    def _write_segment(self, plaintext, last):
+        nonce = _segment_nonce(self._nonce_prefix, self._segment, last)
+        self._fobj.write(self._aead.encrypt(nonce, plaintext, self._header))
+        self._segment += 1
+
+
+class _SegmentDecryptor(RawIOBase):
+
+    def __init__(self, fobj, aead, header, nonce_prefix, segment_size):
+        self._fobj = fobj
+        self._aead = aead
+        self._header = header
+        self._nonce_prefix = nonce_prefix
+        self._ciphertext_size = segment_size + AEAD_TAG_SIZE
+        self._segment = 0
+        self._plaintext = b''
+        self._offset = 0
+        self._next = fobj.read(self._ciphertext_size)
+        self._finalized = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._plaintext):
+            if self._finalized:
+                return 0
+            self._read_segment()
+
+        size = min(len(buffer), len(self._plaintext) - self._offset)
+        buffer[:size] = self._plaintext[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def _read_segment(self):
+        ciphertext = self._next
+        self._next = self._fobj.read(self._ciphertext_size)
+        last = not self._next
+
+        nonce = _segment_nonce(self._nonce_prefix, self._segment, last)
+        try:
+            self._plaintext = self._aead.decrypt(nonce, ciphertext, self._header)
+        except InvalidTag:
+            raise SegmentAuthenticationError(self._segment)
+
+        self._offset = 0
+        self._segment += 1
+        self._finalized = last
+
+
+class _AeadEncryption(_Encryption):
+
+    header_format = '>16s7sI'
+
+    def __init__(self, segment_size=AEAD_SEGMENT_SIZE):
+        self.segment_size = segment_size
+
+    @property
+    def algorithm(self):
+        raise NotImplementedError
+
+    @property
+    def key_length(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def encrypt(self, fobj: IO[bytes]) -> IO[bytes]:
+        salt = urandom(16)
+        nonce_prefix = urandom(7)
+        header = pack(self.header_format, salt, nonce_prefix, self.segment_size)
+
+        aead = self.algorithm(_derive_key(b"client10", salt, self.key_length))
+
+        encryptor = _SegmentEncryptor(fobj, aead, header, nonce_prefix, self.segment_size)
+        yield encryptor
+        encryptor.finalize()
+
+    @contextmanager
+    def deserialize(self, fobj: IO[bytes]) -> IO[bytes]:
+        header = fobj.read(calcsize(self.header_format))
+        salt, nonce_prefix, segment_size = unpack(self.header_format, header)
+
+        aead = self.algorithm(_derive_key(b"client10", salt, self.key_length))
+
+        yield BufferedReader(_SegmentDecryptor(fobj, aead, header, nonce_prefix, segment_size))
+
+
+class AesGcmEncryption(_AeadEncryption):
+
+    extension = 'aesgcm'
+    algorithm = AESGCM
+    key_length = 16
+
+
+class ChaCha20Poly1305Encryption(_AeadEncryption):
+
+    extension = 'chacha20'
+    algorithm = ChaCha20Poly1305
+    key_length = 32
+
+
 class NoEncryption(_Encryption):
 
     extension = ''
@@ -328,8 +480,33 @@ class NoEncryption(_Encryption):
             pass
 
 
-def get_all() -> Iterable[_Encryption]:
-    return (
+def _derive_key(password, salt, length):
+
+    kdf = PBKDF2HMAC(
+        algorithm=SHA256(),
+        length=length,
+        salt=salt,
+        iterations=PASSWORD_DERIVE_ITER,
+        backend=default_backend()
+    )
+
+    return kdf.derive(password)
+
+
+def _segment_nonce(nonce_prefix, segment, last):
+
+    return nonce_prefix + pack('>IB', segment, 1 if last else 0)
+
+
+def get_all(variants: bool = False) -> Iterable[_Encryption]:
+    encryptors = (
         NoEncryption(),
         AesEncryption(),
     )
+    if not variants:
+        return encryptors
+
+    return encryptors + (
+        AesGcmEncryption(),
+        ChaCha20Poly1305Encryption(),
+    )
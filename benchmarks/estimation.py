@@ -0,0 +1,115 @@
+from collections import namedtuple
+from math import sqrt
+from random import Random
+from statistics import mean
+from statistics import stdev
+from typing import Iterable
+from typing import List
+
+from benchmarks.compression import _Compression
+from benchmarks.encryption import _Encryption
+from benchmarks.pipeline import writer_chain
+from benchmarks.preprocessing import NoPreprocessing
+from benchmarks.preprocessing import _Preprocessing
+from benchmarks.serialization import _Serialization
+from benchmarks.utils import CountingWriter
+from benchmarks.utils import Timer
+
+# two-sided 95% quantiles of Student's t distribution by degrees of freedom
+T_QUANTILES_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306,
+                  9: 2.262, 10: 2.228, 15: 2.131, 20: 2.086, 30: 2.042}
+
+Estimate = namedtuple('Estimate', (
+    'size',
+    'size_low',
+    'size_high',
+    'seconds',
+    'seconds_low',
+    'seconds_high',
+))
+
+
+class SizeEstimator:
+    def __init__(self, num_strata: int = 8, sample_fraction: float = 0.02, min_sample_size: int = 5,
+                 seed: int = 0):
+        self.num_strata = num_strata
+        self.sample_fraction = sample_fraction
+        self.min_sample_size = min_sample_size
+        self.seed = seed
+
+    def estimate(self, emails: List[dict], compressor: _Compression, serializer: _Serialization,
+                 encryptor: _Encryption, preprocessor: _Preprocessing = None) -> Estimate:
+        preprocessor = preprocessor or NoPreprocessing()
+        samples = list(self.samples(emails))
+        pooled = [email for sample in samples for email in sample]
+        remaining = len(emails) - len(pooled)
+
+        size, seconds = self._measure(pooled, compressor, serializer, encryptor, preprocessor)
+
+        size_rates = []
+        seconds_rates = []
+        for i, sample in enumerate(samples):
+            others = [email for (j, other) in enumerate(samples) if j != i for email in other]
+            size_without, seconds_without = self._measure(others, compressor, serializer, encryptor, preprocessor)
+            size_rates.append((size - size_without) / len(sample))
+            seconds_rates.append(max(seconds - seconds_without, 0.0) / len(sample))
+
+        size_growth, size_margin = _extrapolate(size_rates, remaining)
+        seconds_growth, seconds_margin = _extrapolate(seconds_rates, remaining)
+        return Estimate(
+            size=size + size_growth,
+            size_low=size + max(size_growth - size_margin, 0.0),
+            size_high=size + size_growth + size_margin,
+            seconds=seconds + seconds_growth,
+            seconds_low=seconds + max(seconds_growth - seconds_margin, 0.0),
+            seconds_high=seconds + seconds_growth + seconds_margin,
+        )
+
+    def samples(self, emails: List[dict]) -> Iterable[List[dict]]:
+        rng = Random(self.seed)
+        num_strata = max(min(self.num_strata, len(emails) // self.min_sample_size), 1)
+        stratum_size = len(emails) / num_strata
+        for i in range(num_strata):
+            stratum = emails[round(i * stratum_size):round((i + 1) * stratum_size)]
+            sample_size = min(max(round(len(stratum) * self.sample_fraction), self.min_sample_size), len(stratum))
+            indices = sorted(rng.sample(range(len(stratum)), sample_size))
+            yield [stratum[index] for index in indices]
+
+    @classmethod
+    def _measure(cls, emails: List[dict], compressor: _Compression, serializer: _Serialization,
+                 encryptor: _Encryption, preprocessor: _Preprocessing) -> tuple:
+        sink = CountingWriter(_NullWriter())
+        with Timer.timeit() as timer:
+            with writer_chain(sink, compressor, encryptor) as comp:
+                serializer.serialize(preprocessor.preprocess(iter(emails)), comp)
+        return sink.written, timer.elapsed()
+
+
+class _NullWriter:
+    @classmethod
+    def write(cls, data: bytes) -> int:
+        return len(data)
+
+    @classmethod
+    def flush(cls):
+        pass
+
+
+def prune(estimates: dict) -> set:
+    if not estimates:
+        return set()
+    best_high = min(estimate.size_high for estimate in estimates.values())
+    return {key for (key, estimate) in estimates.items() if estimate.size_low <= best_high}
+
+
+def _extrapolate(rates: List[float], population: int) -> tuple:
+    total = mean(rates) * population
+    if len(rates) < 2:
+        return total, float('inf')
+    standard_error = stdev(rates) / sqrt(len(rates)) * population
+    return total, _t_quantile(len(rates) - 1) * standard_error
+
+
+def _t_quantile(degrees_of_freedom: int) -> float:
+    known = [dof for dof in T_QUANTILES_95 if dof <= degrees_of_freedom]
+    return T_QUANTILES_95[max(known)] if known else T_QUANTILES_95[1]
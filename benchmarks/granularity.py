@@ -0,0 +1,91 @@
+from io import SEEK_END
+from itertools import islice
+from struct import calcsize
+from struct import pack
+from struct import unpack
+from typing import IO
+from typing import Iterable
+from typing import List
+
+from benchmarks.compression import _Compression
+from benchmarks.serialization import _Serialization
+from benchmarks.utils import CountingWriter
+from benchmarks.utils import bounded_reader
+
+
+class GroupedContainer:
+    trailer_format = '>QI'
+
+    def __init__(self, group_size: int = 0):
+        self.group_size = group_size
+
+    @property
+    def extension(self) -> str:
+        if not self.group_size:
+            return '.batch'
+        return '.groups{}'.format(self.group_size)
+
+    def write(self, objs: Iterable[dict], serializer: _Serialization,
+              compressor: _Compression, fobj: IO[bytes]):
+        sizes = []
+        for group in self._groups(objs):
+            segment = CountingWriter(fobj)
+            with compressor.compress(segment) as comp:
+                serializer.serialize(iter(group), comp)
+            sizes.append(segment.written)
+
+        fobj.write(pack('>{}Q'.format(len(sizes)), *sizes))
+        fobj.write(pack(self.trailer_format, len(sizes), self.group_size))
+
+    def read(self, serializer: _Serialization, compressor: _Compression,
+             fobj: IO[bytes]) -> Iterable[dict]:
+        start = fobj.tell()
+        sizes = self._read_index(fobj)
+
+        offset = start
+        for size in sizes:
+            fobj.seek(offset)
+            with compressor.decompress(bounded_reader(fobj, size)) as decomp:
+                yield from serializer.deserialize(decomp)
+            offset += size
+
+    def read_one(self, index: int, serializer: _Serialization,
+                 compressor: _Compression, fobj: IO[bytes]) -> dict:
+        start = fobj.tell()
+        sizes = self._read_index(fobj)
+        group_size = self.group_size or index + 1
+        group, position = divmod(index, group_size)
+
+        fobj.seek(start + sum(sizes[:group]))
+        with compressor.decompress(bounded_reader(fobj, sizes[group])) as decomp:
+            for obj in islice(serializer.deserialize(decomp), position, None):
+                return obj
+
+        raise IndexError(index)
+
+    def _groups(self, objs: Iterable[dict]) -> Iterable[List[dict]]:
+        if not self.group_size:
+            yield list(objs)
+            return
+
+        objs = iter(objs)
+        while True:
+            group = list(islice(objs, self.group_size))
+            if not group:
+                break
+            yield group
+
+    def _read_index(self, fobj: IO[bytes]) -> List[int]:
+        trailer_size = calcsize(self.trailer_format)
+        fobj.seek(-trailer_size, SEEK_END)
+        num_groups, group_size = unpack(self.trailer_format, fobj.read(trailer_size))
+        if group_size != self.group_size:
+            raise ValueError('Container has group size {}, expected {}'.format(group_size, self.group_size))
+
+        index_format = '>{}Q'.format(num_groups)
+        fobj.seek(-trailer_size - calcsize(index_format), SEEK_END)
+        return list(unpack(index_format, fobj.read(calcsize(index_format))))
+
+
+def get_all(group_sizes: Iterable[int] = (1, 10, 100)) -> Iterable[GroupedContainer]:
+    return tuple(GroupedContainer(group_size) for group_size in group_sizes) + (GroupedContainer(),)
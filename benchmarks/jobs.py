@@ -0,0 +1,59 @@
+from io import BufferedReader
+
+from benchmarks.pipeline import reader_chain
+from benchmarks.pipeline import writer_chain
+from benchmarks.sandbox import peak_memory_mb
+from benchmarks.utils import LatencyRecorder
+from benchmarks.utils import ThrottledReader
+from benchmarks.utils import Timer
+from benchmarks.utils import email_digest
+
+
+def verify_emails(actuals, expecteds):
+    for i, (actual, expected) in enumerate(zip(actuals, expecteds)):
+        for key in actual.keys() | expected.keys():
+            actual_value = actual.get(key)
+            expected_value = expected.get(key)
+            assert \
+                (actual_value == expected_value) or \
+                (not actual_value and not expected_value), \
+                'i={},key={},actual={},expected={}'.format(
+                    i, key, actual_value, expected_value)
+
+
+def write_read(emails, outpath, compressor, serializer, encryptor, preprocessor, pipelined=False):
+    try:
+        with Timer.timeit() as write_timer:
+            with open(outpath, 'wb') as raw:
+                with writer_chain(raw, compressor, encryptor, pipelined) as comp:
+                    serializer.serialize(preprocessor.preprocess(iter(emails)), comp)
+    except Exception as ex:
+        return ex, ex, ex
+
+    try:
+        with Timer.timeit() as read_timer:
+            latency = LatencyRecorder()
+            with open(outpath, 'rb') as raw:
+                with reader_chain(raw, compressor, encryptor, pipelined) as decomp:
+                    actuals = preprocessor.postprocess(serializer.deserialize(decomp))
+                    verify_emails(latency.track(actuals), emails)
+    except Exception as ex:
+        return write_timer.elapsed(), ex, ex
+
+    return write_timer.elapsed(), read_timer.elapsed(), latency.summary()
+
+
+def read_digests(outpath, compressor, serializer, encryptor, expected_digests, bytes_per_second=None):
+    with Timer.timeit() as read_timer:
+        with open(outpath, 'rb') as raw:
+            if bytes_per_second:
+                raw = BufferedReader(ThrottledReader(raw, bytes_per_second))
+            with reader_chain(raw, compressor, encryptor) as decomp:
+                actual_digests = [email_digest(email) for email in serializer.deserialize(decomp)]
+
+    if actual_digests != expected_digests:
+        mismatches = sum(1 for actual, expected in zip(actual_digests, expected_digests) if actual != expected)
+        raise ValueError('read {} of {} emails, {} mismatched'.format(
+            len(actual_digests), len(expected_digests), mismatches))
+
+    return read_timer.elapsed(), peak_memory_mb()
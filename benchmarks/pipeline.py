@@ -0,0 +1,241 @@
+from contextlib import contextmanager
+from io import BufferedReader
+from io import RawIOBase
+from queue import Full
+from queue import Queue
+from threading import Event
+from threading import Thread
+from typing import IO
+
+from benchmarks.compression import _Compression
+from benchmarks.encryption import _Encryption
+from benchmarks.utils import MappedReader
+
+PIPE_QUEUE_SIZE = 16
+PIPE_CHUNK_SIZE = 64 * 1024
+COALESCE_BUFFER_SIZE = 64 * 1024
+
+_DONE = object()
+
+
+class PipeWriter:
+    def __init__(self, fobj: IO[bytes], queue_size: int = PIPE_QUEUE_SIZE):
+        self._fobj = fobj
+        self._queue = Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is _DONE:
+                break
+            if self._error is None:
+                try:
+                    self._fobj.write(chunk)
+                except BaseException as ex:
+                    self._error = ex
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, data: bytes) -> int:
+        self._raise_error()
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_DONE)
+            self._thread.join()
+        self._raise_error()
+
+    @classmethod
+    def writable(cls) -> bool:
+        return True
+
+    @classmethod
+    def seekable(cls) -> bool:
+        return False
+
+
+class PipeReader(RawIOBase):
+    def __init__(self, fobj: IO[bytes], queue_size: int = PIPE_QUEUE_SIZE,
+                 chunk_size: int = PIPE_CHUNK_SIZE):
+        self._fobj = fobj
+        self._chunk_size = chunk_size
+        self._queue = Queue(maxsize=queue_size)
+        self._stopped = Event()
+        self._chunk = b''
+        self._offset = 0
+        self._eof = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                chunk = self._fobj.read(self._chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except BaseException as ex:
+            self._put(ex)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            else:
+                break
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self._offset >= len(self._chunk):
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._chunk = item
+            self._offset = 0
+
+        size = min(len(buffer), len(self._chunk) - self._offset)
+        buffer[:size] = self._chunk[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        super().close()
+
+
+class CoalescingWriter:
+    def __init__(self, fobj: IO[bytes], buffer_size: int = COALESCE_BUFFER_SIZE):
+        self._fobj = fobj
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        size = len(data)
+        if not self._buffer and size >= self._buffer_size:
+            self._fobj.write(data)
+            return size
+
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            self._drain()
+        return size
+
+    def flush(self):
+        self._drain()
+        flush = getattr(self._fobj, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def close(self):
+        self._drain()
+
+    def _drain(self):
+        if self._buffer:
+            buffer, self._buffer = self._buffer, bytearray()
+            self._fobj.write(buffer)
+
+    @classmethod
+    def writable(cls) -> bool:
+        return True
+
+    @classmethod
+    def seekable(cls) -> bool:
+        return False
+
+
+@contextmanager
+def coalescing_writer(fobj: IO[bytes], buffer_size: int = COALESCE_BUFFER_SIZE) -> IO[bytes]:
+    if not buffer_size:
+        yield fobj
+        return
+
+    writer = CoalescingWriter(fobj, buffer_size)
+    yield writer
+    writer.close()
+
+
+@contextmanager
+def pipe_writer(fobj: IO[bytes], pipelined: bool = True) -> IO[bytes]:
+    if not pipelined:
+        yield fobj
+        return
+
+    writer = PipeWriter(fobj)
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+
+@contextmanager
+def pipe_reader(fobj: IO[bytes], pipelined: bool = True) -> IO[bytes]:
+    if not pipelined:
+        yield fobj
+        return
+
+    reader = PipeReader(fobj)
+    try:
+        yield BufferedReader(reader)
+    finally:
+        reader.close()
+
+
+@contextmanager
+def mapped_reader(fobj: IO[bytes]) -> IO[bytes]:
+    try:
+        reader = MappedReader(fobj)
+    except (AttributeError, OSError, ValueError):
+        yield fobj
+        return
+
+    try:
+        yield reader
+    finally:
+        reader.close()
+
+
+@contextmanager
+def writer_chain(fobj: IO[bytes], compressor: _Compression, encryptor: _Encryption,
+                 pipelined: bool = False, buffer_size: int = COALESCE_BUFFER_SIZE) -> IO[bytes]:
+    with encryptor.encrypt(fobj) as enc:
+        with pipe_writer(enc, pipelined) as enc:
+            with coalescing_writer(enc, buffer_size) as enc:
+                with compressor.compress(enc) as comp:
+                    with pipe_writer(comp, pipelined) as comp:
+                        with coalescing_writer(comp, buffer_size) as comp:
+                            yield comp
+
+
+@contextmanager
+def reader_chain(fobj: IO[bytes], compressor: _Compression, encryptor: _Encryption,
+                 pipelined: bool = False) -> IO[bytes]:
+    with encryptor.deserialize(fobj) as denc:
+        with pipe_reader(denc, pipelined) as denc:
+            with compressor.decompress(denc) as decomp:
+                if decomp is fobj:
+                    with mapped_reader(decomp) as mapped:
+                        yield mapped
+                    return
+
+                with pipe_reader(decomp, pipelined) as decomp:
+                    yield decomp
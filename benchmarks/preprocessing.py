@@ -0,0 +1,228 @@
+from abc import ABC
+from base64 import b85decode
+from base64 import b85encode
+from datetime import datetime
+from datetime import timedelta
+from hashlib import sha256
+from typing import Iterable
+from uuid import UUID
+
+from benchmarks.utils import BlobReferences
+
+
+class _Preprocessing(ABC):
+    @property
+    def extension(self) -> str:
+        raise NotImplementedError
+
+    def preprocess(self, objs: Iterable[dict]) -> Iterable[dict]:
+        raise NotImplementedError
+
+    def postprocess(self, objs: Iterable[dict]) -> Iterable[dict]:
+        raise NotImplementedError
+
+
+class NoPreprocessing(_Preprocessing):
+    extension = ''
+
+    def preprocess(self, objs: Iterable[dict]) -> Iterable[dict]:
+        return objs
+
+    def postprocess(self, objs: Iterable[dict]) -> Iterable[dict]:
+        return objs
+
+
+class AttachmentDedupPreprocessing(_Preprocessing):
+    extension = '.dedup'
+    references = BlobReferences(marker=b'\x00LKDEDUP', escape=b'\x00LKDDESC')
+
+    def preprocess(self, objs: Iterable[dict]) -> Iterable[dict]:
+        blob_indexes = {}
+        for obj in objs:
+            attachments = obj.get('attachments')
+            if attachments:
+                obj = dict(obj)
+                obj['attachments'] = [self._dedup(attachment, blob_indexes)
+                                      for attachment in attachments]
+            yield obj
+
+    def postprocess(self, objs: Iterable[dict]) -> Iterable[dict]:
+        blobs = []
+        for obj in objs:
+            attachments = obj.get('attachments')
+            if attachments:
+                obj['attachments'] = [self._restore(attachment, blobs)
+                                      for attachment in attachments]
+            yield obj
+
+    @classmethod
+    def _dedup(cls, attachment: dict, blob_indexes: dict) -> dict:
+        content = attachment['content']
+        digest = sha256(content.encode('ascii')).digest()
+        try:
+            index = blob_indexes[digest]
+        except KeyError:
+            blob_indexes[digest] = len(blob_indexes)
+            escaped = cls.references.escape_literal(content)
+            if escaped is content:
+                return attachment
+            content = escaped
+        else:
+            content = cls.references.reference(index)
+        attachment = dict(attachment)
+        attachment['content'] = content
+        return attachment
+
+    @classmethod
+    def _restore(cls, attachment: dict, blobs: list) -> dict:
+        content = attachment['content']
+        index = cls.references.index(content)
+        if index is not None:
+            attachment['content'] = blobs[index]
+            return attachment
+        content = cls.references.unescape_literal(content)
+        attachment['content'] = content
+        blobs.append(content)
+        return attachment
+
+
+class HeaderDictionaryPreprocessing(_Preprocessing):
+    extension = '.headers'
+    tag = '#'
+    escape = '!'
+
+    address_fields = ('from', 'to', 'cc', 'bcc')
+    sent_at_formats = (
+        ('%Y-%m-%d %H:%M', 60),
+        ('%Y-%m-%d %H:%M:%S', 1),
+        ('%Y-%m-%dT%H:%M:%S', 1),
+    )
+    sent_at_epoch = datetime(1970, 1, 1)
+    uid_hyphenated = 'u'
+    uid_hex = 'x'
+
+    def preprocess(self, objs: Iterable[dict]) -> Iterable[dict]:
+        addresses = {}
+        previous_sent_at = self.sent_at_epoch
+        for obj in objs:
+            obj = dict(obj)
+
+            for key in self.address_fields:
+                value = obj.get(key)
+                if isinstance(value, str):
+                    obj[key] = self._intern(value, addresses)
+                elif isinstance(value, list) and all(isinstance(item, str) for item in value):
+                    obj[key] = [self._intern(item, addresses) for item in value]
+
+            sent_at = obj.get('sent_at')
+            if isinstance(sent_at, str):
+                obj['sent_at'], previous_sent_at = self._encode_sent_at(sent_at, previous_sent_at)
+
+            uid = obj.get('_uid')
+            if isinstance(uid, str):
+                obj['_uid'] = self._encode_uid(uid)
+
+            yield obj
+
+    def postprocess(self, objs: Iterable[dict]) -> Iterable[dict]:
+        addresses = []
+        previous_sent_at = self.sent_at_epoch
+        for obj in objs:
+            for key in self.address_fields:
+                value = obj.get(key)
+                if isinstance(value, str):
+                    obj[key] = self._lookup(value, addresses)
+                elif isinstance(value, list) and all(isinstance(item, str) for item in value):
+                    obj[key] = [self._lookup(item, addresses) for item in value]
+
+            sent_at = obj.get('sent_at')
+            if isinstance(sent_at, str):
+                obj['sent_at'], previous_sent_at = self._decode_sent_at(sent_at, previous_sent_at)
+
+            uid = obj.get('_uid')
+            if isinstance(uid, str):
+                obj['_uid'] = self._decode_uid(uid)
+
+            yield obj
+
+    def _escape(self, value: str) -> str:
+        if value.startswith((self.tag, self.escape)):
+            return self.escape + value
+        return value
+
+    def _unescape(self, value: str) -> str:
+        if value.startswith(self.escape):
+            return value[len(self.escape):]
+        return value
+
+    def _intern(self, value: str, addresses: dict) -> str:
+        try:
+            index = addresses[value]
+        except KeyError:
+            addresses[value] = len(addresses)
+            return self._escape(value)
+        return self.tag + _to_base36(index)
+
+    def _lookup(self, value: str, addresses: list) -> str:
+        if value.startswith(self.tag):
+            return addresses[int(value[len(self.tag):], 36)]
+        value = self._unescape(value)
+        addresses.append(value)
+        return value
+
+    def _encode_sent_at(self, value: str, previous: datetime):
+        for index, (date_format, resolution) in enumerate(self.sent_at_formats):
+            try:
+                parsed = datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+            if parsed.strftime(date_format) != value:
+                continue
+            delta = int((parsed - previous).total_seconds())
+            if delta % resolution:
+                continue
+            return '{}{}{:+d}'.format(self.tag, index, delta // resolution), parsed
+        return self._escape(value), previous
+
+    def _decode_sent_at(self, value: str, previous: datetime):
+        if not value.startswith(self.tag):
+            return self._unescape(value), previous
+        date_format, resolution = self.sent_at_formats[int(value[len(self.tag)])]
+        parsed = previous + timedelta(seconds=int(value[len(self.tag) + 1:]) * resolution)
+        return parsed.strftime(date_format), parsed
+
+    def _encode_uid(self, value: str) -> str:
+        try:
+            uid = UUID(value)
+        except ValueError:
+            return self._escape(value)
+        if str(uid) == value:
+            return self.tag + self.uid_hyphenated + b85encode(uid.bytes).decode('ascii')
+        if uid.hex == value:
+            return self.tag + self.uid_hex + b85encode(uid.bytes).decode('ascii')
+        return self._escape(value)
+
+    def _decode_uid(self, value: str) -> str:
+        if not value.startswith(self.tag):
+            return self._unescape(value)
+        uid_format = value[len(self.tag)]
+        uid = UUID(bytes=b85decode(value[len(self.tag) + 1:]))
+        return str(uid) if uid_format == self.uid_hyphenated else uid.hex
+
+
+def _to_base36(value: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    encoded = ''
+    while True:
+        value, digit = divmod(value, 36)
+        encoded = digits[digit] + encoded
+        if not value:
+            return encoded
+
+
+def get_all() -> Iterable[_Preprocessing]:
+    return (
+        NoPreprocessing(),
+        AttachmentDedupPreprocessing(),
+        HeaderDictionaryPreprocessing(),
+    )
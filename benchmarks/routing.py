@@ -0,0 +1,149 @@
+from base64 import b64decode
+from base64 import b64encode
+from collections import Counter
+from io import SEEK_END
+from math import log2
+from shutil import copyfileobj
+from struct import pack
+from struct import unpack
+from tempfile import TemporaryFile
+from typing import IO
+from typing import Iterable
+
+from benchmarks.compression import NoCompression
+from benchmarks.compression import _Compression
+from benchmarks.serialization import _Serialization
+from benchmarks.utils import BlobReferences
+from benchmarks.utils import CountingWriter
+from benchmarks.utils import bounded_reader
+
+MAGIC_NUMBERS = (
+    (0, b'\xff\xd8\xff'),  # jpeg
+    (0, b'\x89PNG'),  # png
+    (0, b'GIF8'),  # gif
+    (0, b'%PDF'),  # pdf
+    (0, b'PK\x03\x04'),  # zip, docx, xlsx, odt
+    (0, b'\x1f\x8b'),  # gzip
+    (0, b'BZh'),  # bzip2
+    (0, b'\xfd7zXZ'),  # xz
+    (0, b'\x28\xb5\x2f\xfd'),  # zstd
+    (0, b'7z\xbc\xaf'),  # 7z
+    (0, b'Rar!'),  # rar
+    (0, b'ID3'),  # mp3
+    (0, b'OggS'),  # ogg
+    (0, b'fLaC'),  # flac
+    (4, b'ftyp'),  # mp4, mov, heic
+    (8, b'WEBP'),  # webp
+)
+
+
+def is_incompressible(content: str, sample_size: int = 4096, num_samples: int = 3,
+                      entropy_threshold: float = 7.5) -> bool:
+    head = b64decode(content[:16])
+    for offset, magic in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return True
+
+    encoded_sample_size = sample_size // 3 * 4
+    step = max(len(content) // num_samples // 4 * 4, encoded_sample_size)
+    counts = Counter()
+    total = 0
+    for start in range(0, len(content), step):
+        sample = b64decode(content[start:start + encoded_sample_size])
+        counts.update(sample)
+        total += len(sample)
+    if not total:
+        return False
+
+    entropy = -sum(count / total * log2(count / total) for count in counts.values())
+    return entropy >= entropy_threshold
+
+
+class AttachmentRouter:
+    references = BlobReferences(marker=b'\x00LKROUTE', escape=b'\x00LKRTESC')
+    trailer_format = '>QQ'
+
+    def __init__(self, blob_compressor: _Compression = None, min_size: int = 1024):
+        self.blob_compressor = blob_compressor or NoCompression()
+        self.min_size = min_size
+
+    @property
+    def extension(self) -> str:
+        return '.routed{}'.format(self.blob_compressor.extension)
+
+    def write(self, objs: Iterable[dict], serializer: _Serialization,
+              compressor: _Compression, fobj: IO[bytes]):
+        with TemporaryFile() as blobs_file:
+            with self.blob_compressor.compress(blobs_file) as blobs:
+                main = CountingWriter(fobj)
+                with compressor.compress(main) as comp:
+                    serializer.serialize(self._route(objs, blobs), comp)
+
+            blobs_size = blobs_file.tell()
+            blobs_file.seek(0)
+            copyfileobj(blobs_file, fobj)
+
+        fobj.write(pack(self.trailer_format, main.written, blobs_size))
+
+    def read(self, serializer: _Serialization, compressor: _Compression,
+             fobj: IO[bytes]) -> Iterable[dict]:
+        start = fobj.tell()
+        trailer_size = len(pack(self.trailer_format, 0, 0))
+        fobj.seek(-trailer_size, SEEK_END)
+        main_size, blobs_size = unpack(self.trailer_format, fobj.read(trailer_size))
+
+        fobj.seek(start + main_size)
+        with self.blob_compressor.decompress(bounded_reader(fobj, blobs_size)) as blobs:
+            blobs = list(self._read_blobs(blobs))
+
+        fobj.seek(start)
+        with compressor.decompress(bounded_reader(fobj, main_size)) as decomp:
+            for obj in serializer.deserialize(decomp):
+                attachments = obj.get('attachments')
+                if attachments:
+                    for attachment in attachments:
+                        self._restore(attachment, blobs)
+                yield obj
+
+    def _route(self, objs: Iterable[dict], blobs: IO[bytes]) -> Iterable[dict]:
+        num_blobs = 0
+        for obj in objs:
+            attachments = obj.get('attachments')
+            if attachments:
+                routed = []
+                for attachment in attachments:
+                    content = attachment['content']
+                    if len(content) >= self.min_size and is_incompressible(content):
+                        content = b64decode(content)
+                        blobs.write(pack('>I', len(content)))
+                        blobs.write(content)
+                        attachment = dict(attachment)
+                        attachment['content'] = self.references.reference(num_blobs)
+                        num_blobs += 1
+                    else:
+                        escaped = self.references.escape_literal(content)
+                        if escaped is not content:
+                            attachment = dict(attachment)
+                            attachment['content'] = escaped
+                    routed.append(attachment)
+                obj = dict(obj)
+                obj['attachments'] = routed
+            yield obj
+
+    @classmethod
+    def _read_blobs(cls, fobj: IO[bytes]) -> Iterable[str]:
+        while True:
+            header = fobj.read(4)
+            if not header:
+                break
+            size, = unpack('>I', header)
+            yield b64encode(fobj.read(size)).decode('ascii')
+
+    @classmethod
+    def _restore(cls, attachment: dict, blobs: list):
+        content = attachment['content']
+        index = cls.references.index(content)
+        if index is None:
+            attachment['content'] = cls.references.unescape_literal(content)
+        else:
+            attachment['content'] = blobs[index]
@@ -0,0 +1,122 @@
+from multiprocessing import get_context
+from os import getpid
+from pickle import dumps
+from queue import Empty
+from signal import Signals
+from time import monotonic
+from traceback import format_exc
+from typing import Any
+from typing import Callable
+from typing import Iterable
+
+try:
+    from os import sched_getaffinity
+    from os import sched_setaffinity
+except ImportError:
+    sched_getaffinity = None
+    sched_setaffinity = None
+
+try:
+    from resource import RLIMIT_AS
+    from resource import RUSAGE_SELF
+    from resource import getrusage
+    from resource import setrlimit
+except ImportError:
+    setrlimit = None
+
+
+class SandboxError(Exception):
+    def __init__(self, cause: str, details: str = ''):
+        super().__init__(cause)
+        self.cause = cause
+        self.details = details
+
+
+class SandboxTimeout(SandboxError):
+    pass
+
+
+class SandboxCrash(SandboxError):
+    pass
+
+
+class SandboxMemoryError(SandboxError):
+    pass
+
+
+def first_cpu() -> Iterable[int]:
+    if sched_getaffinity is None:
+        return None
+    return [min(sched_getaffinity(0))]
+
+
+def peak_memory_mb() -> float:
+    if setrlimit is None:
+        return 0.0
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_isolated(func: Callable, *args, timeout: float = None, cpu_affinity: Iterable[int] = None,
+                 memory_limit_mb: int = None, poll_interval: float = 0.1) -> Any:
+    context = get_context('spawn')
+    results = context.Queue(maxsize=1)
+    process = context.Process(target=_worker, args=(results, func, args, cpu_affinity, memory_limit_mb))
+    process.start()
+
+    deadline = monotonic() + timeout if timeout else None
+    try:
+        while True:
+            try:
+                status, value = results.get(timeout=poll_interval)
+                break
+            except Empty:
+                if not process.is_alive():
+                    try:
+                        status, value = results.get(timeout=poll_interval)
+                        break
+                    except Empty:
+                        raise SandboxCrash(_describe_exit(process.exitcode))
+                if deadline is not None and monotonic() > deadline:
+                    raise SandboxTimeout('timed out after {}s'.format(timeout))
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+    if status == 'memory':
+        raise SandboxMemoryError('memory limit of {} MB exceeded'.format(memory_limit_mb), value)
+    if status == 'error':
+        raise SandboxError(*value)
+    return value
+
+
+def _worker(results, func: Callable, args: tuple, cpu_affinity: Iterable[int], memory_limit_mb: int):
+    if cpu_affinity is not None and sched_setaffinity is not None:
+        sched_setaffinity(getpid(), cpu_affinity)
+
+    if memory_limit_mb is not None and setrlimit is not None:
+        limit = memory_limit_mb * 1024 * 1024
+        setrlimit(RLIMIT_AS, (limit, limit))
+
+    try:
+        result = ('ok', func(*args))
+    except MemoryError:
+        result = ('memory', format_exc())
+    except Exception as ex:
+        result = ('error', ('{}: {}'.format(type(ex).__name__, ex), format_exc()))
+
+    try:
+        dumps(result)
+    except Exception as ex:
+        result = ('error', ('unable to return result: {}'.format(ex), format_exc()))
+
+    results.put(result)
+
+
+def _describe_exit(exitcode: int) -> str:
+    if exitcode is not None and exitcode < 0:
+        try:
+            return 'crashed with {}'.format(Signals(-exitcode).name)
+        except ValueError:
+            return 'crashed with signal {}'.format(-exitcode)
+    return 'exited with code {} without a result'.format(exitcode)
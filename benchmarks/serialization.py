@@ -1,28 +1,88 @@
 from abc import ABC
 from base64 import b64decode
 from base64 import b64encode
+from bz2 import compress as bz2_compress
+from bz2 import decompress as bz2_decompress
+from collections import OrderedDict
 from contextlib import closing
+from contextlib import contextmanager
 from copy import deepcopy
+from io import BytesIO
 from itertools import groupby
+from itertools import islice
 from json import dumps
 from json import loads
+from lzma import compress as lzma_compress
+from lzma import decompress as lzma_decompress
 from operator import itemgetter
+from os.path import getsize
 from shutil import copyfileobj
+from sqlite3 import Connection as SqliteConnection
 from sqlite3 import IntegrityError
 from sqlite3 import Row as SqliteRow
 from sqlite3 import connect as sqlite_connect
+from struct import pack
+from struct import unpack
+from struct import unpack_from
 from tempfile import NamedTemporaryFile
 from typing import IO
 from typing import Iterable
+from typing import Optional
+from urllib.request import pathname2url
+from zlib import compress as zlib_compress
+from zlib import decompress as zlib_decompress
 
 from bson import BSON
 from cbor import dump as cbor_dump
-from cbor import load as cbor_load
+from cbor import dumps as cbor_dumps
+from cbor import loads as cbor_loads
 from fastavro import parse_schema as avro_parse_schema
 from fastavro import reader as avro_reader
 from fastavro import writer as avro_writer
+from msgpack import OutOfData
 from msgpack import Packer
 from msgpack import Unpacker
+from zstandard import ZstdCompressor
+from zstandard import ZstdDecompressor
+
+from benchmarks.utils import local_path
+
+AVRO_SYNC_SIZE = 16
+AVRO_BLOCK_CODECS = ('deflate', 'snappy', 'zstandard', 'lz4', 'bzip2', 'xz')
+AVRO_SYNC_INTERVALS = (1000 * AVRO_SYNC_SIZE, 16000 * AVRO_SYNC_SIZE)
+
+CBOR_MAJOR_BYTES = 2
+CBOR_MAJOR_TEXT = 3
+CBOR_MAJOR_ARRAY = 4
+CBOR_MAJOR_MAP = 5
+CBOR_MAJOR_TAG = 6
+CBOR_MAJOR_SIMPLE = 7
+CBOR_ARGUMENT_SIZES = {24: 1, 25: 2, 26: 4, 27: 8}
+CBOR_INFO_BREAK = 31
+CBOR_MAX_HEAD_SIZE = 9
+
+BSON_FIXED_SIZES = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16,
+                    0x7F: 0, 0xFF: 0}
+BSON_LENGTH_PREFIXED = {0x02: 4, 0x03: 0, 0x04: 0, 0x05: 5, 0x0D: 4, 0x0E: 4, 0x0F: 0}
+
+try:
+    BSON.decode(memoryview(BSON.encode({})))
+except TypeError:
+    # pymongo before 3.9 only decodes bytes objects
+    BSON_DECODES_BUFFERS = False
+else:
+    BSON_DECODES_BUFFERS = True
+
+FRAME_CHUNK_SIZE = 2 * 1024
+
+COLUMN_CODECS = {
+    'none': (bytes, bytes),
+    'zlib': (lambda data: zlib_compress(data, 9), zlib_decompress),
+    'bz2': (bz2_compress, bz2_decompress),
+    'lzma': (lzma_compress, lzma_decompress),
+    'zstd': (lambda data: ZstdCompressor(level=19).compress(data),
+             lambda data: ZstdDecompressor().decompress(data)),
+}
 
 
 class _Serialization(ABC):
@@ -33,7 +93,7 @@ class _Serialization(ABC):
     def serialize(self, objs: Iterable[dict], fobj: IO[bytes]):
         raise NotImplementedError
 
-    def deserialize(self, fobj: IO[bytes]) -> Iterable[dict]:
+    def deserialize(self, fobj: IO[bytes], *, fields: Iterable[str] = None) -> Iterable[dict]:
         raise NotImplementedError
 
 
@@ -50,75 +110,232 @@ class JsonLinesSerialization(_Serialization):
             fobj.write(b'\n')
 
     @classmethod
-    def deserialize(cls, fobj: IO[bytes]) -> Iterable[dict]:
+    def deserialize(cls, fobj: IO[bytes], *, fields: Iterable[str] = None) -> Iterable[dict]:
+        fields = _fieldset(fields)
         for line in fobj:
-            yield loads(line.decode(cls.encoding))
+            yield _project(loads(line.decode(cls.encoding)), fields)
 
 
 class CborSerialization(_Serialization):
-    extension = '.cbor'
+    def __init__(self, compact_keys: bool = False):
+        self.key_table = KeyTable() if compact_keys else None
 
-    @classmethod
-    def serialize(cls, objs: Iterable[dict], fobj: IO[bytes]):
+    @property
+    def extension(self) -> str:
+        return '.keys.cbor' if self.key_table else '.cbor'
+
+    def serialize(self, objs: Iterable[dict], fobj: IO[bytes]):
+        if self.key_table:
+            cbor_dump(self.key_table.header, fobj)
         for obj in objs:
             obj = byteify_attachments(obj)
+            if self.key_table:
+                obj = self.key_table.compact(obj)
             cbor_dump(obj, fobj)
 
-    @classmethod
-    def deserialize(cls, fobj: IO[bytes]) -> Iterable[dict]:
-        while True:
-            try:
-                obj = cbor_load(fobj)
-            except EOFError:
-                break
+    def deserialize(self, fobj: IO[bytes], *, fields: Iterable[str] = None) -> Iterable[dict]:
+        fields = _fieldset(fields)
+        items = self._read_items(fobj)
+        if self.key_table:
+            self.key_table.check_header(cbor_loads(next(items)))
+        keys = self.key_table.compact_fields(fields) if self.key_table and fields is not None else fields
+        encoded_keys = {cbor_dumps(key): key for key in keys} if keys is not None else None
+        for item in items:
+            if encoded_keys is None:
+                obj = cbor_loads(item)
             else:
-                obj = unbyteify_attachments(obj)
-                yield obj
+                obj = self._load_projected(item, encoded_keys)
+            if self.key_table:
+                obj = self.key_table.expand(obj)
+            obj = unbyteify_attachments(obj)
+            yield obj
+
+    @classmethod
+    def _read_items(cls, fobj: IO[bytes]) -> Iterable[bytearray]:
+        # cbor decodes the first item of a buffer and ignores the rest, so each item is moved to the
+        # front of the frame buffer and decoded in place instead of being copied out
+        reader = _FrameReader(fobj)
+        while reader.fill(1):
+            reader.compact()
+            end = _cbor_item_end(reader.buffer, 0, reader.end)
+            while end < 0:
+                if not reader.read_more():
+                    raise EOFError('Unexpected end of stream')
+                end = _cbor_item_end(reader.buffer, 0, reader.end)
+            yield reader.buffer
+            reader.take(end)
+
+    @classmethod
+    def _load_projected(cls, item: bytearray, encoded_keys: dict) -> dict:
+        head = BytesIO(item[:CBOR_MAX_HEAD_SIZE])
+        major, info = _read_cbor_head(head)
+        if major != CBOR_MAJOR_MAP:
+            raise ValueError('Expected a CBOR map, got major type {}'.format(major))
+
+        num_keys = _read_cbor_length(head, info)
+        if num_keys is None:
+            raise ValueError('Indefinite-length CBOR maps are not supported')
+
+        obj = {}
+        position = head.tell()
+        for _ in range(num_keys):
+            key_end = _cbor_item_end(item, position, len(item))
+            value_end = _cbor_item_end(item, key_end, len(item))
+            key = encoded_keys.get(bytes(item[position:key_end]))
+            if key is not None:
+                obj[key] = cbor_loads(item[key_end:value_end])
+            position = value_end
+        return obj
 
 
 class BsonLinesSerialization(_Serialization):
-    extension = '.bsonl'
+    def __init__(self, compact_keys: bool = False):
+        self.key_table = KeyTable(stringify=True) if compact_keys else None
 
-    @classmethod
-    def serialize(cls, objs: Iterable[dict], fobj: IO[bytes]):
+    @property
+    def extension(self) -> str:
+        return '.keys.bsonl' if self.key_table else '.bsonl'
+
+    def serialize(self, objs: Iterable[dict], fobj: IO[bytes]):
+        if self.key_table:
+            fobj.write(BSON.encode(self.key_table.header))
+            fobj.write(b'\n')
         for obj in objs:
             obj = byteify_attachments(obj)
+            if self.key_table:
+                obj = self.key_table.compact(obj)
             fobj.write(BSON.encode(obj))
             fobj.write(b'\n')
 
-    @classmethod
-    def deserialize(cls, fobj: IO[bytes]) -> Iterable[dict]:
-        for line in fobj:
+    def deserialize(self, fobj: IO[bytes], *, fields: Iterable[str] = None) -> Iterable[dict]:
+        fields = _fieldset(fields)
+        documents = self._read_documents(fobj)
+        if self.key_table:
+            # noinspection PyCallByClass,PyTypeChecker
+            self.key_table.check_header(BSON.decode(next(documents)))
+        if fields is not None:
+            keys = self.key_table.compact_fields(fields) if self.key_table else fields
+            names = frozenset(key.encode('utf-8') for key in keys)
+            documents = (self._project_document(bytes(document), names) for document in documents)
+        for document in documents:
             # noinspection PyCallByClass,PyTypeChecker
-            obj = BSON.decode(line.rstrip(b'\n'))
+            obj = BSON.decode(document)
+            if self.key_table:
+                obj = self.key_table.expand(obj)
             # noinspection PyTypeChecker
-            obj = unbyteify_attachments(obj)
+            obj = unbyteify_attachments(_project(obj, fields))
             yield obj
 
+    @classmethod
+    def _read_documents(cls, fobj: IO[bytes]) -> Iterable[bytes]:
+        if not BSON_DECODES_BUFFERS:
+            # framing into a shared buffer only pays off when documents can be decoded without a copy
+            yield from cls._read_document_copies(fobj)
+            return
 
-class MsgpackSerialization(_Serialization):
-    extension = '.msgpack'
+        reader = _FrameReader(fobj)
+        while reader.fill(4):
+            size, = unpack_from('<i', reader.buffer, reader.start)
+            if not reader.fill(size + 1):
+                raise EOFError('Unexpected end of stream')
+            document = reader.take(size + 1)
+            _check_separator(document[size:])
+            yield document[:size]
 
     @classmethod
-    def serialize(cls, objs: Iterable[dict], fobj: IO[bytes]):
+    def _read_document_copies(cls, fobj: IO[bytes]) -> Iterable[bytes]:
+        while True:
+            header = fobj.read(4)
+            if not header:
+                break
+            size, = unpack('<i', header)
+            document = header + fobj.read(size - 4)
+            separator = fobj.read(1)
+            if len(document) != size or not separator:
+                raise EOFError('Unexpected end of stream')
+            _check_separator(separator)
+            yield document
+
+    @classmethod
+    def _project_document(cls, document: bytes, names: frozenset) -> bytes:
+        elements = []
+        position = 4
+        end = len(document) - 1
+        while position < end:
+            start = position
+            element_type = document[position]
+            name_end = document.index(b'\x00', position + 1)
+            position = name_end + 1
+            size = BSON_FIXED_SIZES.get(element_type)
+            if size is None:
+                if element_type not in BSON_LENGTH_PREFIXED:
+                    return document
+                size, = unpack('<i', document[position:position + 4])
+                size += BSON_LENGTH_PREFIXED[element_type]
+            position += size
+            if document[start + 1:name_end] in names:
+                elements.append(document[start:position])
+
+        body = b''.join(elements)
+        return pack('<i', len(body) + 5) + body + b'\x00'
+
+
+class MsgpackSerialization(_Serialization):
+    def __init__(self, compact_keys: bool = False):
+        self.key_table = KeyTable() if compact_keys else None
+
+    @property
+    def extension(self) -> str:
+        return '.keys.msgpack' if self.key_table else '.msgpack'
+
+    def serialize(self, objs: Iterable[dict], fobj: IO[bytes]):
         packer = Packer(use_bin_type=True)
+        if self.key_table:
+            fobj.write(packer.pack(self.key_table.header))
         for obj in objs:
             obj = byteify_attachments(obj)
+            if self.key_table:
+                obj = self.key_table.compact(obj)
             serialized = packer.pack(obj)
             fobj.write(serialized)
 
-    @classmethod
-    def deserialize(cls, fobj: IO[bytes]) -> Iterable[dict]:
+    def deserialize(self, fobj: IO[bytes], *, fields: Iterable[str] = None) -> Iterable[dict]:
+        fields = _fieldset(fields)
         unpacker = Unpacker(fobj, raw=False)
-        for obj in unpacker:
+        if self.key_table:
+            self.key_table.check_header(next(unpacker))
+        if fields is not None:
+            keys = self.key_table.compact_fields(fields) if self.key_table else fields
+            objs = self._unpack_projected(unpacker, keys)
+        else:
+            objs = unpacker
+        for obj in objs:
+            if self.key_table:
+                obj = self.key_table.expand(obj)
             obj = unbyteify_attachments(obj)
             yield obj
 
+    @classmethod
+    def _unpack_projected(cls, unpacker: Unpacker, keys: frozenset) -> Iterable[dict]:
+        while True:
+            try:
+                num_keys = unpacker.read_map_header()
+            except OutOfData:
+                break
+            obj = {}
+            for _ in range(num_keys):
+                key = unpacker.unpack()
+                if key in keys:
+                    obj[key] = unpacker.unpack()
+                else:
+                    unpacker.skip()
+            yield obj
+
 
 class AvroSerialization(_Serialization):
-    extension = '.avro'
+    default_sync_interval = 1000 * AVRO_SYNC_SIZE
 
-    schema = avro_parse_schema({
+    schema_definition = {
         "type": "record",
         "name": "Email",
         "fields": [
@@ -150,24 +367,74 @@ class AvroSerialization(_Serialization):
                 ]
              }}]}
         ]
-    })
+    }
+    schema = avro_parse_schema(schema_definition)
 
-    @classmethod
-    def serialize(cls, objs: Iterable[dict], fobj: IO[bytes]):
+    def __init__(self, codec: str = 'null', sync_interval: int = default_sync_interval):
+        self.codec = codec
+        self.sync_interval = sync_interval
+
+    @property
+    def extension(self) -> str:
+        if self.codec == 'null' and self.sync_interval == self.default_sync_interval:
+            return '.avro'
+        return '.{}.{}.avro'.format(self.codec, self.sync_interval)
+
+    def serialize(self, objs: Iterable[dict], fobj: IO[bytes]):
         objs = (byteify_attachments(obj) for obj in objs)
-        avro_writer(fobj, cls.schema, objs)
+        avro_writer(fobj, self.schema, objs, codec=self.codec, sync_interval=self.sync_interval)
 
-    @classmethod
-    def deserialize(cls, fobj: IO[bytes]) -> Iterable[dict]:
-        for obj in avro_reader(fobj):
+    def deserialize(self, fobj: IO[bytes], *, skip: int = 0, fields: Iterable[str] = None) -> Iterable[dict]:
+        fobj = _PushbackReader(fobj)
+        objs = avro_reader(fobj, reader_schema=self._reader_schema(_fieldset(fields)))
+        skip -= self._skip_blocks(fobj, skip)
+        for obj in islice(objs, skip, None):
             obj = unbyteify_attachments(obj)
             yield {key: value for (key, value) in obj.items()
                    if value is not None}
 
+    @classmethod
+    def _reader_schema(cls, fields: Optional[frozenset]) -> Optional[dict]:
+        if fields is None:
+            return None
+        definition = dict(cls.schema_definition)
+        definition['fields'] = [field for field in definition['fields'] if field['name'] in fields]
+        return avro_parse_schema(definition)
+
+    @classmethod
+    def _skip_blocks(cls, fobj: '_PushbackReader', skip: int) -> int:
+        skipped = 0
+        while True:
+            header = BytesIO()
+            try:
+                num_records = _read_avro_long(fobj, header)
+                if skipped + num_records > skip:
+                    fobj.unread(header.getvalue())
+                    break
+                block_size = _read_avro_long(fobj, header)
+            except EOFError:
+                fobj.unread(header.getvalue())
+                break
+            fobj.read(block_size + AVRO_SYNC_SIZE)
+            skipped += num_records
+        return skipped
+
+    @classmethod
+    def available_codecs(cls) -> Iterable[str]:
+        for codec in AVRO_BLOCK_CODECS:
+            try:
+                avro_writer(BytesIO(), cls.schema, [{}], codec=codec)
+            except ValueError:
+                continue
+            else:
+                yield codec
+
 
 class SqliteSerialization(_Serialization):
     extension = '.sqlite'
     separator = chr(30)
+    scalar_columns = ('_uid', 'read', 'sent_at', 'from', 'subject', 'body')
+    list_columns = ('to', 'cc', 'bcc')
 
     @classmethod
     def serialize(cls, objs: Iterable[dict], fobj: IO[bytes]):
@@ -293,42 +560,73 @@ class SqliteSerialization(_Serialization):
             copyfileobj(db_file, fobj)
 
     @classmethod
-    def deserialize(cls, fobj: IO[bytes]) -> Iterable[dict]:
-        with NamedTemporaryFile() as db_file:
-            copyfileobj(fobj, db_file)
-            db_file.seek(0)
-            with closing(sqlite_connect(db_file.name)) as connection:
+    def deserialize(cls, fobj: IO[bytes], *, fields: Iterable[str] = None) -> Iterable[dict]:
+        fields = _fieldset(fields)
+        scalar_keys = [key for key in cls.scalar_columns if fields is None or key in fields]
+        list_keys = [key for key in cls.list_columns if fields is None or key in fields]
+        with_attachments = fields is None or 'attachments' in fields
+
+        with cls._database_path(fobj) as db_path:
+            with closing(cls._connect_read_only(db_path)) as connection:
                 connection.row_factory = SqliteRow
                 with closing(connection.cursor()) as cursor:
-                    joined = cursor.execute('''
-                    SELECT emails.id AS __row_order__, *
-                    FROM emails
-                    LEFT OUTER JOIN emails_to_attachments
-                        ON emails.id = emails_to_attachments.email_id
-                    LEFT OUTER JOIN attachments
-                        ON attachments.id = emails_to_attachments.attachment_id
-                    LEFT OUTER JOIN contents
-                        ON attachments.content_id = contents.id
-                    ORDER BY __row_order__
-                    ''')
+                    columns = ''.join(', emails."{0}" AS "{0}"'.format(key) for key in scalar_keys + list_keys)
+                    if with_attachments:
+                        joined = cursor.execute('''
+                        SELECT emails.id AS __row_order__{}, filename, content, cid
+                        FROM emails
+                        LEFT OUTER JOIN emails_to_attachments
+                            ON emails.id = emails_to_attachments.email_id
+                        LEFT OUTER JOIN attachments
+                            ON attachments.id = emails_to_attachments.attachment_id
+                        LEFT OUTER JOIN contents
+                            ON attachments.content_id = contents.id
+                        ORDER BY __row_order__
+                        '''.format(columns))
+                    else:
+                        joined = cursor.execute('''
+                        SELECT emails.id AS __row_order__{}
+                        FROM emails
+                        ORDER BY __row_order__
+                        '''.format(columns))
                     for _, rows in groupby(joined, itemgetter('__row_order__')):
                         rows = list(rows)
                         row = rows[0]
-                        obj = {key: row[key] for key in ('_uid', 'read', 'sent_at', 'from', 'subject', 'body')
+                        obj = {key: row[key] for key in scalar_keys
                                if row[key] is not None}
 
-                        for key in ('to', 'cc', 'bcc'):
+                        for key in list_keys:
                             obj[key] = cls._deserialize_list(row, key)
 
-                        obj['attachments'] = []
-                        for row in rows:
-                            attachment = {key: row[key] for key in ('filename', 'content', 'cid')
-                                          if row[key] is not None}
-                            if attachment:
-                                obj['attachments'].append(attachment)
-                        obj = unbyteify_attachments(obj)
+                        if with_attachments:
+                            obj['attachments'] = []
+                            for row in rows:
+                                attachment = {key: row[key] for key in ('filename', 'content', 'cid')
+                                              if row[key] is not None}
+                                if attachment:
+                                    obj['attachments'].append(attachment)
+                            obj = unbyteify_attachments(obj)
                         yield obj
 
+    @classmethod
+    @contextmanager
+    def _database_path(cls, fobj: IO[bytes]) -> Iterable[str]:
+        path = local_path(fobj)
+        if path is not None:
+            yield path
+            return
+
+        with NamedTemporaryFile() as db_file:
+            copyfileobj(fobj, db_file)
+            db_file.flush()
+            yield db_file.name
+
+    @classmethod
+    def _connect_read_only(cls, path: str) -> SqliteConnection:
+        connection = sqlite_connect('file:{}?mode=ro&immutable=1'.format(pathname2url(path)), uri=True)
+        connection.execute('PRAGMA mmap_size = {}'.format(getsize(path)))
+        return connection
+
     @classmethod
     def _serialize_list(cls, obj, key):
         try:
@@ -344,6 +642,763 @@ class SqliteSerialization(_Serialization):
         return value.split(cls.separator)
 
 
+class CompactBinarySerialization(_Serialization):
+    extension = '.bin'
+    magic = b'LKB\x01'
+    encoding = 'utf-8'
+
+    flag_read = 1 << 0
+    flag_has_read = 1 << 1
+    flag_attachments = 1 << 2
+    flag_extra = 1 << 3
+    string_flags = (
+        ('sent_at', 1 << 4),
+        ('subject', 1 << 5),
+        ('body', 1 << 6),
+        ('_uid', 1 << 7),
+    )
+    address_flags = (
+        ('from', 1 << 8),
+    )
+    address_list_flags = (
+        ('to', 1 << 9),
+        ('cc', 1 << 10),
+        ('bcc', 1 << 11),
+    )
+
+    attachment_flag_cid = 1 << 0
+    attachment_flag_extra = 1 << 1
+
+    def serialize(self, objs: Iterable[dict], fobj: IO[bytes]):
+        addresses = {}
+        fobj.write(self.magic)
+        for obj in objs:
+            buffer = bytearray()
+            self._write_email(buffer, obj, addresses)
+            fobj.write(buffer)
+
+    def deserialize(self, fobj: IO[bytes], *, fields: Iterable[str] = None) -> Iterable[dict]:
+        fields = _fieldset(fields)
+        reader = _ByteReader(fobj)
+        if reader.read(len(self.magic)) != self.magic:
+            raise ValueError('Not a compact binary email stream')
+        addresses = []
+        while not reader.at_eof():
+            yield self._read_email(reader, addresses, fields)
+
+    def _write_email(self, buffer: bytearray, obj: dict, addresses: dict):
+        extra = dict(obj)
+        flags = 0
+
+        read = extra.pop('read', None)
+        if isinstance(read, bool):
+            flags |= self.flag_has_read | (self.flag_read if read else 0)
+        elif 'read' in obj:
+            extra['read'] = read
+
+        strings = []
+        for key, flag in self.string_flags:
+            value = extra.pop(key, None)
+            if isinstance(value, str):
+                flags |= flag
+                strings.append(value)
+            elif key in obj:
+                extra[key] = value
+
+        address_values = []
+        for key, flag in self.address_flags:
+            value = extra.pop(key, None)
+            if isinstance(value, str):
+                flags |= flag
+                address_values.append(value)
+            elif key in obj:
+                extra[key] = value
+
+        address_lists = []
+        for key, flag in self.address_list_flags:
+            value = extra.pop(key, None)
+            if isinstance(value, list) and all(isinstance(item, str) for item in value):
+                flags |= flag
+                address_lists.append(value)
+            elif key in obj:
+                extra[key] = value
+
+        attachments = extra.pop('attachments', None)
+        if isinstance(attachments, list):
+            flags |= self.flag_attachments
+        elif 'attachments' in obj:
+            extra['attachments'] = attachments
+
+        if extra:
+            flags |= self.flag_extra
+
+        _write_varint(buffer, flags)
+
+        for value in strings:
+            self._write_string(buffer, value)
+
+        for value in address_values:
+            self._write_address(buffer, value, addresses)
+
+        for values in address_lists:
+            _write_varint(buffer, len(values))
+            for value in values:
+                self._write_address(buffer, value, addresses)
+
+        if flags & self.flag_attachments:
+            _write_varint(buffer, len(attachments))
+            for attachment in attachments:
+                self._write_attachment(buffer, attachment)
+
+        if flags & self.flag_extra:
+            self._write_string(buffer, dumps(extra, separators=(',', ':')))
+
+    def _read_email(self, reader: '_ByteReader', addresses: list, fields: frozenset = None) -> dict:
+        obj = {}
+        flags = reader.varint()
+
+        if flags & self.flag_has_read:
+            obj['read'] = bool(flags & self.flag_read)
+
+        for key, flag in self.string_flags:
+            if flags & flag:
+                if fields is None or key in fields:
+                    obj[key] = reader.string(self.encoding)
+                else:
+                    reader.skip(reader.varint())
+
+        for key, flag in self.address_flags:
+            if flags & flag:
+                obj[key] = self._read_address(reader, addresses)
+
+        for key, flag in self.address_list_flags:
+            if flags & flag:
+                obj[key] = [self._read_address(reader, addresses)
+                            for _ in range(reader.varint())]
+
+        if flags & self.flag_attachments:
+            if fields is None or 'attachments' in fields:
+                obj['attachments'] = [self._read_attachment(reader)
+                                      for _ in range(reader.varint())]
+            else:
+                for _ in range(reader.varint()):
+                    self._skip_attachment(reader)
+
+        if flags & self.flag_extra:
+            obj.update(loads(reader.string(self.encoding)))
+
+        return _project(obj, fields)
+
+    def _write_attachment(self, buffer: bytearray, attachment: dict):
+        extra = dict(attachment)
+        filename = extra.pop('filename')
+        content = b64decode(extra.pop('content'))
+        cid = extra.pop('cid', None)
+
+        flags = 0
+        if isinstance(cid, str):
+            flags |= self.attachment_flag_cid
+        elif 'cid' in attachment:
+            extra['cid'] = cid
+        if extra:
+            flags |= self.attachment_flag_extra
+
+        _write_varint(buffer, flags)
+        self._write_string(buffer, filename)
+        _write_varint(buffer, len(content))
+        buffer += content
+        if flags & self.attachment_flag_cid:
+            self._write_string(buffer, cid)
+        if flags & self.attachment_flag_extra:
+            self._write_string(buffer, dumps(extra, separators=(',', ':')))
+
+    def _read_attachment(self, reader: '_ByteReader') -> dict:
+        flags = reader.varint()
+        attachment = {
+            'filename': reader.string(self.encoding),
+            'content': b64encode(reader.read(reader.varint())).decode('ascii'),
+        }
+        if flags & self.attachment_flag_cid:
+            attachment['cid'] = reader.string(self.encoding)
+        if flags & self.attachment_flag_extra:
+            attachment.update(loads(reader.string(self.encoding)))
+        return attachment
+
+    def _skip_attachment(self, reader: '_ByteReader'):
+        flags = reader.varint()
+        reader.skip(reader.varint())
+        reader.skip(reader.varint())
+        if flags & self.attachment_flag_cid:
+            reader.skip(reader.varint())
+        if flags & self.attachment_flag_extra:
+            reader.skip(reader.varint())
+
+    @classmethod
+    def _write_string(cls, buffer: bytearray, value: str):
+        encoded = value.encode(cls.encoding)
+        _write_varint(buffer, len(encoded))
+        buffer += encoded
+
+    @classmethod
+    def _write_address(cls, buffer: bytearray, value: str, addresses: dict):
+        try:
+            _write_varint(buffer, addresses[value] + 1)
+        except KeyError:
+            addresses[value] = len(addresses)
+            _write_varint(buffer, 0)
+            cls._write_string(buffer, value)
+
+    @classmethod
+    def _read_address(cls, reader: '_ByteReader', addresses: list) -> str:
+        index = reader.varint()
+        if index:
+            return addresses[index - 1]
+        value = reader.string(cls.encoding)
+        addresses.append(value)
+        return value
+
+
+class ColumnarSerialization(_Serialization):
+    magic = b'LKC\x01'
+    encoding = 'utf-8'
+
+    string_fields = ('sent_at', 'from', 'subject', 'body', '_uid')
+    list_fields = ('to', 'cc', 'bcc')
+    column_names = (
+        ('read',)
+        + string_fields
+        + tuple(name for key in list_fields for name in (key, key + '.values'))
+        + ('attachments', 'attachments.filename', 'attachments.content', 'attachments.cid', 'attachments.extra')
+        + ('extra',)
+    )
+
+    def __init__(self, codec: str = 'none', codecs: dict = None):
+        self.codec = codec
+        self.codecs = codecs or {}
+
+    @property
+    def extension(self) -> str:
+        if self.codec == 'none':
+            return '.columns'
+        return '.{}.columns'.format(self.codec)
+
+    def serialize(self, objs: Iterable[dict], fobj: IO[bytes]):
+        columns = OrderedDict((name, _ColumnWriter()) for name in self.column_names)
+
+        num_objs = 0
+        for obj in objs:
+            num_objs += 1
+            extra = dict(obj)
+
+            read = extra.pop('read', None)
+            if isinstance(read, bool):
+                columns['read'].append_count(int(read) + 1)
+            else:
+                columns['read'].append_count(0)
+                if 'read' in obj:
+                    extra['read'] = read
+
+            for key in self.string_fields:
+                value = extra.pop(key, None)
+                if isinstance(value, str):
+                    columns[key].append(value.encode(self.encoding))
+                else:
+                    columns[key].append(None)
+                    if key in obj:
+                        extra[key] = value
+
+            for key in self.list_fields:
+                values = extra.pop(key, None)
+                if isinstance(values, list) and all(isinstance(value, str) for value in values):
+                    columns[key].append_count(len(values) + 1)
+                    for value in values:
+                        columns[key + '.values'].append(value.encode(self.encoding))
+                else:
+                    columns[key].append_count(0)
+                    if key in obj:
+                        extra[key] = values
+
+            attachments = extra.pop('attachments', None)
+            if isinstance(attachments, list):
+                columns['attachments'].append_count(len(attachments) + 1)
+                for attachment in attachments:
+                    self._write_attachment(attachment, columns)
+            else:
+                columns['attachments'].append_count(0)
+                if 'attachments' in obj:
+                    extra['attachments'] = attachments
+
+            if extra:
+                columns['extra'].append(dumps(extra, separators=(',', ':')).encode(self.encoding))
+            else:
+                columns['extra'].append(None)
+
+        header = bytearray(self.magic)
+        _write_varint(header, num_objs)
+        _write_varint(header, len(columns))
+        payloads = []
+        for name, writer in columns.items():
+            codec = self.codecs.get(name, self.codec)
+            compress, _ = COLUMN_CODECS[codec]
+            payload = compress(writer.getvalue())
+            payloads.append(payload)
+            for value in (name, codec):
+                encoded = value.encode(self.encoding)
+                _write_varint(header, len(encoded))
+                header += encoded
+            _write_varint(header, len(payload))
+
+        fobj.write(header)
+        for payload in payloads:
+            fobj.write(payload)
+
+    def deserialize(self, fobj: IO[bytes], *, fields: Iterable[str] = None) -> Iterable[dict]:
+        fields = _fieldset(fields)
+
+        reader = _ByteReader(fobj)
+        if reader.read(len(self.magic)) != self.magic:
+            raise ValueError('Not a columnar email stream')
+        num_objs = reader.varint()
+        segments = [(reader.string(self.encoding), reader.string(self.encoding), reader.varint())
+                    for _ in range(reader.varint())]
+
+        columns = {}
+        for name, codec, size in segments:
+            if fields is None or name == 'extra' or name.split('.')[0] in fields:
+                _, decompress = COLUMN_CODECS[codec]
+                columns[name] = _ColumnReader(decompress(reader.read(size)))
+            else:
+                reader.skip(size)
+
+        for _ in range(num_objs):
+            obj = {}
+
+            if 'read' in columns:
+                read = columns['read'].next_count()
+                if read:
+                    obj['read'] = bool(read - 1)
+
+            for key in self.string_fields:
+                if key in columns:
+                    value = columns[key].next()
+                    if value is not None:
+                        obj[key] = value.decode(self.encoding)
+
+            for key in self.list_fields:
+                if key in columns:
+                    count = columns[key].next_count()
+                    if count:
+                        values = columns[key + '.values']
+                        obj[key] = [values.next().decode(self.encoding) for _ in range(count - 1)]
+
+            if 'attachments' in columns:
+                count = columns['attachments'].next_count()
+                if count:
+                    obj['attachments'] = [self._read_attachment(columns) for _ in range(count - 1)]
+
+            if 'extra' in columns:
+                extra = columns['extra'].next()
+                if extra is not None:
+                    obj.update(loads(extra.decode(self.encoding)))
+
+            yield _project(obj, fields)
+
+    def _write_attachment(self, attachment: dict, columns: dict):
+        extra = dict(attachment)
+        columns['attachments.filename'].append(extra.pop('filename').encode(self.encoding))
+        columns['attachments.content'].append(b64decode(extra.pop('content')))
+        cid = extra.pop('cid', None)
+        if isinstance(cid, str):
+            columns['attachments.cid'].append(cid.encode(self.encoding))
+        else:
+            columns['attachments.cid'].append(None)
+            if 'cid' in attachment:
+                extra['cid'] = cid
+        if extra:
+            columns['attachments.extra'].append(dumps(extra, separators=(',', ':')).encode(self.encoding))
+        else:
+            columns['attachments.extra'].append(None)
+
+    def _read_attachment(self, columns: dict) -> dict:
+        attachment = {
+            'filename': columns['attachments.filename'].next().decode(self.encoding),
+            'content': b64encode(columns['attachments.content'].next()).decode('ascii'),
+        }
+        cid = columns['attachments.cid'].next()
+        if cid is not None:
+            attachment['cid'] = cid.decode(self.encoding)
+        extra = columns['attachments.extra'].next()
+        if extra is not None:
+            attachment.update(loads(extra.decode(self.encoding)))
+        return attachment
+
+
+class KeyTable:
+    version = 1
+    escape = '~'
+
+    email_keys = ('to', 'cc', 'bcc', 'from', 'subject', 'body', 'sent_at', '_uid', 'read', 'attachments')
+    attachment_keys = ('filename', 'content', 'cid')
+
+    def __init__(self, stringify: bool = False):
+        self.stringify = stringify
+        self._email_codes = self._make_codes(self.email_keys)
+        self._email_names = {code: key for (key, code) in self._email_codes.items()}
+        self._attachment_codes = self._make_codes(self.attachment_keys)
+        self._attachment_names = {code: key for (key, code) in self._attachment_codes.items()}
+        self._attachments_code = self._email_codes['attachments']
+
+    @property
+    def header(self) -> dict:
+        return {'keytable': self.version}
+
+    def check_header(self, header: dict):
+        if header != self.header:
+            raise ValueError('Unsupported key table header {}'.format(header))
+
+    def compact_fields(self, fields: Iterable[str]) -> frozenset:
+        return frozenset(self._encode_key(key, self._email_codes) for key in fields)
+
+    def compact(self, obj: dict) -> dict:
+        obj = self._rename(obj, self._encode_key, self._email_codes)
+        attachments = obj.get(self._attachments_code)
+        if attachments:
+            obj[self._attachments_code] = [
+                self._rename(attachment, self._encode_key, self._attachment_codes)
+                for attachment in attachments]
+        return obj
+
+    def expand(self, obj: dict) -> dict:
+        obj = self._rename(obj, self._decode_key, self._email_names)
+        attachments = obj.get('attachments')
+        if attachments:
+            obj['attachments'] = [
+                self._rename(attachment, self._decode_key, self._attachment_names)
+                for attachment in attachments]
+        return obj
+
+    def _make_codes(self, keys):
+        return {key: str(code) if self.stringify else code
+                for (code, key) in enumerate(keys)}
+
+    def _encode_key(self, key, codes):
+        try:
+            return codes[key]
+        except KeyError:
+            pass
+        if self.stringify and (key.isdigit() or key.startswith(self.escape)):
+            return self.escape + key
+        return key
+
+    def _decode_key(self, key, names):
+        try:
+            return names[key]
+        except KeyError:
+            pass
+        if self.stringify and key.startswith(self.escape):
+            return key[len(self.escape):]
+        return key
+
+    @classmethod
+    def _rename(cls, obj, rename, table):
+        return {rename(key, table): value for (key, value) in obj.items()}
+
+
+class _PushbackReader:
+    def __init__(self, fobj: IO[bytes]):
+        self._fobj = fobj
+        self._pending = b''
+
+    def unread(self, data: bytes):
+        self._pending = data + self._pending
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._pending:
+            return self._fobj.read(size)
+        if size < 0:
+            data, self._pending = self._pending + self._fobj.read(), b''
+            return data
+        data, self._pending = self._pending[:size], self._pending[size:]
+        if len(data) < size:
+            data += self._fobj.read(size - len(data))
+        return data
+
+
+def _check_separator(separator: bytes):
+    if separator != b'\n':
+        raise ValueError('Expected a newline after the BSON document, got {!r}'.format(bytes(separator)))
+
+
+class _FrameReader:
+    def __init__(self, fobj: IO[bytes], chunk_size: int = FRAME_CHUNK_SIZE):
+        self._fobj = fobj
+        self._chunk_size = chunk_size
+        self._readinto = getattr(fobj, 'readinto', None) or self._read_into
+        # room for one chunk of unconsumed bytes plus the next chunk, so steady-state reads only compact
+        self.buffer = bytearray(2 * chunk_size)
+        self._view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def fill(self, size: int) -> bool:
+        while self.end - self.start < size:
+            if not self.read_more(size):
+                return False
+        return True
+
+    def read_more(self, size: int = 0) -> bool:
+        if self.end == len(self.buffer) or self.start + size > len(self.buffer):
+            self.compact()
+            if self.end == len(self.buffer) or size > len(self.buffer):
+                # only a frame that does not fit at all grows the buffer, and only to the next whole chunk
+                capacity = max(size, self.end + 1)
+                buffer = bytearray(-(-capacity // self._chunk_size) * self._chunk_size)
+                buffer[:self.end] = self._view[:self.end]
+                self.buffer, self._view = buffer, memoryview(buffer)
+
+        count = self._readinto(self._view[self.end:])
+        if not count:
+            return False
+        self.end += count
+        return True
+
+    def compact(self):
+        if self.start:
+            available = self.end - self.start
+            self._view[:available] = self._view[self.start:self.end]
+            self.start, self.end = 0, available
+
+    def take(self, size: int) -> memoryview:
+        start = self.start
+        self.start += size
+        return self._view[start:self.start]
+
+    def _read_into(self, view: memoryview) -> int:
+        data = self._fobj.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+
+def _read_avro_long(fobj: IO[bytes], consumed: IO[bytes]) -> int:
+    value = 0
+    shift = 0
+    while True:
+        byte = fobj.read(1)
+        if not byte:
+            raise EOFError
+        consumed.write(byte)
+        value |= (byte[0] & 0x7f) << shift
+        shift += 7
+        if not byte[0] & 0x80:
+            return (value >> 1) ^ -(value & 1)
+
+
+class _ByteReader:
+    def __init__(self, fobj: IO[bytes], chunk_size: int = 65536):
+        self._fobj = fobj
+        self._chunk_size = chunk_size
+        self._buffer = b''
+        self._position = 0
+
+    def _fill(self, size: int) -> bool:
+        available = len(self._buffer) - self._position
+        if available >= size:
+            return True
+        chunks = [self._buffer[self._position:]]
+        while available < size:
+            chunk = self._fobj.read(max(self._chunk_size, size - available))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            available += len(chunk)
+        self._buffer = b''.join(chunks)
+        self._position = 0
+        return available >= size
+
+    def at_eof(self) -> bool:
+        return not self._fill(1)
+
+    def read(self, size: int) -> bytes:
+        if not self._fill(size):
+            raise EOFError('Unexpected end of stream')
+        start = self._position
+        self._position += size
+        return self._buffer[start:self._position]
+
+    def varint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            if self._position >= len(self._buffer) and not self._fill(1):
+                raise EOFError('Unexpected end of stream')
+            byte = self._buffer[self._position]
+            self._position += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def string(self, encoding: str) -> str:
+        return self.read(self.varint()).decode(encoding)
+
+    def skip(self, size: int):
+        available = len(self._buffer) - self._position
+        if size <= available:
+            self._position += size
+            return
+        self._buffer = b''
+        self._position = 0
+        size -= available
+        while size > 0:
+            chunk = self._fobj.read(min(size, self._chunk_size))
+            if not chunk:
+                raise EOFError('Unexpected end of stream')
+            size -= len(chunk)
+
+
+class _ColumnWriter:
+    def __init__(self):
+        self._lengths = bytearray()
+        self._values = bytearray()
+
+    def append(self, value: Optional[bytes]):
+        if value is None:
+            _write_varint(self._lengths, 0)
+        else:
+            _write_varint(self._lengths, len(value) + 1)
+            self._values += value
+
+    def append_count(self, count: int):
+        _write_varint(self._lengths, count)
+
+    def getvalue(self) -> bytes:
+        header = bytearray()
+        _write_varint(header, len(self._lengths))
+        return bytes(header + self._lengths + self._values)
+
+
+class _ColumnReader:
+    def __init__(self, payload: bytes):
+        self._payload = memoryview(payload)
+        self._position = 0
+        lengths_size = self._varint()
+        self._lengths_end = self._position + lengths_size
+        self._values_position = self._lengths_end
+
+    def _varint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            byte = self._payload[self._position]
+            self._position += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+    def next_count(self) -> int:
+        return self._varint()
+
+    def next(self) -> Optional[bytes]:
+        length = self._varint()
+        if not length:
+            return None
+        start = self._values_position
+        self._values_position += length - 1
+        return self._payload[start:self._values_position].tobytes()
+
+
+def _read_cbor_head(fobj: IO[bytes]) -> tuple:
+    head = fobj.read(1)
+    if not head:
+        raise EOFError
+    return head[0] >> 5, head[0] & 0x1f
+
+
+def _read_cbor_length(fobj: IO[bytes], info: int) -> Optional[int]:
+    if info < 24:
+        return info
+    if info == 31:
+        return None
+    size = CBOR_ARGUMENT_SIZES.get(info)
+    if size is None:
+        raise ValueError('Invalid CBOR additional information {}'.format(info))
+    return int.from_bytes(fobj.read(size), 'big')
+
+
+def _cbor_item_end(buffer: bytearray, position: int, end: int) -> int:
+    parents = []
+    count = 1
+    while True:
+        if position >= end:
+            return -1
+        head = buffer[position]
+        position += 1
+        major = head >> 5
+        info = head & 0x1f
+
+        if info < 24:
+            length = info
+        elif info < 28:
+            size = 1 << (info - 24)
+            if position + size > end:
+                return -1
+            length = int.from_bytes(buffer[position:position + size], 'big')
+            position += size
+        elif info == CBOR_INFO_BREAK:
+            length = None
+        else:
+            raise ValueError('Invalid CBOR additional information {}'.format(info))
+
+        if length is None:
+            if major == CBOR_MAJOR_SIMPLE:
+                if count is not None:
+                    raise ValueError('Unexpected CBOR break')
+                count = parents.pop()
+            elif CBOR_MAJOR_BYTES <= major <= CBOR_MAJOR_MAP:
+                parents.append(count)
+                count = None
+                continue
+            else:
+                raise ValueError('Invalid indefinite length for CBOR major type {}'.format(major))
+        elif major == CBOR_MAJOR_TEXT or major == CBOR_MAJOR_BYTES:
+            position += length
+        elif major == CBOR_MAJOR_MAP or major == CBOR_MAJOR_ARRAY:
+            if length:
+                parents.append(count)
+                count = length * 2 if major == CBOR_MAJOR_MAP else length
+                continue
+        elif major == CBOR_MAJOR_TAG:
+            parents.append(count)
+            count = 1
+            continue
+
+        while count is not None:
+            count -= 1
+            if count:
+                break
+            if not parents:
+                return position if position <= end else -1
+            count = parents.pop()
+
+
+def _fieldset(fields: Optional[Iterable[str]]) -> Optional[frozenset]:
+    return frozenset(fields) if fields is not None else None
+
+
+def _project(obj: dict, fields: Optional[frozenset]) -> dict:
+    if fields is None:
+        return obj
+    return {key: value for (key, value) in obj.items() if key in fields}
+
+
+def _write_varint(buffer: bytearray, value: int):
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
 def byteify_attachments(obj: dict) -> dict:
     if not obj.get('attachments'):
         return obj
@@ -370,12 +1425,28 @@ def unbyteify_attachments(obj: dict) -> dict:
     return obj
 
 
-def get_all() -> Iterable[_Serialization]:
-    return (
+def get_all(variants: bool = False) -> Iterable[_Serialization]:
+    serializers = (
         JsonLinesSerialization(),
         CborSerialization(),
         BsonLinesSerialization(),
         MsgpackSerialization(),
         AvroSerialization(),
         SqliteSerialization(),
+        CompactBinarySerialization(),
+        ColumnarSerialization(),
+    )
+    if not variants:
+        return serializers
+
+    return serializers + (
+        CborSerialization(compact_keys=True),
+        BsonLinesSerialization(compact_keys=True),
+        MsgpackSerialization(compact_keys=True),
+        *(AvroSerialization(codec, sync_interval)
+          for codec in AvroSerialization.available_codecs()
+          for sync_interval in AVRO_SYNC_INTERVALS),
+        ColumnarSerialization(codec='zlib'),
+        ColumnarSerialization(codec='lzma'),
+        ColumnarSerialization(codec='zstd'),
     )
@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from json import dump
+from json import dumps
+from json import load
+from os import cpu_count
+from os import makedirs
+from os.path import join
+from typing import IO
+from typing import Iterable
+from typing import List
+
+from benchmarks.compression import _Compression
+from benchmarks.encryption import _Encryption
+from benchmarks.pipeline import reader_chain
+from benchmarks.pipeline import writer_chain
+from benchmarks.preprocessing import _Preprocessing
+from benchmarks.serialization import _Serialization
+from benchmarks.utils import CountingWriter
+
+MANIFEST_NAME = 'manifest.json'
+DIGEST_CHUNK_SIZE = 64 * 1024
+
+
+class ShardedOutput:
+    def __init__(self, num_shards: int = 0, max_shard_bytes: int = 0, workers: int = None):
+        if bool(num_shards) == bool(max_shard_bytes):
+            raise ValueError('Expected either a shard count or a maximum shard size')
+
+        self.num_shards = num_shards
+        self.max_shard_bytes = max_shard_bytes
+        self.workers = workers or cpu_count() or 1
+
+    @property
+    def extension(self) -> str:
+        if self.num_shards:
+            return '.shards{}'.format(self.num_shards)
+        return '.shards{}kb'.format(self.max_shard_bytes // 1024)
+
+    def split(self, objs: List[dict]) -> List[List[dict]]:
+        if self.num_shards:
+            num_shards = min(self.num_shards, len(objs)) or 1
+            shard_size = len(objs) / num_shards
+            return [objs[round(i * shard_size):round((i + 1) * shard_size)] for i in range(num_shards)]
+
+        shards = [[]]
+        shard_bytes = 0
+        for obj in objs:
+            obj_bytes = len(dumps(obj))
+            if shards[-1] and shard_bytes + obj_bytes > self.max_shard_bytes:
+                shards.append([])
+                shard_bytes = 0
+            shards[-1].append(obj)
+            shard_bytes += obj_bytes
+        return shards
+
+    def write(self, objs: List[dict], outdir: str, compressor: _Compression, serializer: _Serialization,
+              encryptor: _Encryption, preprocessor: _Preprocessing) -> dict:
+        makedirs(outdir, exist_ok=True)
+        suffix = '{}{}{}{}'.format(preprocessor.extension, serializer.extension,
+                                   compressor.extension, encryptor.extension)
+        shards = self.split(list(objs))
+
+        def write_shard(index: int) -> dict:
+            name = '{:05d}{}'.format(index, suffix)
+            with open(join(outdir, name), 'wb') as raw:
+                counter = CountingWriter(raw, sha256())
+                with writer_chain(counter, compressor, encryptor) as comp:
+                    serializer.serialize(preprocessor.preprocess(iter(shards[index])), comp)
+            return {
+                'name': name,
+                'emails': len(shards[index]),
+                'bytes': counter.written,
+                'sha256': counter.digest.hexdigest(),
+            }
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            manifest = {
+                'emails': sum(len(shard) for shard in shards),
+                'shards': list(executor.map(write_shard, range(len(shards)))),
+            }
+
+        with open(join(outdir, MANIFEST_NAME), 'w') as fobj:
+            dump(manifest, fobj, indent=2)
+
+        return manifest
+
+    def read(self, outdir: str, compressor: _Compression, serializer: _Serialization,
+             encryptor: _Encryption, preprocessor: _Preprocessing) -> Iterable[dict]:
+        manifest = read_manifest(outdir)
+
+        def read_shard(index: int) -> List[dict]:
+            return self.read_one(index, outdir, compressor, serializer, encryptor, preprocessor, manifest)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for shard in executor.map(read_shard, range(len(manifest['shards']))):
+                yield from shard
+
+    @classmethod
+    def read_one(cls, index: int, outdir: str, compressor: _Compression, serializer: _Serialization,
+                 encryptor: _Encryption, preprocessor: _Preprocessing, manifest: dict = None) -> List[dict]:
+        manifest = manifest or read_manifest(outdir)
+        shard = manifest['shards'][index]
+        with open(join(outdir, shard['name']), 'rb') as raw:
+            _verify_digest(raw, shard)
+            with reader_chain(raw, compressor, encryptor) as decomp:
+                objs = list(preprocessor.postprocess(serializer.deserialize(decomp)))
+
+        if len(objs) != shard['emails']:
+            raise ValueError('Shard {} has {} emails, expected {}'.format(shard['name'], len(objs), shard['emails']))
+        return objs
+
+
+def _verify_digest(fobj: IO[bytes], shard: dict):
+    digest = sha256()
+    for chunk in iter(lambda: fobj.read(DIGEST_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    if digest.hexdigest() != shard['sha256']:
+        raise ValueError('Shard {} does not match its manifest digest'.format(shard['name']))
+    fobj.seek(0)
+
+
+def read_manifest(outdir: str) -> dict:
+    with open(join(outdir, MANIFEST_NAME)) as fobj:
+        return load(fobj)
+
+
+def get_all(shard_counts: Iterable[int] = (2, 4, 16), max_shard_kbs: Iterable[int] = (),
+            workers: int = None) -> Iterable[ShardedOutput]:
+    return tuple(ShardedOutput(num_shards=num_shards, workers=workers) for num_shards in shard_counts) + \
+        tuple(ShardedOutput(max_shard_bytes=max_shard_kb * 1024, workers=workers) for max_shard_kb in max_shard_kbs)
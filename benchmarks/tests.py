@@ -1,13 +1,99 @@
 from base64 import b64encode
+from bz2 import decompress as bz2_decompress
+from copy import deepcopy
+from gzip import decompress as gzip_decompress
+from gzip import open as gzip_open
+from hashlib import sha256
 from io import BytesIO
+from json import dump
+from json import dumps
+from json import load
+from json import loads
+from lzma import decompress as lzma_decompress
+from multiprocessing import get_context
+from os import abort
 from os import close
+from os import getenv
+from os import makedirs
 from os import remove
+from os import urandom
+from os.path import dirname
+from os.path import isfile
+from os.path import join
+from pickle import dumps as pickle_dumps
+from pickle import loads as pickle_loads
+from random import Random
+from tempfile import TemporaryDirectory
+from tempfile import gettempdir
 from tempfile import mkstemp
+from threading import Thread
+from time import sleep
+from tracemalloc import get_traced_memory
+from tracemalloc import start as tracemalloc_start
+from tracemalloc import stop as tracemalloc_stop
 from unittest import TestCase
+from unittest import skipUnless
+from uuid import UUID
 
+import requests
+
+from benchmarks.__main__ import run_estimate_benchmarks
+from benchmarks.autotune import halving_schedule
+from benchmarks.autotune import successive_halving
+from benchmarks.compression import GzipCompression
+from benchmarks.compression import NoCompression
+from benchmarks.compression import ParallelBz2Compression
+from benchmarks.compression import ParallelGzipCompression
+from benchmarks.compression import ParallelXzCompression
 from benchmarks.compression import get_all as compressors
+from benchmarks.corpus import CompactCorpus
+from benchmarks.delta import get_all as delta_compressors
+from benchmarks.delta import split_batches
+from benchmarks.distributed import Coordinator
+from benchmarks.distributed import CoordinatorServer
+from benchmarks.distributed import pack_corpus
+from benchmarks.distributed import run_worker
+from benchmarks.encryption import AesGcmEncryption
+from benchmarks.encryption import ChaCha20Poly1305Encryption
+from benchmarks.encryption import NoEncryption
+from benchmarks.encryption import SegmentAuthenticationError
 from benchmarks.encryption import get_all as encryptors
+from benchmarks.estimation import Estimate
+from benchmarks.estimation import SizeEstimator
+from benchmarks.estimation import prune
+from benchmarks.granularity import GroupedContainer
+from benchmarks.granularity import get_all as granularities
+from benchmarks.jobs import write_read
+from benchmarks.pipeline import coalescing_writer
+from benchmarks.pipeline import pipe_writer
+from benchmarks.pipeline import reader_chain
+from benchmarks.pipeline import writer_chain
+from benchmarks.preprocessing import AttachmentDedupPreprocessing
+from benchmarks.preprocessing import NoPreprocessing
+from benchmarks.preprocessing import get_all as preprocessors
+from benchmarks.routing import AttachmentRouter
+from benchmarks.routing import is_incompressible
+from benchmarks.sandbox import SandboxCrash
+from benchmarks.sandbox import SandboxError
+from benchmarks.sandbox import SandboxMemoryError
+from benchmarks.sandbox import SandboxTimeout
+from benchmarks.sandbox import run_isolated
+from benchmarks.serialization import AvroSerialization
+from benchmarks.serialization import BsonLinesSerialization
+from benchmarks.serialization import CborSerialization
+from benchmarks.serialization import ColumnarSerialization
+from benchmarks.serialization import CompactBinarySerialization
+from benchmarks.serialization import JsonLinesSerialization
+from benchmarks.serialization import MsgpackSerialization
+from benchmarks.serialization import SqliteSerialization
 from benchmarks.serialization import get_all as serializers
+from benchmarks.sharding import ShardedOutput
+from benchmarks.sharding import read_manifest
+from benchmarks.utils import LatencyRecorder
+from benchmarks.utils import MappedReader
+from benchmarks.utils import Timer
+from benchmarks.utils import bounded_reader
+from benchmarks.utils import local_path
 
 
 class TempfilesTestCase(TestCase):
@@ -27,7 +113,7 @@ class TempfilesTestCase(TestCase):
 
 class CompressionTests(TestCase):
     def test_roundtrip(self):
-        for compressor in compressors():
+        for compressor in compressors(variants=True):
             with self.subTest(compressor=compressor):
                 expected = b'test content'
                 path = self.given_tempfile(compressor)
@@ -42,6 +128,24 @@ class CompressionTests(TestCase):
 
                 self.assertEqual(actual, expected)
 
+    def test_block_parallel_output_is_readable_by_stock_decoders(self):
+        expected = urandom(1000) * 50
+        for compressor, decompress in (
+            (ParallelGzipCompression(workers=2, block_size=4096), gzip_decompress),
+            (ParallelBz2Compression(workers=2, block_size=4096), bz2_decompress),
+            (ParallelXzCompression(workers=2, block_size=4096), lzma_decompress),
+        ):
+            with self.subTest(compressor=compressor):
+                buffer = BytesIO()
+                with compressor.compress(buffer) as compressed:
+                    compressed.write(expected)
+
+                self.assertEqual(decompress(buffer.getvalue()), expected)
+
+                buffer.seek(0)
+                with compressor.decompress(buffer) as decompressed:
+                    self.assertEqual(decompressed.read(), expected)
+
     def setUp(self):
         self.temp_paths = []
 
@@ -56,9 +160,47 @@ class CompressionTests(TestCase):
         return temp_path
 
 
+class CorpusTests(TestCase):
+    def test_roundtrip(self):
+        emails = synthetic_emails(20)
+        emails[0]['x-mailer'] = 'extra'
+        emails[5]['attachments'].append({'filename': 'raw.txt', 'content': 'not base64!'})
+        del emails[1]['subject']
+
+        corpus = CompactCorpus(emails)
+
+        self.assertEqual(len(corpus), 20)
+        self.assertListEqual(list(corpus), emails)
+        self.assertListEqual(list(corpus[5:10]), emails[5:10])
+        self.assertEqual(corpus[-1], emails[-1])
+
+    def test_pickle_roundtrip(self):
+        emails = [{'subject': 'partial', 'attachments': [{'filename': 'a.txt', 'content': 'YQ=='}]}]
+
+        corpus = pickle_loads(pickle_dumps(CompactCorpus(emails)))
+
+        self.assertListEqual(list(corpus), emails)
+
+    def test_uses_less_memory(self):
+        serialized = [dumps(email) for email in synthetic_emails(200)]
+
+        tracemalloc_start()
+        emails = [loads(email) for email in serialized]
+        dict_memory, _ = get_traced_memory()
+        tracemalloc_stop()
+
+        tracemalloc_start()
+        corpus = CompactCorpus(loads(email) for email in serialized)
+        compact_memory, _ = get_traced_memory()
+        tracemalloc_stop()
+
+        self.assertEqual(len(corpus), len(emails))
+        self.assertLess(compact_memory, 0.8 * dict_memory)
+
+
 class SerializationTests(TestCase):
     def test_roundtrip(self):
-        for serializer in serializers():
+        for serializer in serializers(variants=True):
             with self.subTest(serializer=serializer):
                 expected = [
                     {
@@ -106,10 +248,689 @@ class SerializationTests(TestCase):
                 actual = list(serializer.deserialize(fobj))
                 self.assertListEqual(actual, expected)
 
+    def test_compact_keys_fallback(self):
+        for serializer in (CborSerialization(compact_keys=True),
+                           BsonLinesSerialization(compact_keys=True),
+                           MsgpackSerialization(compact_keys=True)):
+            with self.subTest(serializer=serializer):
+                expected = [
+                    {
+                        'subject': 'foo',
+                        'x-mailer': 'bar',
+                        '7': 'digits',
+                        '~tilde': 'escaped',
+                        'attachments': [
+                            {
+                                'filename': 'attachment.txt',
+                                'content': b64encode(b'foo').decode('ascii'),
+                                'mimetype': 'text/plain',
+                            },
+                        ],
+                    },
+                ]
+                fobj = BytesIO()
+                serializer.serialize(expected, fobj)
+                fobj.seek(0)
+                actual = list(serializer.deserialize(fobj))
+                self.assertListEqual(actual, expected)
+
+    def test_framed_streams(self):
+        expected = [
+            {
+                'subject': 'line\nbreak {}'.format(i),
+                'attachments': [
+                    {
+                        'filename': 'attachment.bin',
+                        'content': b64encode(b'\n\x00' * 50000 * i).decode('ascii'),
+                    },
+                ],
+            }
+            for i in range(3)
+        ]
+
+        for serializer in (CborSerialization(), BsonLinesSerialization()):
+            with self.subTest(serializer=serializer):
+                fobj = BytesIO()
+                serializer.serialize(expected, fobj)
+                serialized = fobj.getvalue()
+
+                self.assertListEqual(list(serializer.deserialize(BytesIO(serialized))), expected)
+
+                with self.assertRaises(EOFError):
+                    list(serializer.deserialize(BytesIO(serialized[:-10])))
+
+    def test_bson_rejects_misaligned_stream(self):
+        serializer = BsonLinesSerialization()
+        fobj = BytesIO()
+        serializer.serialize([{'subject': 'first'}, {'subject': 'second'}], fobj)
+        corrupted = bytearray(fobj.getvalue())
+        corrupted[int.from_bytes(corrupted[:4], 'little')] = 0
+
+        with self.assertRaises(ValueError):
+            list(serializer.deserialize(BytesIO(bytes(corrupted))))
+
+    def test_compact_binary_fallback(self):
+        serializer = CompactBinarySerialization()
+        expected = [
+            {
+                'from': 'from@from',
+                'to': ['foo@bar', 'from@from'],
+                'cc': ['foo@bar'],
+                'read': True,
+                'attachments': [
+                    {
+                        'filename': 'attachment.txt',
+                        'content': b64encode(b'foo').decode('ascii'),
+                        'cid': 'cid1',
+                        'mimetype': 'text/plain',
+                    },
+                ],
+            },
+            {
+                'from': 'foo@bar',
+                'subject': None,
+                'read': None,
+                'x-mailer': 'bar',
+            },
+        ]
+        fobj = BytesIO()
+        serializer.serialize(expected, fobj)
+        fobj.seek(0)
+        actual = list(serializer.deserialize(fobj))
+        self.assertListEqual(actual, expected)
+
+    def test_columnar_projection(self):
+        serializer = ColumnarSerialization(codec='zlib', codecs={'attachments.content': 'none'})
+        emails = [
+            {
+                'from': 'from{}@from'.format(i),
+                'subject': 'subject {}'.format(i),
+                'body': 'body {}'.format(i),
+                'to': ['foo@bar'],
+                'attachments': [{'filename': 'a.txt', 'content': b64encode(b'foo').decode('ascii')}],
+            }
+            for i in range(5)
+        ]
+        fobj = BytesIO()
+        serializer.serialize(emails, fobj)
+        fobj.seek(0)
+
+        actual = list(serializer.deserialize(fobj, fields=('from', 'subject')))
+
+        expected = [{'from': email['from'], 'subject': email['subject']} for email in emails]
+        self.assertListEqual(actual, expected)
+
+    def test_projection(self):
+        emails = [
+            {
+                'from': 'from{}@from'.format(i),
+                'subject': 'subject {}'.format(i),
+                'sent_at': '2020-01-0{} 10:00'.format(i + 1),
+                'body': 'body {}'.format(i),
+                'to': ['foo@bar'],
+                'read': True,
+                'attachments': [{'filename': 'a.txt', 'content': b64encode(b'foo').decode('ascii')}],
+            }
+            for i in range(3)
+        ]
+
+        for fields in (('from', 'subject', 'sent_at'), ('to', 'attachments')):
+            expected = [{key: email[key] for key in fields} for email in emails]
+            for serializer in serializers(variants=True):
+                with self.subTest(serializer=serializer.extension, fields=fields):
+                    fobj = BytesIO()
+                    serializer.serialize(iter(emails), fobj)
+                    fobj.seek(0)
+
+                    actual = list(serializer.deserialize(fobj, fields=fields))
+
+                    self.assertListEqual(actual, expected)
+
+    def test_avro_skip_blocks(self):
+        serializer = AvroSerialization(codec='deflate', sync_interval=64)
+        expected = [{'subject': 'email {}'.format(i), 'to': ['foo@bar']} for i in range(50)]
+        fobj = BytesIO()
+        serializer.serialize(expected, fobj)
+
+        for skip in (0, 1, 37, 50):
+            with self.subTest(skip=skip):
+                fobj.seek(0)
+                actual = list(serializer.deserialize(fobj, skip=skip))
+                self.assertListEqual(actual, expected[skip:])
+
+
+class PreprocessingTests(TestCase):
+    def test_roundtrip(self):
+        for preprocessor in preprocessors():
+            with self.subTest(preprocessor=preprocessor):
+                expected = [
+                    {
+                        'subject': 'email {}'.format(i),
+                        'from': 'from{}@from'.format(i % 2),
+                        'to': ['foo@bar', '#hash@bar', 'from0@from'],
+                        'cc': [],
+                        'sent_at': ('2020-01-31 20:50', '2020-01-30 08:15:42', 'yesterday')[i],
+                        '_uid': ('4c2b3ae0-0a5e-4d0c-9a29-2ec4d2d0b1e5', '4C2B3AE0', '!bang')[i],
+                        'attachments': [
+                            {
+                                'filename': 'logo.png',
+                                'content': b64encode(b'same logo').decode('ascii'),
+                            },
+                            {
+                                'filename': 'note.txt',
+                                'content': b64encode('note {}'.format(i).encode('ascii')).decode('ascii'),
+                            },
+                        ],
+                    }
+                    for i in range(3)
+                ]
+                original = deepcopy(expected)
+
+                fobj = BytesIO()
+                serializer = JsonLinesSerialization()
+                serializer.serialize(preprocessor.preprocess(iter(expected)), fobj)
+                fobj.seek(0)
+                actual = list(preprocessor.postprocess(serializer.deserialize(fobj)))
+
+                self.assertListEqual(actual, expected)
+                self.assertListEqual(expected, original)
+
+    def test_dedup_emits_each_blob_once(self):
+        content = b64encode(b'same logo' * 100).decode('ascii')
+        emails = [{'attachments': [{'filename': 'logo.png', 'content': content}]} for _ in range(5)]
+
+        preprocessed = list(AttachmentDedupPreprocessing().preprocess(iter(emails)))
+
+        contents = [email['attachments'][0]['content'] for email in preprocessed]
+        self.assertEqual(contents.count(content), 1)
+
+    def test_dedup_escapes_literal_references(self):
+        references = AttachmentDedupPreprocessing.references
+        contents = [
+            b64encode(b'hello').decode('ascii'),
+            b64encode(b'world').decode('ascii'),
+            references.reference(1),
+            b64encode(references.escape + b'literal').decode('ascii'),
+        ]
+        expected = [{'subject': 'email {}'.format(i), 'attachments': [{'filename': 'a.bin', 'content': content}]}
+                    for i, content in enumerate(contents + contents)]
+
+        for serializer in serializers(variants=True):
+            with self.subTest(serializer=serializer.extension):
+                preprocessor = AttachmentDedupPreprocessing()
+                fobj = BytesIO()
+                serializer.serialize(preprocessor.preprocess(iter(deepcopy(expected))), fobj)
+                fobj.seek(0)
+                actual = list(preprocessor.postprocess(serializer.deserialize(fobj)))
+
+                self.assertListEqual([email['attachments'] for email in actual],
+                                     [email['attachments'] for email in expected])
+
+
+class RoutingTests(TempfilesTestCase):
+    def test_is_incompressible(self):
+        self.assertTrue(is_incompressible(b64encode(b'\x89PNG\r\n\x1a\n' + b'\0' * 100).decode('ascii')))
+        self.assertTrue(is_incompressible(b64encode(urandom(20000)).decode('ascii')))
+        self.assertFalse(is_incompressible(b64encode(b'plain text ' * 2000).decode('ascii')))
+
+    def test_roundtrip(self):
+        router = AttachmentRouter()
+        compressor = GzipCompression()
+        serializer = JsonLinesSerialization()
+        expected = [
+            {
+                'subject': 'foo',
+                'attachments': [
+                    {'filename': 'random.bin', 'content': b64encode(urandom(5000)).decode('ascii')},
+                    {'filename': 'text.txt', 'content': b64encode(b'text ' * 1000).decode('ascii')},
+                ],
+            },
+            {
+                'subject': 'bar',
+            },
+        ]
+        path = self.given_tempfile(router.extension)
+
+        with open(path, 'wb') as fobj:
+            router.write(iter(expected), serializer, compressor, fobj)
+
+        with open(path, 'rb') as fobj:
+            actual = list(router.read(serializer, compressor, fobj))
+
+        self.assertListEqual(actual, expected)
+
+    def test_roundtrip_of_literal_references(self):
+        router = AttachmentRouter()
+        compressor = NoCompression()
+        references = AttachmentRouter.references
+        expected = [
+            {
+                'subject': 'foo',
+                'attachments': [
+                    {'filename': 'random.bin', 'content': b64encode(urandom(5000)).decode('ascii')},
+                    {'filename': 'reference.bin', 'content': references.reference(0)},
+                    {'filename': 'escape.bin', 'content': b64encode(references.escape + b'x').decode('ascii')},
+                ],
+            },
+        ]
+
+        for serializer in serializers(variants=True):
+            with self.subTest(serializer=serializer.extension):
+                path = self.given_tempfile(router.extension)
+
+                with open(path, 'wb') as fobj:
+                    router.write(iter(deepcopy(expected)), serializer, compressor, fobj)
+
+                with open(path, 'rb') as fobj:
+                    actual = list(router.read(serializer, compressor, fobj))
+
+                self.assertListEqual([email['attachments'] for email in actual],
+                                     [email['attachments'] for email in expected])
+
+    def test_bounded_reader_reads_lines_up_to_the_bound(self):
+        fobj = BytesIO(b'first\nsecond\nthird\n')
+
+        self.assertListEqual(list(bounded_reader(fobj, 10)), [b'first\n', b'seco'])
+
+
+class DeltaTests(TestCase):
+    def test_roundtrip(self):
+        reference = b'shared signature and recipients ' * 100
+        data = reference[:1000] + b'new content'
+
+        for compressor in delta_compressors():
+            with self.subTest(compressor=compressor.extension):
+                delta = compressor.compress(data, reference)
+
+                self.assertEqual(compressor.decompress(delta, reference), data)
+                self.assertLess(len(delta), len(compressor.compress(data)))
+
+    def test_split_batches(self):
+        emails = [
+            {'subject': 'c', 'sent_at': '2020-01-02 10:00'},
+            {'subject': 'a', 'sent_at': '2020-01-01 09:00'},
+            {'subject': 'b', 'sent_at': '2020-01-01 11:00'},
+        ]
+
+        batches = split_batches(emails)
+
+        self.assertEqual([[email['subject'] for email in batch] for batch in batches], [['a', 'b'], ['c']])
+
+
+class EstimationTests(TestCase):
+    def test_samples_are_stratified(self):
+        emails = [{'subject': str(i)} for i in range(100)]
+
+        samples = list(SizeEstimator(num_strata=4, sample_fraction=0.1).samples(emails))
+
+        self.assertEqual(len(samples), 4)
+        for i, sample in enumerate(samples):
+            self.assertEqual(len(sample), 5)
+            self.assertTrue(all(25 * i <= int(email['subject']) < 25 * (i + 1) for email in sample))
+
+    def test_estimate_brackets_actual_size(self):
+        emails = synthetic_emails(200)
+        serializer = JsonLinesSerialization()
+        actual = BytesIO()
+        serializer.serialize(iter(emails), actual)
+
+        estimate = SizeEstimator().estimate(emails, NoCompression(), serializer, NoEncryption())
+
+        self.assertLessEqual(estimate.size_low, len(actual.getvalue()))
+        self.assertGreaterEqual(estimate.size_high, len(actual.getvalue()))
+
+    def test_prune(self):
+        estimates = {
+            'best': Estimate(100, 90, 110, 1, 1, 1),
+            'overlapping': Estimate(120, 105, 135, 1, 1, 1),
+            'worse': Estimate(200, 180, 220, 1, 1, 1),
+        }
+
+        self.assertSetEqual(prune(estimates), {'best', 'overlapping'})
+
+    def test_error_percent_of_empty_file(self):
+        jobs = [(NoCompression(), JsonLinesSerialization(), NoEncryption(), NoPreprocessing())]
+
+        with TemporaryDirectory() as results_dir:
+            result, = run_estimate_benchmarks([{}], results_dir, validate_all=True, jobs=jobs)
+
+        self.assertEqual(result.FilesizeKb, '0.00')
+        self.assertEqual(result.FilesizeErrorPercent, 'n/a')
+
+
+class AutotuneTests(TestCase):
+    def test_halving_schedule(self):
+        schedule = halving_schedule(num_candidates=100, num_emails=270, eta=3, min_emails=5)
+
+        self.assertListEqual(schedule, [(5, 100), (10, 34), (30, 12), (90, 4), (270, 2)])
+
+    def test_successive_halving_picks_one_winner(self):
+        emails = synthetic_emails(30)
+        jobs = [(compressor, JsonLinesSerialization(), NoEncryption(), NoPreprocessing())
+                for compressor in (NoCompression(), GzipCompression(level=1), GzipCompression())]
+
+        trials = list(successive_halving(emails, jobs, gettempdir(), bandwidth_kbps=64, min_emails=10))
+
+        self.assertEqual(sum(1 for trial in trials if trial.Status == 'winner'), 1)
+        self.assertEqual(trials[-1].NumEmails, '30')
+
+    def test_successive_halving_reports_skipped_candidates(self):
+        emails = synthetic_emails(30)
+        jobs = [(compressor, JsonLinesSerialization(), NoEncryption(), NoPreprocessing())
+                for compressor in (NoCompression(), GzipCompression(level=1), GzipCompression())]
+
+        trials = list(successive_halving(emails, jobs, gettempdir(), bandwidth_kbps=64, budget_seconds=0,
+                                         min_emails=10))
+
+        first_round = [trial.Status for trial in trials if trial.Round == '1']
+        self.assertEqual(first_round.count('skipped'), 2)
+        self.assertEqual(len(first_round), len(jobs))
+
+
+class DistributedTests(TestCase):
+    def test_reassigns_expired_leases(self):
+        jobs = [(compressor, JsonLinesSerialization(), NoEncryption(), NoPreprocessing())
+                for compressor in (NoCompression(), GzipCompression())]
+        coordinator = Coordinator(jobs, corpus=b'', lease_size=2, lease_timeout=0)
+
+        first = coordinator.lease('first')['jobs']
+        second = coordinator.lease('second')['jobs']
+        for job in second:
+            coordinator.fail('second', job, 'failed')
+        coordinator.fail('first', first[0], 'ignored')
+
+        self.assertListEqual(first, second)
+        self.assertTrue(coordinator.lease('first')['done'])
+        self.assertListEqual([str(result.FilesizeKb.ex) for result in coordinator.results()], ['failed', 'failed'])
+
+    def test_local_workers(self):
+        jobs = [(compressor, JsonLinesSerialization(), NoEncryption(), NoPreprocessing())
+                for compressor in (NoCompression(), GzipCompression(), ParallelGzipCompression())]
+
+        with TemporaryDirectory() as temp_dir:
+            inputs_dir = join(temp_dir, 'inputs')
+            makedirs(inputs_dir)
+            for i, email in enumerate(synthetic_emails(10)):
+                with gzip_open(join(inputs_dir, '{}.json.gz'.format(i)), 'wt') as fobj:
+                    dump(email, fobj)
+
+            server = CoordinatorServer(Coordinator(jobs, pack_corpus(inputs_dir)), 'secret', port=0)
+            url = 'http://127.0.0.1:{}'.format(server.port)
+            context = get_context('spawn')
+            workers = [context.Process(target=run_worker, args=(
+                url, 'secret', join(temp_dir, 'results'), join(temp_dir, 'cache'), 'worker-{}'.format(i), 0.1))
+                for i in range(2)]
+            for worker in workers:
+                worker.start()
+
+            results = list(server.run(poll_interval=0.1, linger_seconds=30))
+
+            for worker in workers:
+                worker.join()
+
+        self.assertListEqual(sorted(result.Compressor for result in results), ['(none)', 'gz', 'parallel.gz'])
+        self.assertTrue(all(float(result.ReadTimeSeconds) > 0 for result in results))
+        self.assertListEqual([worker.exitcode for worker in workers], [0, 0])
+
+    def test_rejects_requests_without_token(self):
+        server = CoordinatorServer(Coordinator([], corpus=b''), 'secret', port=0)
+        url = 'http://127.0.0.1:{}'.format(server.port)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            self.assertEqual(requests.get(url + '/corpus').status_code, 401)
+            self.assertEqual(requests.post(url + '/register', json={'worker': 'intruder'},
+                                           headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+            self.assertEqual(requests.get(url + '/corpus', headers={'Authorization': 'Bearer secret'}).status_code,
+                             200)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+class GranularityTests(TempfilesTestCase):
+    def test_roundtrip(self):
+        compressor = GzipCompression()
+        serializer = JsonLinesSerialization()
+        expected = [{'subject': 'email {}'.format(i)} for i in range(25)]
+
+        for container in granularities((1, 10)):
+            with self.subTest(container=container.extension):
+                path = self.given_tempfile(container.extension)
+
+                with open(path, 'wb') as fobj:
+                    container.write(iter(expected), serializer, compressor, fobj)
+
+                with open(path, 'rb') as fobj:
+                    self.assertListEqual(list(container.read(serializer, compressor, fobj)), expected)
+
+                for index in (0, 9, 10, 24):
+                    with open(path, 'rb') as fobj:
+                        self.assertEqual(container.read_one(index, serializer, compressor, fobj), expected[index])
+
+    def test_uncompressed_read_is_not_dominated_by_the_container(self):
+        compressor = NoCompression()
+        serializer = JsonLinesSerialization()
+        emails = synthetic_emails(200)
+        container = GroupedContainer(group_size=100)
+        direct_path = self.given_tempfile(serializer.extension)
+        grouped_path = self.given_tempfile(container.extension)
+
+        with open(direct_path, 'wb') as fobj:
+            serializer.serialize(iter(emails), fobj)
+        with open(grouped_path, 'wb') as fobj:
+            container.write(iter(emails), serializer, compressor, fobj)
+
+        def read_direct():
+            with open(direct_path, 'rb') as fobj:
+                self.assertEqual(sum(1 for _ in serializer.deserialize(fobj)), len(emails))
+
+        def read_grouped():
+            with open(grouped_path, 'rb') as fobj:
+                self.assertEqual(sum(1 for _ in container.read(serializer, compressor, fobj)), len(emails))
+
+        self.assertLess(best_time(read_grouped), 5 * best_time(read_direct))
+
+
+class ShardingTests(TestCase):
+    def test_roundtrip(self):
+        compressor = GzipCompression()
+        serializer = JsonLinesSerialization()
+        encryptor = AesGcmEncryption()
+        preprocessor = NoPreprocessing()
+        expected = [{'subject': 'email {}'.format(i), 'body': 'x' * 100} for i in range(25)]
+
+        for container, num_shards in ((ShardedOutput(num_shards=4, workers=2), 4),
+                                      (ShardedOutput(max_shard_bytes=1024, workers=2), 4)):
+            with self.subTest(container=container.extension), TemporaryDirectory() as outdir:
+                manifest = container.write(expected, outdir, compressor, serializer, encryptor, preprocessor)
+
+                self.assertEqual(len(manifest['shards']), num_shards)
+                self.assertEqual(manifest, read_manifest(outdir))
+                for shard in manifest['shards']:
+                    with open(join(outdir, shard['name']), 'rb') as fobj:
+                        self.assertEqual(sha256(fobj.read()).hexdigest(), shard['sha256'])
+
+                actual = list(container.read(outdir, compressor, serializer, encryptor, preprocessor))
+                self.assertListEqual(actual, expected)
+
+                last = manifest['shards'][-1]['emails']
+                self.assertListEqual(container.read_one(num_shards - 1, outdir, compressor, serializer,
+                                                        encryptor, preprocessor), expected[-last:])
+
+    def test_rejects_corrupted_shard(self):
+        compressor = NoCompression()
+        serializer = JsonLinesSerialization()
+        encryptor = NoEncryption()
+        preprocessor = NoPreprocessing()
+        container = ShardedOutput(num_shards=2, workers=1)
+
+        with TemporaryDirectory() as outdir:
+            manifest = container.write([{'subject': 'email {}'.format(i)} for i in range(4)], outdir,
+                                       compressor, serializer, encryptor, preprocessor)
+            with open(join(outdir, manifest['shards'][1]['name']), 'r+b') as fobj:
+                fobj.write(b'{"subject": "spoofed"}\n')
+
+            with self.assertRaises(ValueError):
+                container.read_one(1, outdir, compressor, serializer, encryptor, preprocessor)
+
+
+class SandboxTests(TestCase):
+    def test_returns_result(self):
+        self.assertEqual(run_isolated(pow, 2, 10), 1024)
+
+    def test_reports_error(self):
+        with self.assertRaises(SandboxError) as context:
+            run_isolated(int, 'not a number')
+
+        self.assertIn('ValueError', context.exception.cause)
+
+    def test_reports_timeout(self):
+        with self.assertRaises(SandboxTimeout):
+            run_isolated(sleep, 30, timeout=1)
+
+    def test_reports_crash(self):
+        with self.assertRaises(SandboxCrash) as context:
+            run_isolated(abort)
+
+        self.assertIn('SIGABRT', context.exception.cause)
+
+    def test_reports_memory_limit(self):
+        with self.assertRaises(SandboxMemoryError):
+            run_isolated(bytearray, 1024 * 1024 * 1024, memory_limit_mb=512)
+
+
+class LatencyRecorderTests(TestCase):
+    def test_percentiles(self):
+        recorder = LatencyRecorder()
+        recorder._latencies = [0.001 * i for i in range(1, 101)]
+
+        self.assertAlmostEqual(recorder.percentile(50), 0.050)
+        self.assertAlmostEqual(recorder.percentile(99), 0.099)
+        self.assertAlmostEqual(recorder.percentile(100), 0.100)
+
+    def test_tracks_first_item(self):
+        def slow_items():
+            sleep(0.05)
+            yield 'first'
+            yield 'second'
+
+        recorder = LatencyRecorder()
+
+        self.assertListEqual(list(recorder.track(slow_items())), ['first', 'second'])
+        self.assertGreaterEqual(recorder.summary().first_seconds, 0.05)
+        self.assertLess(recorder.summary().p50_seconds, 0.05)
+
+
+class JobsTests(TempfilesTestCase):
+    def test_write_read(self):
+        emails = [{'subject': 'email {}'.format(i)} for i in range(3)]
+        path = self.given_tempfile('.jsonl.gz')
+
+        write_time, read_time, latency = write_read(emails, path, GzipCompression(), JsonLinesSerialization(),
+                                                    NoEncryption(), NoPreprocessing())
+
+        self.assertIsInstance(write_time, float)
+        self.assertIsInstance(read_time, float)
+        self.assertLessEqual(latency.p50_seconds, latency.p99_seconds)
+        self.assertLessEqual(latency.first_seconds, read_time)
+
+    def test_write_read_returns_errors(self):
+        emails = [{'subject': 'email'}]
+        path = join(self.given_tempfile('.missing'), 'emails.jsonl')
+
+        write_time, read_time, latency = write_read(emails, path, GzipCompression(), JsonLinesSerialization(),
+                                                    NoEncryption(), NoPreprocessing())
+
+        self.assertIsInstance(write_time, OSError)
+        self.assertIs(read_time, write_time)
+        self.assertIs(latency, write_time)
+
+
+class PipelineTests(TempfilesTestCase):
+    def test_roundtrip(self):
+        compressor = GzipCompression()
+        encryptor = AesGcmEncryption(segment_size=1024)
+        expected = urandom(100000)
+        path = self.given_tempfile('.pipeline')
+
+        with open(path, 'wb') as fobj:
+            with writer_chain(fobj, compressor, encryptor, pipelined=True) as writer:
+                for i in range(0, len(expected), 1000):
+                    writer.write(expected[i:i + 1000])
+
+        with open(path, 'rb') as fobj:
+            with reader_chain(fobj, compressor, encryptor, pipelined=True) as reader:
+                actual = reader.read()
+
+        self.assertEqual(actual, expected)
+
+    def test_coalescing_writer(self):
+        class RecordingFile(BytesIO):
+            def __init__(self):
+                super().__init__()
+                self.num_writes = 0
+
+            def write(self, data):
+                self.num_writes += 1
+                return super().write(data)
+
+        sink = RecordingFile()
+        with coalescing_writer(sink, buffer_size=100) as writer:
+            for i in range(100):
+                writer.write(b'0123456789')
+            writer.write(b'x' * 1000)
+
+        self.assertEqual(sink.getvalue(), b'0123456789' * 100 + b'x' * 1000)
+        self.assertEqual(sink.num_writes, 11)
+
+    def test_writer_error(self):
+        class BrokenFile:
+            def write(self, data):
+                raise IOError('broken')
+
+        with self.assertRaises(IOError):
+            with pipe_writer(BrokenFile()) as writer:
+                writer.write(b'foo')
+
+
+class MappedReaderTests(TempfilesTestCase):
+    def test_reader_chain_maps_plain_files(self):
+        path = self.given_tempfile('.jsonl')
+        with open(path, 'wb') as fobj:
+            fobj.write(b'first\nsecond\nthird')
+
+        with open(path, 'rb') as fobj:
+            with reader_chain(fobj, NoCompression(), NoEncryption()) as reader:
+                self.assertIsInstance(reader, MappedReader)
+                self.assertEqual(local_path(reader), path)
+                self.assertEqual(reader.readline(), b'first\n')
+                self.assertListEqual(list(reader), [b'second\n', b'third'])
+                reader.seek(2)
+                buffer = bytearray(4)
+                self.assertEqual(reader.readinto(buffer), 4)
+                self.assertEqual(buffer, b'rst\n')
+
+    def test_sqlite_reads_in_place(self):
+        serializer = SqliteSerialization()
+        expected = [{'_uid': str(i), 'subject': 'email {}'.format(i), 'to': ['foo@bar']} for i in range(3)]
+        path = self.given_tempfile(serializer.extension)
+
+        with open(path, 'wb') as fobj:
+            serializer.serialize(iter(expected), fobj)
+
+        with open(path, 'rb') as fobj:
+            with reader_chain(fobj, NoCompression(), NoEncryption()) as reader:
+                actual = list(serializer.deserialize(reader))
+
+        self.assertListEqual([{key: email[key] for key in expected[0]} for email in actual], expected)
+        self.assertIsNone(local_path(BytesIO()))
+
 
 class EncryptionTests(TempfilesTestCase):
     def test_roundtrip(self):
-        for encryptor in encryptors():
+        for encryptor in encryptors(variants=True):
             with self.subTest(encryptor=encryptor):
                 expected = b'some bytes'
 
@@ -127,6 +948,206 @@ class EncryptionTests(TempfilesTestCase):
                     with encryptor.deserialize(fobj) as decrypted:
                         self.assertEqual(decrypted.read(), expected)
 
+    def test_aead_segments(self):
+        for encryptor in (AesGcmEncryption(segment_size=16), ChaCha20Poly1305Encryption(segment_size=16)):
+            with self.subTest(encryptor=encryptor):
+                expected = bytes(range(100))
+                fobj = BytesIO()
+
+                with encryptor.encrypt(fobj) as encrypted:
+                    encrypted.write(expected)
+                ciphertext = fobj.getvalue()
+
+                with encryptor.deserialize(BytesIO(ciphertext)) as decrypted:
+                    self.assertEqual(decrypted.read(), expected)
+
+                tampered = bytearray(ciphertext)
+                tampered[-20] ^= 1
+                with encryptor.deserialize(BytesIO(bytes(tampered))) as decrypted:
+                    with self.assertRaises(SegmentAuthenticationError) as error:
+                        decrypted.read()
+                self.assertEqual(error.exception.segment, 6)
+
+                truncated = ciphertext[:-(16 + 4 + 16)]
+                with encryptor.deserialize(BytesIO(truncated)) as decrypted:
+                    with self.assertRaises(SegmentAuthenticationError):
+                        decrypted.read()
+
+
+PERF_MODE = getenv('BENCHMARKS_PERF', '')
+PERF_BASELINE_PATH = getenv('BENCHMARKS_PERF_BASELINE', join(dirname(__file__), 'perf_baseline.json'))
+PERF_TIME_TOLERANCE = float(getenv('BENCHMARKS_PERF_TOLERANCE', '2.0'))
+PERF_ALLOCATION_TOLERANCE = 1.25
+PERF_SCALING_FACTOR = 10
+# a quadratic read path takes ~100x as long on 10x the data; leave headroom below that
+# for linear codecs whose working set outgrows the CPU caches, like bzip2's 900k blocks
+PERF_SCALING_TOLERANCE = 5
+PERF_REPEATS = 3
+
+
+def synthetic_emails(count, seed=0):
+    rng = Random(seed)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'school', 'report', 'meeting', 'thanks', 'regards']
+    addresses = ['user{}@example{}.com'.format(i, i % 3) for i in range(20)]
+    emails = []
+    for i in range(count):
+        email = {
+            'to': rng.sample(addresses, 2),
+            'cc': rng.sample(addresses, i % 2),
+            'bcc': [],
+            'from': rng.choice(addresses),
+            'subject': 'Re: thread {}'.format(i % 7),
+            'body': ' '.join(rng.choice(words) for _ in range(200)),
+            'sent_at': '2020-01-{:02d} {:02d}:00'.format(1 + i % 28, i % 24),
+            '_uid': str(UUID(int=rng.getrandbits(128))),
+            'read': bool(i % 2),
+        }
+        if i % 5 == 0:
+            content = bytes(rng.getrandbits(8) for _ in range(1024)) + ' '.join(words).encode('ascii') * 50
+            email['attachments'] = [{'filename': 'file{}.bin'.format(i), 'content': b64encode(content).decode('ascii')}]
+        emails.append(email)
+    return emails
+
+
+def calibrate():
+    def workload():
+        total = 0
+        for i in range(200000):
+            total += i * i % 7
+        return total
+
+    return best_time(workload)
+
+
+def best_time(func, repeats=PERF_REPEATS):
+    elapsed = []
+    for _ in range(repeats):
+        with Timer.timeit() as timer:
+            func()
+        elapsed.append(timer.elapsed())
+    return min(elapsed)
+
+
+def peak_allocation_kb(func):
+    tracemalloc_start()
+    try:
+        func()
+        _, peak = get_traced_memory()
+    finally:
+        tracemalloc_stop()
+    return peak / 1024
+
+
+def perf_cases():
+    for serializer in serializers(variants=True):
+        def write(emails, path, serializer=serializer):
+            with open(path, 'wb') as fobj:
+                serializer.serialize(iter(emails), fobj)
+
+        def read(path, serializer=serializer):
+            with open(path, 'rb') as fobj:
+                for _ in serializer.deserialize(fobj):
+                    pass
+
+        yield 'serialization{}'.format(serializer.extension), write, read
+
+    for compressor in compressors(variants=True):
+        def write(emails, path, compressor=compressor):
+            with open(path, 'wb') as fobj:
+                with compressor.compress(fobj) as compressed:
+                    JsonLinesSerialization().serialize(iter(emails), compressed)
+
+        def read(path, compressor=compressor):
+            with open(path, 'rb') as fobj:
+                with compressor.decompress(fobj) as decompressed:
+                    decompressed.read()
+
+        yield 'compression{}'.format(compressor.extension or '.none'), write, read
+
+    for encryptor in encryptors(variants=True):
+        def write(emails, path, encryptor=encryptor):
+            with open(path, 'wb') as fobj:
+                with encryptor.encrypt(fobj) as encrypted:
+                    JsonLinesSerialization().serialize(iter(emails), encrypted)
+
+        def read(path, encryptor=encryptor):
+            with open(path, 'rb') as fobj:
+                with encryptor.deserialize(fobj) as decrypted:
+                    decrypted.read()
+
+        yield 'encryption.{}'.format(encryptor.extension or 'none'), write, read
+
+
+@skipUnless(PERF_MODE, 'set BENCHMARKS_PERF=1 to check or BENCHMARKS_PERF=record to update the baseline')
+class PerformanceTests(TempfilesTestCase):
+    def test_throughput(self):
+        emails = synthetic_emails(100)
+        calibration = calibrate()
+
+        for key, write, read in perf_cases():
+            with self.subTest(case=key):
+                path = self.given_tempfile('.perf')
+
+                def roundtrip():
+                    write(emails, path)
+                    read(path)
+
+                self.check_baseline(key, 'time', best_time(roundtrip) / calibration, PERF_TIME_TOLERANCE)
+
+    def test_allocations(self):
+        emails = synthetic_emails(100)
+
+        for key, write, read in perf_cases():
+            with self.subTest(case=key):
+                path = self.given_tempfile('.perf')
+
+                def roundtrip():
+                    write(emails, path)
+                    read(path)
+
+                self.check_baseline(key, 'peak_kb', peak_allocation_kb(roundtrip), PERF_ALLOCATION_TOLERANCE)
+
+    def test_read_scaling(self):
+        small = synthetic_emails(100)
+        large = synthetic_emails(100 * PERF_SCALING_FACTOR)
+        limit = PERF_SCALING_FACTOR * PERF_SCALING_TOLERANCE
+
+        for key, write, read in perf_cases():
+            with self.subTest(case=key):
+                small_path = self.given_tempfile('.perf')
+                large_path = self.given_tempfile('.perf')
+                write(small, small_path)
+                write(large, large_path)
+
+                ratio = best_time(lambda: read(large_path)) / best_time(lambda: read(small_path))
+
+                self.assertLessEqual(ratio, limit, '{}x data took {:.1f}x as long to read'.format(
+                    PERF_SCALING_FACTOR, ratio))
+
+    def check_baseline(self, key, metric, actual, tolerance):
+        baseline = self.load_baseline()
+
+        if PERF_MODE == 'record':
+            baseline.setdefault(key, {})[metric] = round(actual, 4)
+            with open(PERF_BASELINE_PATH, 'w') as fobj:
+                dump(baseline, fobj, indent=2, sort_keys=True)
+                fobj.write('\n')
+            return
+
+        expected = baseline.get(key, {}).get(metric)
+        if expected is None:
+            self.skipTest('no baseline {} for {}'.format(metric, key))
+
+        self.assertLessEqual(actual, expected * tolerance, '{} regressed from {:.4f} to {:.4f}'.format(
+            metric, expected, actual))
+
+    @classmethod
+    def load_baseline(cls):
+        if not isfile(PERF_BASELINE_PATH):
+            return {}
+        with open(PERF_BASELINE_PATH) as fobj:
+            return load(fobj)
+
 
 if __name__ == '__main__':
     from unittest import main
@@ -1,13 +1,38 @@
+from base64 import b64decode
+from base64 import b64encode
+from collections import namedtuple
 from contextlib import contextmanager
 from datetime import datetime
 from gzip import open as gzip_open
+from hashlib import sha256
+from io import BufferedReader
+from io import FileIO
+from io import RawIOBase
+from json import dumps
 from json import loads
+from math import ceil
+from mmap import ACCESS_READ
+from mmap import mmap
 from os import makedirs
 from os import remove
+from os import rename
 from os import stat
+from os.path import abspath
+from os.path import dirname
 from os.path import isdir
 from shutil import copyfileobj
+from shutil import rmtree
+from struct import pack
+from struct import unpack
 from tempfile import NamedTemporaryFile
+from tempfile import mkdtemp
+from time import monotonic
+from time import perf_counter
+from time import process_time
+from time import sleep
+from typing import IO
+from typing import Iterable
+from typing import Optional
 from zipfile import ZipFile
 
 import requests
@@ -17,15 +42,25 @@ class Timer:
     def __init__(self):
         self._start = None
         self._stop = None
+        self._cpu_start = None
+        self._cpu_stop = None
 
     def start(self):
         self._start = datetime.now()
+        self._cpu_start = process_time()
 
     def stop(self):
         self._stop = datetime.now()
+        self._cpu_stop = process_time()
+
+    def elapsed(self) -> float:
+        return (self._stop - self._start).total_seconds()
+
+    def cpu_elapsed(self) -> float:
+        return self._cpu_stop - self._cpu_start
 
     def seconds(self) -> str:
-        return '{:.4f}'.format((self._stop - self._start).total_seconds())
+        return '{:.4f}'.format(self.elapsed())
 
     @classmethod
     @contextmanager
@@ -36,8 +71,246 @@ class Timer:
         timer.stop()
 
 
-def download_to_file(url: str) -> str:
-    response = requests.get(url, stream=True)
+Latency = namedtuple('Latency', (
+    'first_seconds',
+    'p50_seconds',
+    'p99_seconds',
+))
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self._start = perf_counter()
+        self._first = None
+        self._latencies = []
+
+    def track(self, items: Iterable) -> Iterable:
+        items = iter(items)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            stop = perf_counter()
+            if self._first is None:
+                self._first = stop - self._start
+            self._latencies.append(stop - start)
+            yield item
+
+    def percentile(self, percent: float) -> float:
+        if not self._latencies:
+            return 0.0
+        latencies = sorted(self._latencies)
+        rank = max(ceil(percent / 100 * len(latencies)), 1)
+        return latencies[rank - 1]
+
+    def summary(self) -> Latency:
+        return Latency(
+            first_seconds=self._first or 0.0,
+            p50_seconds=self.percentile(50),
+            p99_seconds=self.percentile(99),
+        )
+
+
+class BoundedReader(RawIOBase):
+    def __init__(self, fobj: IO[bytes], size: int):
+        self._fobj = fobj
+        self._remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        data = self._fobj.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+
+def bounded_reader(fobj: IO[bytes], size: int) -> BufferedReader:
+    # buffered so that line-oriented deserializers don't fall back to one read call per byte
+    return BufferedReader(BoundedReader(fobj, size))
+
+
+class ThrottledReader(RawIOBase):
+    def __init__(self, fobj: IO[bytes], bytes_per_second: int):
+        self._fobj = fobj
+        self._bytes_per_second = bytes_per_second
+        self._start = monotonic()
+        self._read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self._fobj.seekable()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._fobj.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._fobj.tell()
+
+    def readinto(self, buffer) -> int:
+        data = self._fobj.read(len(buffer))
+        buffer[:len(data)] = data
+        self._read += len(data)
+
+        delay = self._start + self._read / self._bytes_per_second - monotonic()
+        if delay > 0:
+            sleep(delay)
+        return len(data)
+
+
+class ChunkReader(RawIOBase):
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._chunk = b''
+        self._offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self._offset >= len(self._chunk):
+            self._chunk = next(self._chunks, None)
+            self._offset = 0
+            if self._chunk is None:
+                self._chunk = b''
+                return 0
+
+        size = min(len(buffer), len(self._chunk) - self._offset)
+        buffer[:size] = self._chunk[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+
+class MappedReader(RawIOBase):
+    def __init__(self, fobj: IO[bytes]):
+        self.name = fobj.name
+        self._mmap = mmap(fobj.fileno(), 0, access=ACCESS_READ)
+        self._mmap.seek(fobj.tell())
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self._mmap.seek(offset, whence)
+        return self._mmap.tell()
+
+    def tell(self) -> int:
+        return self._mmap.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        return self._mmap.read(-1 if size is None else size)
+
+    def readline(self, size: int = -1) -> bytes:
+        line = self._mmap.readline()
+        if size is not None and 0 <= size < len(line):
+            self._mmap.seek(size - len(line), 1)
+            line = line[:size]
+        return line
+
+    def __iter__(self) -> Iterable[bytes]:
+        return iter(self._mmap.readline, b'')
+
+    def readinto(self, buffer) -> int:
+        start = self._mmap.tell()
+        size = min(len(buffer), len(self._mmap) - start)
+        buffer[:size] = self._mmap[start:start + size]
+        self._mmap.seek(start + size)
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._mmap.close()
+        super().close()
+
+
+def local_path(fobj: IO[bytes]) -> Optional[str]:
+    if not isinstance(fobj, MappedReader):
+        if not isinstance(fobj, BufferedReader) or not isinstance(fobj.raw, FileIO):
+            return None
+    if not isinstance(fobj.name, str) or fobj.tell() != 0:
+        return None
+    return fobj.name
+
+
+class CountingWriter:
+    def __init__(self, fobj: IO[bytes], digest=None):
+        self._fobj = fobj
+        self.digest = digest
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self._fobj.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        self._fobj.flush()
+
+    @classmethod
+    def seekable(cls) -> bool:
+        return False
+
+
+class BlobReferences:
+    """
+    Encodes references to out-of-line attachment blobs as base64 attachment contents.
+
+    Literal contents that decode to one of the markers are escaped inside the base64 payload,
+    so that the escape survives serializers that store the decoded attachment bytes.
+    """
+
+    def __init__(self, marker: bytes, escape: bytes):
+        self.marker = marker
+        self.escape = escape
+        self._head_length = (max(len(marker), len(escape)) + 2) // 3 * 4
+
+    def reference(self, index: int) -> str:
+        return b64encode(self.marker + pack('>I', index)).decode('ascii')
+
+    def escape_literal(self, content: str) -> str:
+        if self._head(content).startswith((self.marker, self.escape)):
+            return b64encode(self.escape + b64decode(content)).decode('ascii')
+        return content
+
+    def index(self, content: str) -> Optional[int]:
+        if not self._head(content).startswith(self.marker):
+            return None
+        index, = unpack('>I', b64decode(content)[len(self.marker):])
+        return index
+
+    def unescape_literal(self, content: str) -> str:
+        if self._head(content).startswith(self.escape):
+            return b64encode(b64decode(content)[len(self.escape):]).decode('ascii')
+        return content
+
+    def _head(self, content: str) -> bytes:
+        try:
+            return b64decode(content[:self._head_length])
+        except ValueError:
+            return b''
+
+
+def email_digest(email: dict) -> str:
+    normalized = {key: int(value) if isinstance(value, bool) else value
+                  for key, value in email.items() if value}
+    return sha256(dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def download_to_file(url: str, headers: Optional[dict] = None) -> str:
+    response = requests.get(url, stream=True, headers=headers)
     response.raise_for_status()
 
     with NamedTemporaryFile(mode='wb', delete=False) as fobj:
@@ -46,14 +319,25 @@ def download_to_file(url: str) -> str:
     return fobj.name
 
 
-def download_sample_emails(emails_zip_url: str, inputs_dir: str) -> None:
+def download_sample_emails(emails_zip_url: str, inputs_dir: str, headers: Optional[dict] = None) -> None:
     if isdir(inputs_dir):
         return
 
-    emails_zip = download_to_file(emails_zip_url)
+    emails_zip = download_to_file(emails_zip_url, headers)
     try:
-        makedirs(inputs_dir, exist_ok=True)
-        ZipFile(emails_zip).extractall(inputs_dir)
+        parent_dir = dirname(abspath(inputs_dir))
+        makedirs(parent_dir, exist_ok=True)
+        # extract next to the target and move it into place so that concurrent readers never see a partial corpus
+        extract_dir = mkdtemp(prefix='.extract-', dir=parent_dir)
+        try:
+            ZipFile(emails_zip).extractall(extract_dir)
+            try:
+                rename(extract_dir, inputs_dir)
+            except OSError:
+                if not isdir(inputs_dir):
+                    raise
+        finally:
+            rmtree(extract_dir, ignore_errors=True)
     finally:
         remove(emails_zip)
 